@@ -0,0 +1,361 @@
+"""
+Reproducible benchmarks for the wdc library.
+
+Measures the cold import time of the module, query generation for large expression trees and switch
+statements, the memory held by large expressions built from the classes and from interned nodes,
+decoding of large CSV and PNG payloads (in one process and across a process pool), and
+end-to-end throughput and latency of Query.execute_query against a local stub WCPS HTTP server with
+configurable latency and payload size. Results are written as JSON so runs of
+different versions can be compared:
+
+    python bench_wdc.py --output before.json
+    python bench_wdc.py --output after.json --compare before.json
+"""
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'wdc'))
+from wdc import (Query, DatabaseConnection, Coverage, Axis, BinaryOperation, Switch, Case, RGBColor, MetricsAggregator,
+                 DecodePipeline, NodeScope, OperationNode, CaseNode, ColorNode, SwitchNode, to_node, decode_csv,
+                 decode_result)
+
+def measure(function, repeat):
+    """
+    Runs a function repeat times and summarizes the wall-clock durations in seconds.
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return {'min': min(durations), 'median': statistics.median(durations), 'repeat': repeat}
+
+def balanced_expression(coverages, size, combine=BinaryOperation):
+    """
+    Builds a balanced tree with size leaves, cycling through the coverages; combine builds each operation.
+    """
+    operators = ['+', '-', '*', '/']
+    level = [coverages[index % len(coverages)] if index % 3 else index for index in range(size)]
+    depth = 0
+    while len(level) > 1:
+        operator = operators[depth % len(operators)]
+        paired = [combine(level[index], operator, level[index + 1]) for index in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            paired.append(level[-1])
+        level = paired
+        depth += 1
+    return level[0]
+
+def bench_generate(scale, repeat):
+    results = {}
+    Coverage.coverage_counter = 1
+    coverages = [Coverage(f"Cube{index}") for index in range(4)]
+    for coverage in coverages:
+        coverage.set_subset(Axis("Lat", 35, 75), Axis("Long", -20, 40), Axis("ansi", '"2014-07"'))
+    query = Query(DatabaseConnection("http://localhost"))
+    for coverage in coverages:
+        query.add_coverage(coverage)
+    query.set_operation('encode')
+    query.set_return('CSV')
+    for size in (1000 * scale, 10000 * scale):
+        expression = balanced_expression(coverages, size)
+        results[f'expression_tree_{size}_leaves'] = measure(lambda: query.generate_query(expression), repeat)
+
+    query.set_operation('colorcoding')
+    query.set_return('PNG')
+    breakpoints = [index * 0.1 for index in range(1000 * scale)]
+    colors = [(index % 256, (index * 7) % 256, (index * 13) % 256) for index in range(len(breakpoints) + 1)]
+    switch = Switch(RGBColor(*colors[-1]))
+    for breakpoint, color in zip(breakpoints, colors):
+        switch.add_case(Case(coverages[0] < breakpoint, RGBColor(*color)))
+    query.set_switch(switch)
+    results[f'switch_{len(breakpoints)}_cases'] = measure(lambda: query.generate_query(coverages[0]), repeat)
+    results[f'switch_from_thresholds_{len(breakpoints)}'] = measure(
+        lambda: Switch.from_thresholds(coverages[0], breakpoints, colors), repeat)
+    query.set_switch(Switch.from_thresholds(coverages[0], breakpoints, colors))
+    results[f'threshold_switch_{len(breakpoints)}_cases'] = measure(lambda: query.generate_query(coverages[0]), repeat)
+    return results
+
+def traced(build):
+    """
+    Builds an expression and returns it with the bytes still allocated afterwards and the build time.
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    expression = build()
+    seconds = time.perf_counter() - start
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return expression, allocated, seconds
+
+def bench_memory(scale):
+    """
+    Compares the memory held by expressions built from BinaryOperation objects and from interned nodes, built
+    in a NodeScope and kept after it ends, or interned in the weak table:
+    a running sum with a repeated term, a balanced tree whose subtrees repeat and a colormap switch whose cases
+    compare the same converted values.
+    """
+    Coverage.coverage_counter = 1
+    coverages = [Coverage(f"Cube{index}") for index in range(4)]
+    for coverage in coverages:
+        coverage.set_subset(Axis("Lat", 35, 75), Axis("Long", -20, 40), Axis("ansi", '"2014-07"'))
+    nodes = [to_node(coverage) for coverage in coverages]
+
+    def running_sum(coverage, size):
+        expression = coverage * 1
+        for index in range(size):
+            expression = expression + (coverage * (index % 100) + index)
+        return expression
+
+    def colormap(coverage, size, switch, case, color):
+        cases = [case(((coverage - 273.15) / 10) < index * 0.01, color(index % 16 * 16, 0, 255 - index % 16 * 16))
+                 for index in range(size)]
+        return switch(cases, color(255, 255, 255))
+
+    def switch(cases, default):
+        built = Switch(default)
+        for case in cases:
+            built.add_case(case)
+        return built
+
+    builds = {
+        f'running_sum_{100000 * scale}': (lambda: running_sum(coverages[0], 100000 * scale),
+                                          lambda: running_sum(nodes[0], 100000 * scale)),
+        f'balanced_{100000 * scale}_leaves': (lambda: balanced_expression(coverages, 100000 * scale),
+                                              lambda: balanced_expression(nodes, 100000 * scale, OperationNode)),
+        f'switch_{10000 * scale}_cases': (lambda: colormap(coverages[0], 10000 * scale, switch, Case, RGBColor),
+                                          lambda: colormap(nodes[0], 10000 * scale, SwitchNode, CaseNode, ColorNode)),
+    }
+    results = {}
+    for name, (classes, interned) in builds.items():
+        expression, allocated, seconds = traced(classes)
+        text = None if name.startswith('running_sum') else str(expression)  # Running sums are too deep for BinaryOperation
+        del expression
+        scope = NodeScope()
+
+        def scoped():
+            with scope:
+                built = interned()
+                scoped.nodes = len(scope)
+            return built
+
+        node, node_allocated, node_seconds = traced(scoped)
+        if text is not None:
+            assert str(node) == text
+        del node
+        weak, weak_allocated, weak_seconds = traced(interned)
+        del weak
+        results[name] = {'classes_bytes': allocated, 'nodes_bytes': node_allocated, 'ratio': node_allocated / allocated,
+                         'weak_bytes': weak_allocated, 'weak_ratio': weak_allocated / allocated, 'nodes': scoped.nodes,
+                         'classes_build': seconds, 'nodes_build': node_seconds, 'weak_build': weak_seconds}
+    return results
+
+def bench_decode(scale, repeat):
+    import numpy as np
+    from PIL import Image
+    results = {}
+    rng = np.random.default_rng(0)
+    side = 500 * scale
+    values = rng.uniform(-40, 40, (side, side)).round(3)
+    csv = ','.join('{' + ','.join(map(str, row)) + '}' for row in values.tolist()).encode()
+    results[f'csv_{side}x{side}'] = dict(measure(lambda: decode_csv(csv), repeat), bytes=len(csv))
+    series = ','.join(map(str, values.ravel().tolist())).encode()
+    results[f'csv_1d_{side * side}'] = dict(measure(lambda: decode_csv(series), repeat), bytes=len(series))
+    buffer = io.BytesIO()
+    Image.fromarray(rng.integers(0, 256, (side * 2, side * 2, 3), dtype=np.uint8), 'RGB').save(buffer, format='PNG')
+    png = buffer.getvalue()
+    results[f'png_{side * 2}x{side * 2}'] = dict(measure(lambda: decode_result(png, 'PNG'), repeat), bytes=len(png))
+    return results
+
+def bench_parallel_decode(scale, repeat, workers):
+    """
+    Decodes a batch of PNG payloads on a thread pool and with DecodePipeline for each number of processes.
+    """
+    import numpy as np
+    from PIL import Image
+    rng = np.random.default_rng(0)
+    side = 500 * scale
+    payloads = []
+    for _ in range(16):
+        buffer = io.BytesIO()
+        Image.fromarray(rng.integers(0, 256, (side, side, 3), dtype=np.uint8), 'RGB').save(buffer, format='PNG')
+        payloads.append(buffer.getvalue())
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(workers)) as executor:
+        results['threads'] = measure(lambda: list(executor.map(lambda content: decode_result(content, 'PNG'), payloads)), repeat)
+    for count in workers:
+        with DecodePipeline(max_workers=count) as pipeline:
+            pipeline.decode(payloads[0], 'PNG').result()  # Start the worker processes before measuring
+            results[f'processes_{count}'] = measure(
+                lambda: [future.result() for future in [pipeline.decode(content, 'PNG') for content in payloads]], repeat)
+    for entry in results.values():
+        entry['payloads'] = len(payloads)
+    return results
+
+class StubWCPSServer:
+    """
+    A local HTTP server that answers every POST with a fixed-size payload after a fixed delay.
+    """
+
+    def __init__(self, latency, payload_bytes):
+        payload = (b'1.5,' * (payload_bytes // 4 + 1))[:payload_bytes]
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                time.sleep(latency)
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/csv')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/rasdaman/ows'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+def bench_end_to_end(requests_count, concurrency, latency, payload_bytes):
+    with StubWCPSServer(latency, payload_bytes) as server:
+        Coverage.coverage_counter = 1
+        coverage = Coverage("AvgLandTemp")
+        coverage.set_subset(Axis("Lat", 53.08), Axis("Long", 8.80), Axis("ansi", '"2014-01"', '"2014-12"'))
+        query = Query(DatabaseConnection(server.url))
+        query.add_coverage(coverage)
+        query.set_operation('encode')
+        query.set_return('CSV')
+        metrics = MetricsAggregator(max_samples=requests_count)
+        query.add_observer(metrics)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            contents = list(executor.map(lambda _: query.execute_query(coverage), range(requests_count)))
+        elapsed = time.perf_counter() - start
+    failures = sum(1 for content in contents if isinstance(content, str))
+    return {
+        'requests': requests_count,
+        'concurrency': concurrency,
+        'latency': latency,
+        'payload_bytes': payload_bytes,
+        'failures': failures,
+        'seconds': elapsed,
+        'requests_per_second': requests_count / elapsed,
+        'latency_p50': metrics.percentile('total', 50),
+        'latency_p90': metrics.percentile('total', 90),
+        'latency_p99': metrics.percentile('total', 99),
+    }
+
+def bench_import(repeat):
+    """
+    Measures the cold import time of wdc in fresh interpreters, with compiled bytecode available.
+    """
+    source = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'wdc')
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    code = "import sys; import wdc; print('requests' in sys.modules)"
+    subprocess.run([sys.executable, '-c', code], cwd=source, env=env, capture_output=True)
+    timings = []
+    loads_requests = None
+    for _ in range(repeat):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=source, env=env,
+                                 capture_output=True, text=True)
+        loads_requests = process.stdout.strip() == 'True'
+        # The last line of -X importtime is the top level import of wdc; its cumulative time is in microseconds.
+        line = [line for line in process.stderr.splitlines() if line.rstrip().endswith('| wdc')][-1]
+        timings.append(int(line.split('|')[1]) / 1e6)
+    return {'wdc': {'median': statistics.median(timings), 'min': min(timings), 'max': max(timings),
+                    'loads_requests': loads_requests}}
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'commit': commit,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def compare(results, baseline):
+    """
+    Prints the ratio of each timing to the baseline; values above 1 are slower.
+    """
+    for section, entries in results.items():
+        for name, entry in entries.items():
+            before = baseline.get(section, {}).get(name)
+            if not before:
+                continue
+            for key in ('median', 'latency_p50', 'latency_p99'):
+                if key in entry and before.get(key):
+                    print(f"{section}.{name}.{key}: {entry[key] / before[key]:.2f}x", file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the wdc library.")
+    parser.add_argument('--sections', nargs='+', default=['import', 'generate', 'memory', 'decode', 'parallel_decode', 'end_to_end'],
+                        choices=['import', 'generate', 'memory', 'decode', 'parallel_decode', 'end_to_end'],
+                        help="Which benchmarks to run.")
+    parser.add_argument('--scale', type=int, default=1, help="Multiplies the size of the generated inputs.")
+    parser.add_argument('--repeat', type=int, default=5, help="Repetitions of each micro benchmark.")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count() or 1],
+                        help="Decoding processes to test in the parallel decode benchmark.")
+    parser.add_argument('--requests', type=int, default=200, help="Requests sent in the end-to-end benchmark.")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8], help="Parallel clients to test.")
+    parser.add_argument('--latency', type=float, default=0.01, help="Seconds the stub server waits per request.")
+    parser.add_argument('--payload', type=int, default=64 * 1024, help="Bytes the stub server returns per request.")
+    parser.add_argument('--output', help="Write the JSON results to this file instead of stdout.")
+    parser.add_argument('--compare', help="A previous JSON result to compare against.")
+    args = parser.parse_args(argv)
+
+    results = {}
+    if 'import' in args.sections:
+        results['import'] = bench_import(args.repeat)
+    if 'generate' in args.sections:
+        results['generate'] = bench_generate(args.scale, args.repeat)
+    if 'memory' in args.sections:
+        results['memory'] = bench_memory(args.scale)
+    if 'decode' in args.sections:
+        results['decode'] = bench_decode(args.scale, args.repeat)
+    if 'parallel_decode' in args.sections:
+        results['parallel_decode'] = bench_parallel_decode(args.scale, args.repeat, sorted(set(args.workers)))
+    if 'end_to_end' in args.sections:
+        results['end_to_end'] = {
+            f'concurrency_{concurrency}': bench_end_to_end(args.requests, concurrency, args.latency, args.payload)
+            for concurrency in args.concurrency
+        }
+    report = {'environment': environment(), 'results': results}
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file)['results'])
+
+if __name__ == '__main__':
+    main()
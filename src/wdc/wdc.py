@@ -1,62 +1,467 @@
-import requests
-from requests.exceptions import HTTPError
+import abc
+import operator
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+class HTTPError(IOError):
+    """
+    Raised for responses with an HTTP error status code (4XX or 5XX).
+    """
+
+    def __init__(self, *args, response=None):
+        super().__init__(*args)
+        self.response = response  # The response that carried the error status
+
+class Transport(abc.ABC):
+    """
+    The interface DatabaseConnection uses to talk HTTP. Subclasses must implement request; the returned object
+    needs status_code, headers, content, elapsed and raise_for_status, like requests.Response or QueryResponse.
+    """
+
+    @abc.abstractmethod
+    def request(self, method, url, fields=None):
+        """
+        Sends one HTTP request.
+
+        Args:
+            method (str): 'GET' or 'POST'.
+            url (str): The URL to send the request to.
+            fields (dict, optional): Form fields for POST, or query parameters for GET.
+
+        Returns:
+            The response, whatever its status code.
+        """
+        raise NotImplementedError
+
+    def post(self, url, fields):
+        return self.request('POST', url, fields)
+
+    def get(self, url, params=None):
+        return self.request('GET', url, params)
+
+    def close(self):
+        """
+        Releases any connections held by the transport.
+        """
+
+class _ThreadConnections(dict):
+    """
+    The kept-alive connections of one thread of an HTTPClientTransport, keyed by (scheme, host). It lives
+    in a thread-local, so it is freed when its thread ends, e.g. when a ThreadPoolExecutor shuts down, and
+    then closes its connections.
+    """
+
+    def __init__(self, transport):
+        super().__init__()
+        self.transport = transport
+
+    def __del__(self):
+        for connection in self.values():
+            self.transport._release(connection)
+
+class HTTPClientTransport(Transport):
+    """
+    The default transport, built on the standard library's http.client so that importing wdc stays cheap.
+    Connections are kept alive and reused per thread, and closed when their thread ends. As with the library's original requests-based code,
+    TLS certificates are not verified unless verify is True.
+    """
+
+    def __init__(self, timeout=None, verify=False):
+        """
+        Initializes an HTTPClientTransport.
+
+        Args:
+            timeout (float, optional): Seconds to wait for connecting and for each read, or None to wait forever.
+            verify (bool): Whether TLS certificates are verified.
+        """
+        self.timeout = timeout
+        self.verify = verify
+        self._local = threading.local()
+        self._all_connections = []
+        self._lock = threading.Lock()
+
+    def _connection(self, scheme, host):
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = _ThreadConnections(self)
+        connection = connections.get((scheme, host))
+        if connection is not None:
+            return connection, True
+        import http.client
+        if scheme == 'https':
+            import ssl
+            context = ssl.create_default_context() if self.verify else ssl._create_unverified_context()
+            connection = http.client.HTTPSConnection(host, timeout=self.timeout, context=context)
+        else:
+            connection = http.client.HTTPConnection(host, timeout=self.timeout)
+        connections[(scheme, host)] = connection
+        with self._lock:
+            self._all_connections.append(connection)
+        return connection, False
+
+    def _release(self, connection):
+        connection.close()
+        with self._lock:
+            if connection in self._all_connections:
+                self._all_connections.remove(connection)
+
+    def _discard(self, scheme, host, connection):
+        self._local.connections.pop((scheme, host), None)
+        self._release(connection)
+
+    def request(self, method, url, fields=None):
+        from urllib.parse import urlsplit, urlencode
+        parts = urlsplit(url)
+        path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        body, headers = None, {}
+        if method == 'POST':
+            body = urlencode(fields or {}).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        elif fields:
+            path += ('&' if '?' in path else '?') + urlencode(fields)
+        while True:
+            connection, reused = self._connection(parts.scheme, parts.netloc)
+            start = time.perf_counter()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                elapsed = time.perf_counter() - start  # Time until the headers arrived
+                content = response.read()
+            except OSError as err:
+                self._discard(parts.scheme, parts.netloc, connection)
+                if reused and isinstance(err, (ConnectionResetError, BrokenPipeError)):
+                    continue  # The server closed an idle kept-alive connection; open a new one
+                raise
+            except Exception:
+                self._discard(parts.scheme, parts.netloc, connection)
+                raise
+            if response.will_close:
+                self._discard(parts.scheme, parts.netloc, connection)
+            return QueryResponse(content, response.status, dict(response.getheaders()), elapsed)
+
+    def close(self):
+        """
+        Closes the sockets of all threads' connections. A connection that is used again reopens its socket.
+        """
+        with self._lock:
+            connections = list(self._all_connections)
+        for connection in connections:
+            connection.close()
+
+class RequestsTransport(Transport):
+    """
+    A transport built on the requests library, which is imported on first use.
+    """
+
+    def __init__(self, verify=False):
+        """
+        Initializes a RequestsTransport.
+
+        Args:
+            verify (bool): Whether TLS certificates are verified.
+        """
+        self.verify = verify
+
+    def request(self, method, url, fields=None):
+        import requests
+        if method == 'POST':
+            return requests.post(url, data=fields, verify=self.verify)
+        return requests.get(url, params=fields, verify=self.verify)
 
 class DatabaseConnection:
     """
     Manages HTTP connections to a database server to facilitate the sending of queries.
     This class abstracts the details of network communications using HTTP POST requests.
     """
-    def __init__(self, server_url):
+    def __init__(self, server_url, retries=0, backoff=0.5, transport=None):
         """
         Initialize a new DatabaseConnection instance.
         
         Args:
             server_url (str): The URL of the database server where queries will be sent.
+            retries (int): How many times a request is repeated after a network error or a 5XX response.
+            backoff (float): Seconds to wait before the first retry; the wait doubles for every further retry.
+            transport (Transport, optional): Sends the HTTP requests. Defaults to an HTTPClientTransport.
         """
         self.server_url = server_url
+        self.retries = retries
+        self.backoff = backoff
+        self.transport = transport if transport is not None else HTTPClientTransport()
+
+    def _post(self, query):
+        """
+        Sends one POST request and returns the response without checking its status.
+        """
+        return self.transport.post(self.server_url, {'query': query})
+
+    def close(self):
+        """
+        Closes the kept-alive connections of the transport.
+        """
+        self.transport.close()
+
+    def __enter__(self):
+        return self
 
-    def send_request(self, query):
+    def __exit__(self, *args):
+        self.close()
+
+    def send_request(self, query, event=None):
         """
         Sends a POST request to the configured database server with the specified query.
         
         Args:
             query (str): The WCPS or query language string to be executed by the database server.
+            event (QueryEvent, optional): Receives the network and download timings, status and retries.
         
         Returns:
-            requests.Response: The response object containing HTTP status, headers, and payload returned by the server.
+            The response object containing HTTP status, headers, and payload returned by the server,
+            or None if the request failed.
         
         Raises:
-            HTTPError: An error from the requests library for responses with HTTP error status codes.
+            HTTPError: Raised for responses with HTTP error status codes, caught and reported.
             Exception: Catches other general exceptions related to network failures or decoding issues.
         """
+        attempt = 0
+        while True:
+            start = time.perf_counter() if event is not None else None
+            try:
+                response = self._post(query)
+                if event is not None:
+                    event.record_response(response, time.perf_counter() - start, attempt)
+                response.raise_for_status()  # Raises HTTPError for bad responses (4XX or 5XX)
+                return response
+            except Exception as err:
+                # HTTP errors of any transport carry the response with its status code.
+                status = getattr(getattr(err, 'response', None), 'status_code', None)
+                is_http_error = isinstance(status, int)
+                if attempt < self.retries and (not is_http_error or status >= 500):
+                    attempt = self._wait_before_retry(attempt)
+                    continue
+                if is_http_error:
+                    print(f"HTTP error occurred: {err}")  # Print and handle HTTP-specific errors
+                else:
+                    print(f"An error occurred: {err}")  # Print and handle other exceptions like network errors
+                if event is not None:
+                    event.retries = attempt
+                    event.error = str(err)
+                return None
+
+    def _wait_before_retry(self, attempt):
+        """
+        Sleeps with exponential backoff and returns the number of the next attempt.
+        """
+        time.sleep(self.backoff * (2 ** attempt))
+        return attempt + 1
+
+    def describe_coverage(self, name):
+        """
+        Fetches the axes, extents and cell types of a coverage with a WCS DescribeCoverage request.
+
+        Args:
+            name (str): The name of the coverage.
+
+        Returns:
+            CoverageMetadata: The description of the coverage, or None if the request failed.
+        """
+        params = {'SERVICE': 'WCS', 'VERSION': '2.0.1', 'REQUEST': 'DescribeCoverage', 'COVERAGEID': name}
         try:
-            response = requests.post(self.server_url, data={'query': query}, verify=False)
-            response.raise_for_status()  # Raises HTTPError for bad responses (4XX or 5XX)
-            return response
-        except HTTPError as http_err:
-            print(f"HTTP error occurred: {http_err}")  # Print and handle HTTP-specific errors
-            return None
+            response = self.transport.get(self.server_url, params)
+            response.raise_for_status()
+            return CoverageMetadata.from_xml(response.content)
         except Exception as err:
-            print(f"An error occurred: {err}")  # Print and handle other exceptions like network errors
+            print(f"An error occurred: {err}")
             return None
     
+_BINDING = re.compile(r'\$(\w+) in \(([^)]*)\)')
+_VARIABLE = re.compile(r'\$(\w+)')
+
+def _normalize_variables(text):
+    """
+    Returns the query text with every coverage variable of its for clause replaced by the coverage name,
+    e.g. $AvgLandTemp for $c1, since variables depend on how many Coverage objects were created before.
+    A name bound to several variables is numbered: $AvgLandTemp#1, $AvgLandTemp#2.
+    """
+    clause, _, _ = text.partition('\nreturn ')
+    bindings = _BINDING.findall(clause)
+    names = [name for _, name in bindings]
+    seen = {}
+    renames = {}
+    for variable, name in bindings:
+        seen[name] = seen.get(name, 0) + 1
+        renames[variable] = name if names.count(name) == 1 else f'{name}#{seen[name]}'
+    return _VARIABLE.sub(lambda match: f'${renames.get(match.group(1), match.group(1))}', text)
+
+class RecordingConnection(DatabaseConnection):
+    """
+    A DatabaseConnection that records every response it receives (status, headers and body, with the
+    query text) to a compact zip archive, so the traffic can later be served by a ReplayConnection.
+    Identical bodies are stored once.
+    """
+
+    def __init__(self, server_url, path, retries=0, backoff=0.5, transport=None):
+        """
+        Initializes a RecordingConnection and creates the archive.
+
+        Args:
+            server_url (str): The URL of the database server where queries will be sent.
+            path (str): The path of the archive to write. An existing file is replaced.
+            retries (int): As for DatabaseConnection.
+            backoff (float): As for DatabaseConnection.
+            transport (Transport, optional): As for DatabaseConnection.
+        """
+        import zipfile
+        super().__init__(server_url, retries, backoff, transport)
+        self.path = path
+        self._archive = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED)
+        self._index = []
+        self._bodies = set()
+        self._lock = threading.Lock()
+
+    def _post(self, query):
+        start = time.perf_counter()
+        response = super()._post(query)
+        duration = time.perf_counter() - start
+        import hashlib
+        content = response.content
+        digest = hashlib.sha1(content).hexdigest()
+        elapsed = getattr(response, 'elapsed', None)
+        elapsed = elapsed.total_seconds() if hasattr(elapsed, 'total_seconds') else duration
+        with self._lock:
+            if digest not in self._bodies:
+                self._archive.writestr(f'bodies/{digest}', content)
+                self._bodies.add(digest)
+            self._index.append({'query': query, 'status': response.status_code, 'headers': dict(response.headers),
+                                'elapsed': elapsed, 'body': digest})
+        return response
+
+    def close(self):
+        """
+        Writes the index and closes the archive.
+        """
+        with self._lock:
+            if self._archive.fp is None:
+                return
+            import json
+            self._archive.writestr('index.json', json.dumps(self._index))
+            self._archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class ReplayConnection(DatabaseConnection):
+    """
+    Serves the responses recorded by a RecordingConnection instead of contacting a server, for
+    deterministic offline tests and load tests. The archive is loaded into memory once, so any number
+    of threads can replay concurrently, optionally with the recorded latency or a multiple of it.
+    Queries are matched with their coverage variables replaced by the coverage names, so a replay does
+    not depend on how many Coverage objects were created before.
+    """
+
+    def __init__(self, path, latency_scale=None, retries=0, backoff=0.5):
+        """
+        Initializes a ReplayConnection from an archive.
+
+        Args:
+            path (str): The path of an archive written by RecordingConnection.
+            latency_scale (float, optional): If set, each response is delayed by its recorded latency times
+                                             this factor (1.0 for the original latency). If None, responses
+                                             are served immediately.
+            retries (int): As for DatabaseConnection.
+            backoff (float): As for DatabaseConnection.
+        """
+        import json
+        import zipfile
+        super().__init__(path, retries, backoff)
+        self.latency_scale = latency_scale
+        self._responses = {}  # Normalized query text -> list of recorded entries, in recording order
+        self._next = {}  # Normalized query text -> index of the entry served next
+        self._lock = threading.Lock()
+        with zipfile.ZipFile(path) as archive:
+            bodies = {}
+            for entry in json.loads(archive.read('index.json')):
+                if entry['body'] not in bodies:
+                    bodies[entry['body']] = archive.read(f"bodies/{entry['body']}")
+                entry['content'] = bodies[entry['body']]
+                self._responses.setdefault(_normalize_variables(entry['query']), []).append(entry)
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._responses.values())
+
+    def __contains__(self, query):
+        return _normalize_variables(query) in self._responses
+
+    def _post(self, query):
+        key = _normalize_variables(query)
+        entries = self._responses.get(key)
+        if not entries:
+            raise LookupError(f"No recorded response for query: {query[:100]!r}")
+        with self._lock:
+            # Repeated recordings of a query are served in turn, e.g. a failure followed by a successful retry.
+            position = self._next.get(key, 0)
+            self._next[key] = (position + 1) % len(entries)
+        entry = entries[position]
+        if self.latency_scale:
+            time.sleep(entry['elapsed'] * self.latency_scale)
+        return QueryResponse(entry['content'], entry['status'], entry['headers'], entry['elapsed'])
+
+class QueryResponse:
+    """
+    A response received by HTTPClientTransport or produced without a server, e.g. by a local backend.
+    It offers the attributes of requests.Response that the library relies on.
+    """
+
+    def __init__(self, content, status_code=200, headers=None, elapsed=None):
+        """
+        Initializes a QueryResponse.
+
+        Args:
+            content (bytes): The payload of the response.
+            status_code (int): The HTTP status code.
+            headers (dict, optional): The response headers.
+            elapsed (float, optional): The seconds it took to produce the response.
+        """
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.elapsed = elapsed
+
+    def __bool__(self):
+        return self.status_code < 400
+
+    def raise_for_status(self):
+        """
+        Raises an HTTPError if the status code signals a client or server error.
+        """
+        if self.status_code >= 400:
+            raise HTTPError(f"{self.status_code} error: {self.content[:200]!r}", response=self)
+
 class Coverage:
     """
     Represents a specific dataset or "coverage" in a database, typically used in geospatial data systems.
     This class allows specifying subsets of data through axis parameters and supports operations on the data.
     """
     coverage_counter = 1  # Class variable to make sure each coverage has a unique variable
-    def __init__(self, name):
+    def __init__(self, name, metadata=None):
         """
         Initializes a new instance of the Coverage class.
 
         Args:
             name (str): The name of the dataset or coverage as recognized by the database.
+            metadata (CoverageMetadata, optional): The description of the coverage. If given, subsets are
+                                                   validated against it when they are set.
         """
         self.name = name
+        self.metadata = metadata
         self.variable = f'c{Coverage.coverage_counter}'  # Unique identifier for this instance
         Coverage.coverage_counter += 1  # Increment the counter for each new instance
         self.subset = None  # To hold subset specifications if set
+        self.axes = []  # The Axis objects the subset was built from
 
     def __str__(self):
         """
@@ -78,13 +483,17 @@ class Coverage:
             *args: A variable number of Axis objects that define the subset parameters.
 
         Raises:
-            ValueError: If any argument is not an instance of the Axis class.
+            ValueError: If any argument is not an instance of the Axis class, or the subset does not
+                        match the metadata of the coverage.
         """
         for arg in args:
             if not isinstance(arg, Axis):
                 raise ValueError("All arguments must be instances of Axis")
+        if self.metadata is not None:
+            self.metadata.validate(args)
         axes_str = ', '.join(str(axis) for axis in args)  # Convert axes to string representation
         self.subset = f'[{axes_str}]'  # Format and store the subset parameters
+        self.axes = list(args)  # Keep the axes so the subset can be inspected or altered later
 
     # These methods enable arithmetic and comparison operations between Coverage instances or with other values.
     # Each operation returns a new BinaryOperation object representing the operation between two operands.
@@ -283,6 +692,46 @@ class Switch:
         """
         self.cases = []
         self.RGBColor = RGBColor
+        self.expression = None  # Expression compared against the breakpoints of a threshold switch
+        self.breakpoints = ()
+        self.threshold_colors = ()  # (red, green, blue) returned below each breakpoint
+
+    @classmethod
+    def from_thresholds(cls, expression, breakpoints, colors):
+        """
+        Builds a colormap switch from ascending breakpoints without creating a Case per breakpoint.
+        Cells below breakpoints[i] (and not below an earlier one) get colors[i]; cells at or above the
+        last breakpoint get colors[-1]. Neighbouring ranges with the same color are merged.
+
+        Args:
+            expression: The Coverage or BinaryOperation compared against the breakpoints.
+            breakpoints (sequence of numbers): Strictly ascending breakpoints, e.g. a list or NumPy array.
+            colors (sequence): len(breakpoints) + 1 colors, as RGBColor objects or (red, green, blue) triples.
+
+        Returns:
+            Switch: The threshold switch.
+
+        Raises:
+            ValueError: If the breakpoints are not strictly ascending or the number of colors does not match.
+        """
+        breakpoints = breakpoints.tolist() if hasattr(breakpoints, 'tolist') else list(breakpoints)
+        colors = colors.tolist() if hasattr(colors, 'tolist') else list(colors)
+        if len(colors) != len(breakpoints) + 1:
+            raise ValueError("from_thresholds needs exactly one more color than breakpoints")
+        if any(lower >= upper for lower, upper in zip(breakpoints, breakpoints[1:])):
+            raise ValueError("Breakpoints must be strictly ascending")
+        triples = [(color.red, color.green, color.blue) if hasattr(color, 'red') else tuple(int(channel) for channel in color)
+                   for color in colors]
+        kept_breakpoints, kept_colors = [], []
+        for breakpoint, color, next_color in zip(breakpoints, triples, triples[1:]):
+            if color != next_color:  # A breakpoint between two ranges of the same color never changes the result
+                kept_breakpoints.append(breakpoint)
+                kept_colors.append(color)
+        switch = cls(RGBColor(*triples[-1]))
+        switch.expression = expression
+        switch.breakpoints = tuple(kept_breakpoints)
+        switch.threshold_colors = tuple(kept_colors)
+        return switch
 
     def add_case(self, case):
         """
@@ -300,189 +749,3937 @@ class Switch:
     def __str__(self):
         """
         Returns a string representation of the switch statement formatted for usage in WCPS queries.
+        Threshold cases come first, in ascending order, followed by the cases added with add_case.
 
         Returns:
             str: A string representing the switch statement and its cases, formatted for readability.
         """
-        switch_statement = "switch\n"
+        parts = ["switch\n"]
+        if self.breakpoints:
+            expression = str(self.expression)  # Rendered once and shared by every threshold case
+            for breakpoint, (red, green, blue) in zip(self.breakpoints, self.threshold_colors):
+                parts.append(f"\tcase ({expression} < {breakpoint})\n\t\treturn {{red: {red}; green: {green}; blue: {blue}}}\n")
         for case in self.cases:
-            case_str = str(case)  # Explicit conversion to string and debugging
-            switch_statement += f"\t{case_str}\n"
-        switch_statement += f"\tdefault return {self.RGBColor}"
-        return switch_statement
-  
-class Query:
-    """
-    Manages operations on a datacube such as querying data through the DatabaseConnection.
-    """
-
-    VALID_RETURN_TYPES = {
-        'CSV': "text/csv",
-        'PNG': "image/png",
-        'JPEG': "image/jpeg"
-    }
+            parts.append(f"\t{case}\n")
+        parts.append(f"\tdefault return {self.RGBColor}")
+        return "".join(parts)
 
-    def __init__(self, dbc):
+    def evaluate(self, resolve):
         """
-        Initialize the Query instance with a DatabaseConnection.
+        Evaluates the switch statement locally, the same way the server does: each cell gets the color
+        of the first case whose expression holds, or the default color if none does.
 
         Args:
-            dbc (DatabaseConnection): The database connection to use for sending queries.
+            resolve (callable): Returns the NumPy array of values for a Coverage in the case expressions.
 
-        Attributes:
-            dbc (DatabaseConnection): Stores the database connection object that will be used for querying.
-            coverages (list): List to store coverage objects added for the query.
-            return_type (str, optional): The type of data to return from queries (CSV, PNG, JPEG), which
-                                         needs to match one of the predefined valid return types.
-            return_value (str, optional): Specific values or expressions to be returned by the query, used in
-                                          conjunction with return_type to format the output.
-            operation (str, optional): The operation to be performed on the data (e.g., max, min, average).
-                                       This defines the processing step to be applied to the dataset.
-            count_condition (str, optional): A condition to be applied specifically for count operations,
-                                             defining filters or criteria that count must satisfy.
-            Switch (Switch, optional): The switch statement to be used for colorcoding operation.
-        """
-        self.dbc = dbc
-        self.coverages = []
-        self.return_type = None
-        self.return_value = None
-        self.operation = None
-        self.count_condition = None
-        self.Switch = None
+        Returns:
+            numpy.ndarray: An array of uint8 RGB triples with the shape of the evaluated values plus 3.
 
-    def add_coverage(self, coverage):
+        Raises:
+            ValueError: If the switch has no cases or a case expression cannot be evaluated locally.
         """
-        Add a coverage to the datacube queries.
+        import numpy as np
+        if not self.cases and not self.breakpoints:
+            raise ValueError("A switch needs at least one case to be evaluated locally")
+        colors = list(self.threshold_colors)
+        colors += [(case.RGBColor.red, case.RGBColor.green, case.RGBColor.blue) for case in self.cases]
+        colors.append((self.RGBColor.red, self.RGBColor.green, self.RGBColor.blue))
+        palette = np.array(colors, dtype=np.uint8)
+        index = None
+        if self.cases:
+            conditions = np.broadcast_arrays(*[np.asarray(evaluate_expression(case.expression, resolve), dtype=bool)
+                                               for case in self.cases])
+            # First matching case wins; the index into the palette is then a single lookup per cell.
+            index = np.select(conditions, np.arange(len(self.cases)), default=len(self.cases)) + len(self.breakpoints)
+        if self.breakpoints:
+            values = np.asarray(evaluate_expression(self.expression, resolve))
+            # For ascending breakpoints the first case 'value < breakpoint' that holds is found by bisection.
+            threshold_index = np.searchsorted(np.asarray(self.breakpoints), values, side='right')
+            fallback = len(self.breakpoints) if index is None else index
+            index = np.where(threshold_index < len(self.breakpoints), threshold_index, fallback)
+        return palette[index]
+  
+class ExpressionNode:
+    """
+    Base class of the compact, immutable expression nodes. A node is interned when it is built: if an
+    identical node already exists, the constructor returns that one instead, so identical subtrees share
+    one object. Equality and hashing are structural; the hash is computed once from the hashes of the
+    children, so nodes can be used as dict keys or memoized, e.g. with functools.lru_cache.
+    Nodes render exactly like the classes they mirror.
 
-        Args:
-            coverage (Coverage): The coverage object.
+    Nodes are interned in a weak-valued table, so a node that is no longer used is released. Inside a
+    NodeScope they are interned in the scope's own plain dict instead, which is cheaper while a large
+    expression is built and is dropped when the scope ends.
+    """
+    __slots__ = ('_hash', '__weakref__')
+    _fields = ()
+    _weak_table = None  # Structural key -> node, created on first use
 
-        Raises:
-            TypeError: If coverage is not an instance of Coverage.
+    @classmethod
+    def _intern(cls, *values):
         """
-        if not isinstance(coverage, Coverage):
-            raise TypeError("coverage must be an instance of Coverage")
-        self.coverages.append(coverage)
-
-    def set_return(self, return_type, return_value=None):
+        Returns the node of this class with these field values, creating it if there is none yet.
         """
-        Set the return type and value for the results of the queries.
-
-        Args:
-            return_type (str): The type of return (e.g., 'CSV', 'PNG', 'JPEG').
-            return_value (str): The value to be returned, used in specific queries.
+        node = object.__new__(cls)
+        for name, value in zip(cls._fields, values):
+            object.__setattr__(node, name, value)
+        object.__setattr__(node, '_hash', hash((cls,) + values))
+        return _intern_node(node)
 
-        Raises:
-            ValueError: If the return_type is not valid.
+    @staticmethod
+    def _table():
         """
-        if return_type in self.VALID_RETURN_TYPES:
-            self.return_type = return_type
-            self.return_value = return_value
-        else:
-            raise ValueError(f"Invalid return type. Valid types are: {list(self.VALID_RETURN_TYPES.keys())}")
-
-    def set_operation(self, operation):
+        Returns the table nodes are interned in: the innermost NodeScope of this thread, or the weak table.
         """
-        Set the operation to perform on the data.
-
-        Args:
-            operation (str): The operation to be performed.
+        table = getattr(_node_scopes, 'table', None)
+        if table is not None:
+            return table
+        if ExpressionNode._weak_table is None:
+            import weakref
+            ExpressionNode._weak_table = weakref.WeakValueDictionary()
+        return ExpressionNode._weak_table
 
-        Raises:
-            ValueError: If the operation is not valid.
+    @staticmethod
+    def interned():
         """
-        if operation in ['max', 'min', 'avg', 'count', 'encode', 'colorcoding']:
-            self.operation = operation
-        else:
-            raise ValueError("Invalid operation.")
-
-    def set_count_condition(self, condition):
+        Returns the number of nodes in the current intern table: the innermost NodeScope, or the weak table.
         """
-        Set the condition for count operations.
+        return len(ExpressionNode._table())
 
-        Args:
-            condition (str): The condition to be applied in a count operation.
+    @staticmethod
+    def clear():
         """
-        self.count_condition = condition
-
-    def set_switch(self, switch):
+        Empties the current intern table. Existing nodes stay valid and equal to nodes built later with the
+        same structure; they are only no longer shared with them.
         """
-        Set the switch statement for colorcoding operation.
+        ExpressionNode._table().clear()
 
-        Args:
-            Switch (Switch): The Switch object representing the switch statement.
+    def _values(self):
+        return [getattr(self, name) for name in self._fields]
+
+    def _weak_key(self):
         """
-        self.Switch = switch
-        
-    def is_aggregation_operation(operation):
+        The key of the node in the weak table, which must not refer to the node itself. Constants are tagged
+        with their type, since 1, 1.0 and True are equal in Python but render differently.
         """
-        Determines if the provided operation is an aggregation type.
+        return (type(self),) + tuple(value if isinstance(value, (ExpressionNode, tuple))
+                                     else (float, repr(value)) if type(value) is float else (type(value), value)
+                                     for value in self._values())
 
-        Args:
-            operation (str): The operation to check.
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if type(self) is not type(other) or self._hash != other._hash:
+            return False
+        return _nodes_equal(self, other)
 
-        Returns:
-            bool: True if the operation is an aggregation, False otherwise.
-        """
-        return operation in ['max', 'min', 'avg', 'count']
+    def __hash__(self):
+        return self._hash
 
-    def generate_query(self, expression):
-        """
-        Generate the database query based on the set parameters and the provided expression.
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
 
-        Args:
-            expression (str): The expression to be included in the query and used for the operations. Could also be a single coverage.
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
 
-        Returns:
-            str: The generated query string.
+    def __reduce__(self):
+        # Unpickled nodes go through the constructor again, so they are interned in the receiving process too.
+        return (type(self), tuple(self._values()))
 
-        Raises:
-            ValueError: If the parameters are insufficient to generate a valid query.
-        """
-        if not self.coverages:
-            raise ValueError("At least one coverage must be added before generating the query.")
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(repr(value) for value in self._values())})"
 
-        base_query = ""
-        for coverage in self.coverages:
-            if base_query:
-                base_query += ",\n"
-            base_query += f"${coverage.variable} in ({coverage.name})"  # Include each coverage
-        base_query = "for " + base_query + "\n"
+_node_scopes = threading.local()  # The table of the innermost NodeScope of each thread
 
-        if self.operation in ['max', 'min', 'avg', 'count', 'encode', 'colorcoding']:
-            if self.operation == 'count' and self.count_condition: # Count operation
-                return f"{base_query}return count({expression} {self.count_condition})"
-            elif self.operation == 'encode' and self.return_type: # Encode operation
-                return f"{base_query}return encode({expression}, \"{self.VALID_RETURN_TYPES[self.return_type]}\")"
-            elif self.operation == 'colorcoding' and (self.return_type == 'PNG' or self.return_type == 'JPEG') and self.Switch: # Switch operation
-                return f"{base_query} return encode(\n    {self.Switch}\n\t, \"{self.VALID_RETURN_TYPES[self.return_type]}\")"
-            elif Query.is_aggregation_operation(self.operation): # Check if it's an aggregation operation
-                return f"{base_query}return {self.operation}({expression})"
+def _intern_node(node):
+    table = getattr(_node_scopes, 'table', None)
+    if table is not None:
+        return table.setdefault(node, node)
+    return ExpressionNode._table().setdefault(node._weak_key(), node)
 
-        # Most basic query
-        elif self.return_value is not None:
-            return f"{base_query}return {self.return_value}"
+def _nodes_equal(first, second):
+    """
+    Compares two nodes structurally without recursion, so long chains compare too. Identical children are
+    skipped at once, and each pair of shared subtrees is compared only once.
+    """
+    pending = [(first, second)]
+    compared = set()
+    while pending:
+        mine, theirs = pending.pop()
+        if mine is theirs:
+            continue
+        if isinstance(mine, ExpressionNode):
+            if type(mine) is not type(theirs) or mine._hash != theirs._hash:
+                return False
+            pair = (id(mine), id(theirs))
+            if pair not in compared:
+                compared.add(pair)
+                pending.extend(zip(mine._values(), theirs._values()))
+        elif isinstance(mine, tuple):
+            if type(theirs) is not tuple or len(mine) != len(theirs):
+                return False
+            pending.extend(zip(mine, theirs))
+        elif type(mine) is not type(theirs) or mine != theirs or (type(mine) is float and repr(mine) != repr(theirs)):
+            return False  # Constants must have the same type; the text of floats tells -0.0 from 0.0
+    return True
 
-        # Selecting a single value
-        elif not self.operation:
-            return f"{base_query}return ({expression})"
+class NodeScope:
+    """
+    Interns the nodes built by this thread inside a with block in a plain dict of the scope, instead of
+    the weak table. That keeps building large generated expressions fast and compact; when the block ends
+    the dict is dropped, and the nodes that are still used keep only their own memory. Nodes built in
+    different scopes are equal if their structure is, but they are not shared.
+    """
 
-        else:
-            raise ValueError("Insufficient parameters to generate a valid query: check operation, subset parameters, and return types.")
+    def __init__(self):
+        self.table = {}  # Every node built in the scope, mapped to itself
+        self._previous = None
 
-    def execute_query(self, expression):
-        """
-        Execute the generated query using the DatabaseConnection.
+    def __len__(self):
+        return len(self.table)
 
-        Args:
-            expression (str): The expression to be executed and included in the query and used for the operations. Could also be a single coverage.
+    def __enter__(self):
+        self._previous = getattr(_node_scopes, 'table', None)
+        _node_scopes.table = self.table
+        return self
 
-        Returns:
-            bytes or str: The raw content of the response if successful, or an error message if the request fails.
-        """
-        query = self.generate_query(expression)  # Generate the query based on current settings
-        response = self.dbc.send_request(query)  # Send the query and receive the response
-        if response:
+    def __exit__(self, *args):
+        _node_scopes.table = self._previous
+        self.table = {}
+
+def _node_operand(value):
+    """
+    Returns the operand of a node for a value: nodes are kept, expression objects are converted with
+    to_node, NumPy scalars become Python numbers and numbers and strings are kept as they are.
+    """
+    if type(value) in (int, float, str, bool) or isinstance(value, ExpressionNode):
+        return value
+    if isinstance(value, (Coverage, BinaryOperation, Axis, RGBColor, Case, Switch)):
+        return to_node(value)
+    if getattr(value, 'ndim', None) == 0 and hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, (int, float, str)):
+        return value
+    raise TypeError(f"{type(value).__name__} cannot be used in an expression node")
+
+class _OperandNode(ExpressionNode):
+    """
+    Base class of the nodes that can be combined with operators into OperationNodes. Since == compares
+    nodes, the WCPS comparisons '=' and '!=' are built with eq and ne instead.
+    """
+    __slots__ = ()
+
+    def __add__(self, other):
+        return OperationNode(self, '+', other)
+
+    def __sub__(self, other):
+        return OperationNode(self, '-', other)
+
+    def __mul__(self, other):
+        return OperationNode(self, '*', other)
+
+    def __truediv__(self, other):
+        return OperationNode(self, '/', other)
+
+    def __lt__(self, other):
+        return OperationNode(self, '<', other)
+
+    def __le__(self, other):
+        return OperationNode(self, '<=', other)
+
+    def __gt__(self, other):
+        return OperationNode(self, '>', other)
+
+    def __ge__(self, other):
+        return OperationNode(self, '>=', other)
+
+    def eq(self, other):
+        return OperationNode(self, '==', other)
+
+    def ne(self, other):
+        return OperationNode(self, '!=', other)
+
+class AxisNode(ExpressionNode):
+    """
+    The immutable counterpart of Axis.
+    """
+    __slots__ = ('name', 'lower_bound', 'upper_bound')
+    _fields = __slots__
+
+    def __new__(cls, name, lower_bound, upper_bound=None):
+        """
+        Returns the interned axis with this name and bounds.
+
+        Args:
+            name (str): The name of the axis.
+            lower_bound (int, float or str): The lower bound, or the single value if upper_bound is None.
+            upper_bound (int, float or str, optional): The upper bound of the axis range.
+        """
+        return cls._intern(name, _node_operand(lower_bound), None if upper_bound is None else _node_operand(upper_bound))
+
+    def __str__(self):
+        if self.upper_bound is None:
+            return f"{self.name}({self.lower_bound})"
+        return f"{self.name}({self.lower_bound}:{self.upper_bound})"
+
+class CoverageNode(_OperandNode):
+    """
+    The immutable counterpart of a Coverage: its name, its variable in the query and its subset.
+    """
+    __slots__ = ('name', 'variable', 'axes')
+    _fields = __slots__
+
+    def __new__(cls, name, variable, axes=()):
+        """
+        Returns the interned coverage reference.
+
+        Args:
+            name (str): The name of the coverage on the server.
+            variable (str): The variable of the coverage in the query, e.g. 'c1'.
+            axes (iterable of AxisNode or Axis, optional): The subset of the coverage.
+        """
+        axes = tuple(axis if isinstance(axis, AxisNode) else AxisNode(axis.name, axis.lower_bound, axis.upper_bound)
+                     for axis in axes)
+        return cls._intern(name, variable, axes)
+
+    def __str__(self):
+        if self.axes:
+            return f"${self.variable}[{', '.join(str(axis) for axis in self.axes)}]"
+        return f"${self.variable}"
+
+class OperationNode(_OperandNode):
+    """
+    The immutable counterpart of BinaryOperation. Each operator has its own subclass that holds the
+    operator as a class attribute, so an operation only stores its two operands and its hash.
+    """
+    __slots__ = ('lhs', 'rhs')
+    _fields = __slots__
+    _classes = {}  # Operator -> the subclass for it
+
+    def __new__(cls, lhs, operator, rhs):
+        """
+        Returns the interned operation.
+
+        Args:
+            lhs: The left-hand side operand: a node, an expression object, a number or a string.
+            operator (str): The operator symbol, such as '+', '<' or '=='.
+            rhs: The right-hand side operand.
+
+        Raises:
+            TypeError: If an operand cannot be used in an expression node, or the operator is not a string.
+        """
+        node_class = OperationNode._classes.get(operator)
+        if node_class is None:
+            if not isinstance(operator, str):
+                raise TypeError("The operator of an OperationNode must be a string")
+            node_class = type('OperationNode', (OperationNode,),
+                              {'__slots__': (), 'operator': operator, '__module__': __name__})
+            node_class = OperationNode._classes.setdefault(operator, node_class)
+        lhs = lhs if isinstance(lhs, ExpressionNode) else _node_operand(lhs)
+        rhs = rhs if isinstance(rhs, ExpressionNode) else _node_operand(rhs)
+        node = object.__new__(node_class)
+        _set_lhs(node, lhs)
+        _set_rhs(node, rhs)
+        _set_hash(node, hash((node_class, lhs, rhs)))
+        return _intern_node(node)
+
+    def __eq__(self, other):
+        # The common case, an equal node found in the intern table, has the very same children.
+        if self is other:
+            return True
+        if type(self) is not type(other) or self._hash != other._hash:
+            return False
+        return (self.lhs is other.lhs and self.rhs is other.rhs) or _nodes_equal(self, other)
+
+    __hash__ = ExpressionNode.__hash__
+
+    def __reduce__(self):
+        return (OperationNode, (self.lhs, self.operator, self.rhs))
+
+    def __repr__(self):
+        return f"OperationNode({self.lhs!r}, {self.operator!r}, {self.rhs!r})"
+
+    def __str__(self):
+        """
+        Renders the operation like BinaryOperation. The tree is walked without recursion, so long chains
+        such as running sums render too, and the text is joined once at the end.
+        """
+        parts = []
+        stack = [self]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, OperationNode):
+                operator = '=' if item.operator == '==' else item.operator
+                stack.extend((')', item.rhs, f' {operator} ', item.lhs, '('))
+            elif isinstance(item, str):
+                parts.append(item)
+            else:
+                parts.append(str(item))
+        return ''.join(parts)
+
+_set_lhs = OperationNode.lhs.__set__  # Slot setters that bypass the immutable __setattr__
+_set_rhs = OperationNode.rhs.__set__
+_set_hash = ExpressionNode._hash.__set__
+
+class ColorNode(ExpressionNode):
+    """
+    The immutable counterpart of RGBColor.
+    """
+    __slots__ = ('red', 'green', 'blue')
+    _fields = __slots__
+
+    def __new__(cls, red, green, blue):
+        return cls._intern(_node_operand(red), _node_operand(green), _node_operand(blue))
+
+    def __str__(self):
+        return f"{{red: {self.red}; green: {self.green}; blue: {self.blue}}}"
+
+class CaseNode(ExpressionNode):
+    """
+    The immutable counterpart of Case.
+    """
+    __slots__ = ('expression', 'color')
+    _fields = __slots__
+
+    def __new__(cls, expression, color):
+        """
+        Returns the interned case.
+
+        Args:
+            expression: The condition of the case, as a node or an expression object.
+            color (ColorNode or RGBColor): The color returned where the condition holds.
+        """
+        return cls._intern(_node_operand(expression), _node_operand(color))
+
+    def __str__(self):
+        return f"case {self.expression}\n\t\treturn {self.color}"
+
+class SwitchNode(ExpressionNode):
+    """
+    The immutable counterpart of Switch. Threshold switches are stored as their equivalent cases.
+    """
+    __slots__ = ('cases', 'default')
+    _fields = __slots__
+
+    def __new__(cls, cases, default):
+        """
+        Returns the interned switch.
+
+        Args:
+            cases (iterable of CaseNode or Case): The cases, in the order they are tried.
+            default (ColorNode or RGBColor): The color returned where no case holds.
+        """
+        return cls._intern(tuple(_node_operand(case) for case in cases), _node_operand(default))
+
+    def __str__(self):
+        parts = ["switch\n"]
+        parts.extend(f"\t{case}\n" for case in self.cases)
+        parts.append(f"\tdefault return {self.default}")
+        return "".join(parts)
+
+def to_node(expression):
+    """
+    Converts an expression built from Coverage, Axis, BinaryOperation, RGBColor, Case and Switch objects
+    into interned nodes. The result renders to the same WCPS text. Coverages are captured with their
+    current subset, so later calls to set_subset do not change the node. Deep BinaryOperation chains are
+    converted without recursion, and objects that occur several times in the tree are converted once.
+
+    Args:
+        expression: The expression object, node, number or string to convert.
+
+    Returns:
+        ExpressionNode or number or str: The interned node, or the constant itself.
+
+    Raises:
+        TypeError: If the expression contains values that cannot be used in an expression node.
+    """
+    if isinstance(expression, Coverage):
+        return CoverageNode(expression.name, expression.variable, expression.axes)
+    if isinstance(expression, Axis):
+        return AxisNode(expression.name, expression.lower_bound, expression.upper_bound)
+    if isinstance(expression, RGBColor):
+        return ColorNode(expression.red, expression.green, expression.blue)
+    if isinstance(expression, Case):
+        return CaseNode(expression.expression, expression.RGBColor)
+    if isinstance(expression, Switch):
+        cases = []
+        if expression.breakpoints:
+            condition = to_node(expression.expression)
+            cases = [CaseNode(OperationNode(condition, '<', breakpoint), ColorNode(*color))
+                     for breakpoint, color in zip(expression.breakpoints, expression.threshold_colors)]
+        return SwitchNode(cases + [to_node(case) for case in expression.cases], expression.RGBColor)
+    if not isinstance(expression, BinaryOperation):
+        return _node_operand(expression)
+    converted = {}  # id of a BinaryOperation -> its node; the tree keeps the objects alive meanwhile
+    stack = [expression]
+    while stack:
+        operation = stack[-1]
+        if id(operation) in converted:
+            stack.pop()
+            continue
+        pending = [child for child in (operation.lhs, operation.rhs)
+                   if isinstance(child, BinaryOperation) and id(child) not in converted]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        lhs, rhs = (converted[id(child)] if isinstance(child, BinaryOperation) else _node_operand(child)
+                    for child in (operation.lhs, operation.rhs))
+        converted[id(operation)] = OperationNode(lhs, operation.operator, rhs)
+    return converted[id(expression)]
+
+class Query:
+    """
+    Manages operations on a datacube such as querying data through the DatabaseConnection.
+    """
+
+    VALID_RETURN_TYPES = {
+        'CSV': "text/csv",
+        'PNG': "image/png",
+        'JPEG': "image/jpeg"
+    }
+
+    def __init__(self, dbc, cache=None):
+        """
+        Initialize the Query instance with a DatabaseConnection.
+
+        Args:
+            dbc (DatabaseConnection): The database connection to use for sending queries.
+            cache (ResultCache, optional): A cache of query results keyed by query text. If None,
+                                           every execution goes to the server.
+
+        Attributes:
+            dbc (DatabaseConnection): Stores the database connection object that will be used for querying.
+            coverages (list): List to store coverage objects added for the query.
+            return_type (str, optional): The type of data to return from queries (CSV, PNG, JPEG), which
+                                         needs to match one of the predefined valid return types.
+            return_value (str, optional): Specific values or expressions to be returned by the query, used in
+                                          conjunction with return_type to format the output.
+            operation (str, optional): The operation to be performed on the data (e.g., max, min, average).
+                                       This defines the processing step to be applied to the dataset.
+            count_condition (str, optional): A condition to be applied specifically for count operations,
+                                             defining filters or criteria that count must satisfy.
+            Switch (Switch, optional): The switch statement to be used for colorcoding operation.
+            histogram (tuple, optional): The (bins, lower, upper) of the histogram operation, set through set_histogram.
+            cache (ResultCache, optional): The result cache consulted before sending a query.
+            preview (tuple, optional): The (width, height, x_axis, y_axis) the result is scaled to on the
+                                       server before encoding, set through set_preview.
+            observers (list): QueryObserver objects notified with a QueryEvent after every request.
+            metadata (MetadataCache, optional): Describes the coverages, set through set_metadata.
+            max_bytes (int, optional): The largest estimated result sent in one request.
+            tile_axis (str, optional): The axis along which larger CSV results are split by execute_array.
+        """
+        self.dbc = dbc
+        self.cache = cache
+        self.coverages = []
+        self.return_type = None
+        self.return_value = None
+        self.operation = None
+        self.count_condition = None
+        self.Switch = None
+        self.histogram = None
+        self.preview = None
+        self.observers = []
+        self.metadata = None
+        self.max_bytes = None
+        self.tile_axis = None
+
+    def add_coverage(self, coverage):
+        """
+        Add a coverage to the datacube queries.
+
+        Args:
+            coverage (Coverage): The coverage object.
+
+        Raises:
+            TypeError: If coverage is not an instance of Coverage.
+        """
+        if not isinstance(coverage, Coverage):
+            raise TypeError("coverage must be an instance of Coverage")
+        self.coverages.append(coverage)
+
+    def set_return(self, return_type, return_value=None):
+        """
+        Set the return type and value for the results of the queries.
+
+        Args:
+            return_type (str): The type of return (e.g., 'CSV', 'PNG', 'JPEG').
+            return_value (str): The value to be returned, used in specific queries.
+
+        Raises:
+            ValueError: If the return_type is not valid.
+        """
+        if return_type in self.VALID_RETURN_TYPES:
+            self.return_type = return_type
+            self.return_value = return_value
+        else:
+            raise ValueError(f"Invalid return type. Valid types are: {list(self.VALID_RETURN_TYPES.keys())}")
+
+    def set_operation(self, operation):
+        """
+        Set the operation to perform on the data.
+
+        Args:
+            operation (str): The operation to be performed.
+
+        Raises:
+            ValueError: If the operation is not valid.
+        """
+        if operation in ['max', 'min', 'avg', 'count', 'sum', 'histogram', 'encode', 'colorcoding']:
+            self.operation = operation
+        else:
+            raise ValueError("Invalid operation.")
+
+    def set_count_condition(self, condition):
+        """
+        Set the condition for count operations.
+
+        Args:
+            condition (str): The condition to be applied in a count operation.
+        """
+        self.count_condition = condition
+
+    def set_switch(self, switch):
+        """
+        Set the switch statement for colorcoding operation.
+
+        Args:
+            Switch (Switch): The Switch object representing the switch statement.
+        """
+        self.Switch = switch
+
+    def set_histogram(self, bins=100, lower=None, upper=None):
+        """
+        Set the bins of the histogram operation, which execute_percentiles also uses. The bins are of equal
+        width and half-open: each counts the values v with edge <= v < next edge.
+
+        Args:
+            bins (int): The number of bins.
+            lower (float, optional): The lower edge of the first bin. If lower and upper are None, the range is
+                                     taken from the minimum and maximum of the data by execute_histogram.
+            upper (float, optional): The upper edge of the last bin.
+
+        Raises:
+            ValueError: If bins is not positive, only one bound is given, or lower is not below upper.
+        """
+        if bins < 1:
+            raise ValueError("A histogram needs at least one bin.")
+        if (lower is None) != (upper is None):
+            raise ValueError("Give both lower and upper, or neither.")
+        if lower is not None:
+            # Plain floats, since the bounds are rendered with repr and NumPy 2 scalars repr as np.float64(...)
+            lower, upper = float(lower), float(upper)
+            if not lower < upper:
+                raise ValueError("The lower bound of a histogram must be below its upper bound.")
+        self.histogram = (bins, lower, upper)
+
+    def _histogram_expression(self, expression):
+        if self.histogram is None or self.histogram[1] is None:
+            raise ValueError("A histogram query needs bounds: set them with set_histogram or use execute_histogram.")
+        bins, lower, upper = self.histogram
+        width = (upper - lower) / bins
+        return (f'encode(coverage histogram over $i x(0:{bins - 1}) values '
+                f'count(({expression} >= {lower!r} + {width!r} * $i) and ({expression} < {lower!r} + {width!r} * ($i + 1))), '
+                f'"text/csv")')
+
+    def add_observer(self, observer):
+        """
+        Register an observer that is notified with the timings and outcome of every request.
+
+        Args:
+            observer (QueryObserver): The observer to notify.
+
+        Raises:
+            TypeError: If observer is not an instance of QueryObserver.
+        """
+        if not isinstance(observer, QueryObserver):
+            raise TypeError("observer must be an instance of QueryObserver")
+        self.observers.append(observer)
+
+    def remove_observer(self, observer):
+        """
+        Stop notifying an observer.
+
+        Args:
+            observer (QueryObserver): The observer to remove.
+        """
+        self.observers.remove(observer)
+
+    def notify(self, event):
+        """
+        Finish an event and pass it to every observer. Errors raised by observers are printed, not propagated.
+
+        Args:
+            event (QueryEvent): The event of a completed request.
+        """
+        event.timings['total'] = time.perf_counter() - event.started
+        for observer in self.observers:
+            try:
+                observer.on_query(event)
+            except Exception as err:
+                print(f"An observer error occurred: {err}")
+
+    def set_preview(self, width, height=None, x_axis='Long', y_axis='Lat'):
+        """
+        Scale encoded results on the server to a target pixel size instead of transferring full resolution.
+
+        Args:
+            width (int): The target number of pixels along x_axis.
+            height (int, optional): The target number of pixels along y_axis. If None, it is derived from
+                                    the aspect ratio of the numeric subset bounds of both axes.
+            x_axis (str): The name of the horizontal axis.
+            y_axis (str): The name of the vertical axis.
+
+        Raises:
+            ValueError: If a size is not positive.
+        """
+        if width < 1 or (height is not None and height < 1):
+            raise ValueError("Preview width and height must be positive.")
+        self.preview = (width, height, x_axis, y_axis)
+
+    def clear_preview(self):
+        """
+        Go back to transferring encoded results at full resolution.
+        """
+        self.preview = None
+
+    def preview_size(self):
+        """
+        Determine the pixel size of the preview, deriving the height from the subset if it was not given.
+
+        Returns:
+            tuple: The (width, height) of the preview.
+
+        Raises:
+            ValueError: If no preview is set, or the height cannot be derived from the subsets.
+        """
+        if self.preview is None:
+            raise ValueError("No preview is set.")
+        width, height, x_axis, y_axis = self.preview
+        if height is not None:
+            return width, height
+        spans = {}
+        for coverage in self.coverages:
+            for axis in coverage.axes:
+                if axis.name in (x_axis, y_axis) and isinstance(axis.lower_bound, (int, float)) \
+                        and isinstance(axis.upper_bound, (int, float)):
+                    spans[axis.name] = abs(axis.upper_bound - axis.lower_bound)
+        if not spans.get(x_axis) or y_axis not in spans:
+            raise ValueError(f"Cannot derive the preview height: give it explicitly or subset {x_axis} and {y_axis} with numeric ranges.")
+        return width, max(1, round(width * spans[y_axis] / spans[x_axis]))
+
+    def scale_expression(self, expression):
+        """
+        Wrap an expression in a server-side scale() to the preview size, if a preview is set.
+
+        Args:
+            expression: The expression or switch statement to be scaled.
+
+        Returns:
+            The expression unchanged if no preview is set, otherwise the scale() expression as a string.
+        """
+        if self.preview is None:
+            return expression
+        width, height = self.preview_size()
+        x_axis, y_axis = self.preview[2], self.preview[3]
+        return f'scale({expression}, {{ {x_axis}:"CRS:1"(0:{width - 1}), {y_axis}:"CRS:1"(0:{height - 1}) }})'
+
+    def set_metadata(self, metadata, max_bytes=None, tile_axis=None):
+        """
+        Validate subsets against the described coverages before generating queries, and limit the size of results.
+
+        Args:
+            metadata (MetadataCache): Provides the description of each coverage.
+            max_bytes (int, optional): If set, queries whose result is estimated to be larger are not sent.
+            tile_axis (str, optional): If set, execute_array splits such queries along this axis with
+                                       execute_tiled instead of refusing them.
+
+        Raises:
+            ValueError: If max_bytes is not positive.
+        """
+        if max_bytes is not None and max_bytes < 1:
+            raise ValueError("max_bytes must be positive.")
+        self.metadata = metadata
+        self.max_bytes = max_bytes
+        self.tile_axis = tile_axis
+
+    def _metadata_for(self, coverage):
+        if coverage.metadata is not None:
+            return coverage.metadata
+        if self.metadata is not None:
+            return self.metadata.get(coverage.name)
+        return None
+
+    def _describe(self):
+        """
+        Returns the description of each coverage, or None for coverages without one, looking each name up once.
+        An execute resolves the descriptions once and uses them both to estimate and to validate.
+        """
+        found = {}
+        for coverage in self.coverages:
+            if coverage.metadata is None and coverage.name not in found:
+                found[coverage.name] = self._metadata_for(coverage)
+        return [coverage.metadata if coverage.metadata is not None else found[coverage.name]
+                for coverage in self.coverages]
+
+    def validate_subsets(self):
+        """
+        Check the subset of every coverage against its description, without contacting the server
+        once the descriptions are cached. Coverages without a description are not checked.
+
+        Raises:
+            ValueError: If an axis is unknown or a bound lies outside the extent of its axis.
+        """
+        self._validate_subsets(self._describe())
+
+    def _validate_subsets(self, described):
+        for coverage, metadata in zip(self.coverages, described):
+            if metadata is not None:
+                metadata.validate(coverage.axes)
+
+    def estimate_result(self):
+        """
+        Estimate the size of the result from the descriptions of the coverages: the largest subset,
+        the preview size if one is set, or a single value for aggregations.
+
+        Returns:
+            tuple: The estimated (cells, bytes) of the result, uncompressed and in binary form, or None if
+                   a coverage has no description or the query returns a custom value.
+        """
+        return self._estimate_result()
+
+    def _estimate_result(self, described=None):
+        # The descriptions are only resolved here if the estimate needs them and the caller has none.
+        if self.operation == 'histogram':
+            bins = self.histogram[0] if self.histogram else 100
+            return bins, bins * 8
+        if Query.is_aggregation_operation(self.operation):
+            return 1, 8
+        if self.operation is None and self.return_value is not None:
+            return None
+        cells, cell_bytes = 0, 0
+        for coverage, metadata in zip(self.coverages, described if described is not None else self._describe()):
+            if metadata is None:
+                return None
+            coverage_cells = metadata.estimate_cells(coverage.axes)
+            if coverage_cells > cells:
+                cells, cell_bytes = coverage_cells, metadata.cell_bytes
+        if self.preview is not None:
+            width, height = self.preview_size()
+            cells = width * height
+        if self.operation == 'colorcoding':
+            cell_bytes = 3  # One RGB pixel
+        return cells, cells * cell_bytes
+
+    def _exceeds_limit(self, described=None):
+        if self.max_bytes is None:
+            return None
+        estimate = self._estimate_result(described)
+        if estimate is None or estimate[1] <= self.max_bytes:
+            return None
+        return estimate[1]
+
+    def is_aggregation_operation(operation):
+        """
+        Determines if the provided operation is an aggregation type.
+
+        Args:
+            operation (str): The operation to check.
+
+        Returns:
+            bool: True if the operation is an aggregation, False otherwise.
+        """
+        return operation in ['max', 'min', 'avg', 'count', 'sum']
+
+    def _for_clause(self):
+        base_query = ""
+        for coverage in self.coverages:
+            if base_query:
+                base_query += ",\n"
+            base_query += f"${coverage.variable} in ({coverage.name})"  # Include each coverage
+        return "for " + base_query + "\n"
+
+    def generate_query(self, expression):
+        """
+        Generate the database query based on the set parameters and the provided expression.
+
+        Args:
+            expression (str): The expression to be included in the query and used for the operations. Could also be a single coverage.
+
+        Returns:
+            str: The generated query string.
+
+        Raises:
+            ValueError: If the parameters are insufficient to generate a valid query.
+        """
+        return self._generate_query(expression)
+
+    def _generate_query(self, expression, described=None):
+        # described holds the descriptions already resolved by an execute, so they are not looked up again.
+        if not self.coverages:
+            raise ValueError("At least one coverage must be added before generating the query.")
+        if self.metadata is not None:
+            self._validate_subsets(described if described is not None else self._describe())
+
+        base_query = self._for_clause()
+
+        if self.operation in ['max', 'min', 'avg', 'count', 'sum', 'histogram', 'encode', 'colorcoding']:
+            if self.operation == 'sum': # Sum operation, called add in WCPS
+                return f"{base_query}return add({expression})"
+            elif self.operation == 'histogram': # One count per bin, all computed in a single request
+                return f"{base_query}return {self._histogram_expression(expression)}"
+            elif self.operation == 'count' and self.count_condition: # Count operation
+                return f"{base_query}return count({expression} {self.count_condition})"
+            elif self.operation == 'encode' and self.return_type: # Encode operation
+                return f"{base_query}return encode({self.scale_expression(expression)}, \"{self.VALID_RETURN_TYPES[self.return_type]}\")"
+            elif self.operation == 'colorcoding' and (self.return_type == 'PNG' or self.return_type == 'JPEG') and self.Switch: # Switch operation
+                return f"{base_query} return encode(\n    {self.scale_expression(self.Switch)}\n\t, \"{self.VALID_RETURN_TYPES[self.return_type]}\")"
+            elif Query.is_aggregation_operation(self.operation): # Check if it's an aggregation operation
+                return f"{base_query}return {self.operation}({expression})"
+
+        # Most basic query
+        elif self.return_value is not None:
+            return f"{base_query}return {self.return_value}"
+
+        # Selecting a single value
+        elif not self.operation:
+            return f"{base_query}return ({expression})"
+
+        else:
+            raise ValueError("Insufficient parameters to generate a valid query: check operation, subset parameters, and return types.")
+
+    def execute_query(self, expression):
+        """
+        Execute the generated query using the DatabaseConnection.
+
+        Args:
+            expression (str): The expression to be executed and included in the query and used for the operations. Could also be a single coverage.
+
+        Returns:
+            bytes or str: The raw content of the response if successful, or an error message if the request fails.
+
+        Raises:
+            ValueError: If the result is estimated to be larger than the max_bytes set through set_metadata.
+        """
+        described = self._describe() if self.metadata is not None else None
+        estimate = self._exceeds_limit(described)
+        if estimate is not None:
+            raise ValueError(f"The result is estimated at {estimate} bytes, more than the limit of {self.max_bytes}; "
+                             f"narrow the subset or use execute_tiled.")
+        if not self.observers:
+            query = self._generate_query(expression, described)  # Generate the query based on current settings
+            return self.send_query(query)
+        event = QueryEvent()
+        query = self._generate_query(expression, described)
+        event.timings['generate'] = time.perf_counter() - event.started
+        content = self.send_query(query, event)
+        self.notify(event)
+        return content
+
+    def execute_array(self, expression):
+        """
+        Execute the query and decode the result into a NumPy array (CSV values or image pixels).
+
+        Args:
+            expression: The expression to be executed, as for execute_query.
+
+        Returns:
+            numpy.ndarray: The decoded result.
+
+        Raises:
+            RuntimeError: If the query failed.
+            ValueError: If the result is estimated to be larger than max_bytes and no tile axis is set.
+        """
+        described = self._describe() if self.metadata is not None else None
+        estimate = self._exceeds_limit(described)
+        if estimate is not None:
+            if self.tile_axis is None:
+                raise ValueError(f"The result is estimated at {estimate} bytes, more than the limit of {self.max_bytes}; "
+                                 f"narrow the subset or set a tile axis.")
+            return self.execute_tiled(expression, self.tile_axis)
+        event = QueryEvent() if self.observers else None
+        query = self._generate_query(expression, described)
+        if event is not None:
+            event.timings['generate'] = time.perf_counter() - event.started
+        content = self.send_query(query, event)
+        if isinstance(content, str):
+            if event is not None:
+                self.notify(event)
+            raise RuntimeError(content)
+        start = time.perf_counter()
+        result = decode_result(content, self.return_type)
+        if event is not None:
+            event.timings['decode'] = time.perf_counter() - start
+            self.notify(event)
+        return result
+
+    def defer(self, expression, decode=False):
+        """
+        Generate the query now but send it only when the result is computed with compute.
+
+        Args:
+            expression: The expression to be executed, as for execute_query. The query is generated from the
+                        current settings and subsets, so they may be changed afterwards.
+            decode (bool): If True, the result is decoded into a NumPy array as by execute_array; otherwise it
+                           is the raw content as returned by execute_query.
+
+        Returns:
+            Deferred: The lazy result.
+        """
+        return Deferred(query=self, text=self.generate_query(expression), decode=decode)
+
+    def execute_tiled(self, expression, axis_name, max_bytes=None):
+        """
+        Execute a CSV query as several smaller ones along one axis and join the decoded tiles. The tiles
+        are requested concurrently and each is estimated to be no larger than max_bytes.
+
+        Args:
+            expression: The expression to be executed, as for execute_query.
+            axis_name (str): The axis to split. It must not be sliced to a single value.
+            max_bytes (int, optional): The largest estimated tile. Defaults to the limit set through set_metadata.
+
+        Returns:
+            numpy.ndarray: The decoded result, as execute_array would return it.
+
+        Raises:
+            ValueError: If the query does not encode CSV, no limit is given, or the coverages are not described.
+            RuntimeError: If a tile failed.
+        """
+        import numpy as np
+        max_bytes = max_bytes if max_bytes is not None else self.max_bytes
+        if self.operation != 'encode' or self.return_type != 'CSV':
+            raise ValueError("Only queries that encode CSV can be executed in tiles.")
+        if not max_bytes or max_bytes < 1:
+            raise ValueError("A positive max_bytes is needed to execute a query in tiles.")
+        estimate = self.estimate_result()
+        if estimate is None:
+            raise ValueError("Every coverage needs a description to execute a query in tiles.")
+        tiled = [(coverage, self._metadata_for(coverage)) for coverage in self.coverages]
+        tiled = [(coverage, metadata) for coverage, metadata in tiled
+                 if any(extent.name == axis_name for extent in metadata.axes)]
+        if not tiled:
+            raise ValueError(f"No coverage has an axis '{axis_name}'.")
+        reference, metadata = tiled[0]
+        extent = metadata.axis(axis_name)
+        subset = next((axis for axis in reference.axes if axis.name == axis_name), None)
+        if subset is not None and subset.upper_bound is None:
+            raise ValueError(f"Cannot split along '{axis_name}', which is sliced to a single value.")
+        first, last = extent.index_range(subset.lower_bound, subset.upper_bound) if subset else (0, extent.size - 1)
+        count = min(last - first + 1, -(-estimate[1] // max_bytes))
+        position = [name for name, _ in metadata.shape(reference.axes)].index(axis_name)
+        originals = [(coverage, list(coverage.axes) if coverage.subset else None) for coverage, _ in tiled]
+        queries = []
+        try:
+            for tile in np.array_split(np.arange(first, last + 1), count):
+                lower, upper = extent.bounds(int(tile[0]), int(tile[-1]))
+                for coverage, axes in originals:
+                    axes = [axis for axis in axes or [] if axis.name != axis_name]
+                    coverage.set_subset(*axes, Axis(axis_name, lower, upper))
+                queries.append(self.generate_query(expression))
+        finally:
+            for coverage, axes in originals:
+                if axes is None:
+                    coverage.subset, coverage.axes = None, []
+                else:
+                    coverage.set_subset(*axes)
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(8, len(queries))) as executor:
+            contents = list(executor.map(self.send_query, queries))
+        parts = []
+        for content in contents:
+            if isinstance(content, str):
+                raise RuntimeError(content)
+            part = decode_result(content, self.return_type)
+            if part.ndim < len(metadata.shape(reference.axes)):
+                part = np.expand_dims(part, position)  # A tile of a single cell along the axis
+            parts.append(part)
+        if extent.descending:
+            parts.reverse()  # Stored from the upper bound down, but requested from the lower bound up
+        return np.concatenate(parts, axis=position)
+
+    def execute_histogram(self, expression):
+        """
+        Compute a histogram on the server, so only one count per bin is transferred. If set_histogram
+        was called without bounds, the minimum and maximum are fetched first in one extra request.
+
+        Args:
+            expression: The expression whose values are counted, as for execute_query.
+
+        Returns:
+            tuple: The counts (numpy.ndarray of int64) and the bins + 1 edges (numpy.ndarray of float64).
+
+        Raises:
+            RuntimeError: If a query failed.
+        """
+        import numpy as np
+        bins, lower, upper = self.histogram or (100, None, None)
+        if lower is None:
+            # Both extremes in one request: max(E) for $i = 0 and max(-E), the negated minimum, for $i = 1.
+            content = self.send_query(f'{self._for_clause()}return encode(coverage extremes over $i x(0:1) values '
+                                      f'max({expression} * (1 - 2 * $i)), "text/csv")')
+            if isinstance(content, str):
+                raise RuntimeError(content)
+            maximum, negated_minimum = decode_csv(content)
+            lower, maximum = float(-negated_minimum), float(maximum)
+            upper = maximum + ((maximum - lower) * 1e-9 if maximum > lower else 1.0)
+            while lower + (upper - lower) / bins * bins <= maximum:  # The maximum must fall into the last bin
+                upper = float(np.nextafter(upper, np.inf))
+        original = (self.operation, self.histogram)
+        try:
+            self.operation, self.histogram = 'histogram', (bins, lower, upper)
+            query = self.generate_query(expression)
+        finally:
+            self.operation, self.histogram = original
+        content = self.send_query(query)
+        if isinstance(content, str):
+            raise RuntimeError(content)
+        counts = decode_csv(content).astype(np.int64)
+        return counts, lower + (upper - lower) / bins * np.arange(bins + 1)
+
+    def execute_percentiles(self, expression, percentiles):
+        """
+        Approximate percentiles from a server-side histogram, interpolating linearly within bins. The error
+        is at most the width of one bin, so more bins give more accurate percentiles.
+
+        Args:
+            expression: The expression whose values are summarized, as for execute_query.
+            percentiles (list): Percentiles between 0 and 100.
+
+        Returns:
+            numpy.ndarray: One value per percentile, or NaN for all of them if no value was counted.
+
+        Raises:
+            ValueError: If a percentile is outside 0 to 100.
+            RuntimeError: If a query failed.
+        """
+        import numpy as np
+        percentiles = np.asarray(percentiles, dtype=float)
+        if np.any((percentiles < 0) | (percentiles > 100)):
+            raise ValueError("Percentiles must be between 0 and 100.")
+        counts, edges = self.execute_histogram(expression)
+        total = counts.sum()
+        if total == 0:
+            return np.full(percentiles.shape, np.nan)
+        cumulative = np.concatenate([[0], np.cumsum(counts)])
+        return np.interp(percentiles / 100 * total, cumulative, edges)
+
+    def send_query(self, query, event=None):
+        """
+        Send an already generated query string, consulting the result cache first if one is set.
+
+        Args:
+            query (str): The query string, as returned by generate_query.
+            event (QueryEvent, optional): Collects the metrics of this request; the caller notifies the
+                                          observers. If None and observers are registered, an event is
+                                          created and the observers are notified here.
+
+        Returns:
+            bytes or str: The raw content of the response if successful, or an error message if the request fails.
+        """
+        owned = event is None and bool(self.observers)
+        if owned:
+            event = QueryEvent()
+        if event is not None:
+            event.query = query
+        content = self._send(query, event)
+        if owned:
+            self.notify(event)
+        return content
+
+    def _send(self, query, event):
+        if self.cache is not None:
+            content = self.cache.get(query)
+            if event is not None:
+                event.cache = 'miss' if content is None else 'hit'
+            if content is not None:
+                if event is not None:
+                    event.response_bytes = len(content)
+                return content  # Served from the cache, no round trip needed
+        if event is None:
+            response = self.dbc.send_request(query)  # Send the query and receive the response
+        else:
+            start = time.perf_counter()
+            if _accepts_event(self.dbc.send_request):
+                response = self.dbc.send_request(query, event=event)
+            else:
+                response = self.dbc.send_request(query)  # A connection that only takes the query
+            if response is not None and 'network' not in event.timings:
+                event.record_response(response, time.perf_counter() - start, 0)  # The connection did not report itself
+        if response:
+            if self.cache is not None:
+                self.cache.put(query, response.content)
             return response.content  # Return the raw content of the response
         else:
-            return "Query execution failed or no response."  # Return an error message if the request failed
\ No newline at end of file
+            return "Query execution failed or no response."  # Return an error message if the request failed
+
+    def execute_progressive(self, expression, levels=(8, 2, 1)):
+        """
+        Execute the query as a series of previews from coarse to fine. All levels are requested at once,
+        so the small coarse images arrive quickly while the finer ones are still being computed.
+
+        Args:
+            expression: The expression to be executed, as for execute_query.
+            levels (tuple): Downsampling factors relative to the preview size, from coarsest to finest.
+
+        Yields:
+            tuple: The (width, height, content) of each level, coarsest first.
+
+        Raises:
+            ValueError: If no preview is set or the levels are not positive.
+        """
+        if any(level < 1 for level in levels):
+            raise ValueError("Progressive levels must be positive downsampling factors.")
+        width, height = self.preview_size()
+        original = self.preview
+        queries = []
+        try:
+            for level in levels:
+                size = (max(1, width // level), max(1, height // level))
+                self.preview = (size[0], size[1], original[2], original[3])
+                queries.append((size, self.generate_query(expression)))
+        finally:
+            self.preview = original
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+            futures = [(size, executor.submit(self.send_query, query)) for size, query in queries]
+            for (level_width, level_height), future in futures:
+                yield level_width, level_height, future.result()
+
+class Deferred:
+    """
+    A lazy result: either the result of a query that has been generated but not sent, or a function of
+    other results. Nothing is executed until compute is called, and then only what the requested
+    results depend on.
+    """
+
+    def __init__(self, query=None, text=None, decode=False, function=None, args=(), kwargs=None):
+        """
+        Initializes a Deferred. Use Query.defer and delayed instead of calling this directly.
+
+        Args:
+            query (Query, optional): The query that sends text.
+            text (str, optional): The generated query string.
+            decode (bool): Whether the result is decoded into a NumPy array or kept as raw content.
+            function (callable, optional): For derived results, the function applied to args and kwargs.
+            args (tuple): Positional arguments of function; Deferred arguments are replaced by their results.
+            kwargs (dict, optional): Keyword arguments of function, treated like args.
+        """
+        self.query = query
+        self.text = text
+        self.decode = decode
+        self.return_type = query.return_type if query is not None else None
+        self.function = function
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs or {})
+
+    @property
+    def dependencies(self):
+        """
+        The Deferred objects this result is computed from, including those inside list and tuple arguments.
+        """
+        found = []
+        pending = list(self.args) + list(self.kwargs.values())
+        while pending:
+            arg = pending.pop(0)
+            if isinstance(arg, Deferred):
+                found.append(arg)
+            elif isinstance(arg, (list, tuple)):
+                pending[:0] = arg
+        return found
+
+    def compute(self, max_workers=8):
+        """
+        Computes this result. See compute.
+        """
+        return compute(self, max_workers=max_workers)[0]
+
+    def __repr__(self):
+        if self.query is not None:
+            return f"Deferred({self.text!r}, decode={self.decode})"
+        return f"Deferred({getattr(self.function, '__name__', self.function)}, {len(self.dependencies)} dependencies)"
+
+    # Arithmetic between lazy results builds derived results, e.g. an anomaly relative to a baseline.
+    def __add__(self, other):
+        return delayed(operator.add, self, other)
+
+    def __sub__(self, other):
+        return delayed(operator.sub, self, other)
+
+    def __mul__(self, other):
+        return delayed(operator.mul, self, other)
+
+    def __truediv__(self, other):
+        return delayed(operator.truediv, self, other)
+
+def delayed(function, *args, **kwargs):
+    """
+    Defers a function of lazy results, e.g. delayed(numpy.subtract, july, baseline).
+
+    Args:
+        function (callable): Called with the computed results in place of the Deferred arguments.
+        *args: Positional arguments: Deferred objects, plain values, or lists and tuples of either.
+        **kwargs: Keyword arguments, Deferred or plain values.
+
+    Returns:
+        Deferred: The lazy result of the call.
+
+    Raises:
+        TypeError: If function is not callable.
+    """
+    if not callable(function):
+        raise TypeError("function must be callable")
+    return Deferred(function=function, args=args, kwargs=kwargs)
+
+def compute(*handles, max_workers=8):
+    """
+    Computes lazy results. Only the queries the handles depend on are sent. Identical queries to the same
+    connection are sent once, and all of them are sent concurrently. Derived results are then evaluated in
+    dependency order.
+
+    Args:
+        *handles (Deferred): The results to compute.
+        max_workers (int): The number of queries sent at once.
+
+    Returns:
+        tuple: The result of each handle: raw content (or the error message of a failed query, as from
+               execute_query), a NumPy array for decoded queries, or the return value of a function.
+
+    Raises:
+        TypeError: If a handle is not a Deferred.
+        RuntimeError: If a query whose result is decoded failed.
+    """
+    for handle in handles:
+        if not isinstance(handle, Deferred):
+            raise TypeError("compute expects Deferred objects")
+    # Order the graph so that every node comes after its dependencies, visiting each node once.
+    order, visited = [], set()
+    for handle in handles:
+        stack = [(handle, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if expanded:
+                order.append(node)
+            elif id(node) not in visited:
+                visited.add(id(node))
+                stack.append((node, True))
+                stack.extend((dependency, False) for dependency in reversed(node.dependencies))
+    requests = {}  # (connection, query text) -> (the query that sends it, the formats it is needed in)
+    for node in order:
+        if node.query is not None:
+            query, formats = requests.setdefault((id(node.query.dbc), node.text), (node.query, set()))
+            formats.add(_result_format(node))
+    results = {}
+    if requests:
+        from concurrent.futures import ThreadPoolExecutor
+
+        def fetch(query, text, formats):
+            content = query.send_query(text)
+            decoded = {}
+            for decode, return_type in formats:
+                if not decode:
+                    decoded[(decode, return_type)] = content
+                elif isinstance(content, str):
+                    raise RuntimeError(content)
+                else:
+                    decoded[(decode, return_type)] = decode_result(content, return_type)
+            return decoded
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(requests))) as executor:
+            futures = {key: executor.submit(fetch, query, key[1], formats) for key, (query, formats) in requests.items()}
+        for key, future in futures.items():
+            for result_format, value in future.result().items():
+                results[key + result_format] = value
+    values = {}
+    for node in order:
+        if node.query is not None:
+            values[id(node)] = results[(id(node.query.dbc), node.text) + _result_format(node)]
+        else:
+            args = [_substitute(arg, values) for arg in node.args]
+            kwargs = {name: _substitute(arg, values) for name, arg in node.kwargs.items()}
+            values[id(node)] = node.function(*args, **kwargs)
+    return tuple(values[id(handle)] for handle in handles)
+
+def _substitute(arg, values):
+    """
+    Replaces Deferred objects, also inside lists and tuples, by their computed values.
+    """
+    if isinstance(arg, Deferred):
+        return values[id(arg)]
+    if isinstance(arg, (list, tuple)):
+        return type(arg)(_substitute(item, values) for item in arg)
+    return arg
+
+def _result_format(node):
+    return (True, node.return_type) if node.decode else (False, None)
+
+class QueryEvent:
+    """
+    The metrics of one request made by a Query, passed to every registered QueryObserver.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty QueryEvent and starts its clock.
+
+        Attributes:
+            query (str): The query text that was sent.
+            query_length (int): The length of the query text.
+            timings (dict): Seconds spent per phase: 'generate', 'network' (waiting for the response headers),
+                            'download' (receiving the body), 'decode' and 'total'. Phases that did not happen are missing.
+            response_bytes (int): The size of the response body, or None if there was none.
+            status (int): The HTTP status code of the last attempt, or None if no response was received.
+            retries (int): How many times the request was repeated.
+            cache (str): 'hit' or 'miss' if the query has a result cache, otherwise None.
+            error (str): The error message if the request failed, otherwise None.
+        """
+        self.started = time.perf_counter()
+        self.query = None
+        self.timings = {}
+        self.response_bytes = None
+        self.status = None
+        self.retries = 0
+        self.cache = None
+        self.error = None
+
+    @property
+    def query_length(self):
+        return len(self.query) if self.query is not None else 0
+
+    def record_response(self, response, seconds, attempt):
+        """
+        Records an attempt that received a response, splitting its duration into network and download time
+        when the response reports how long the headers took (as requests.Response.elapsed does).
+
+        Args:
+            response: The response object of the attempt.
+            seconds (float): The duration of the whole attempt.
+            attempt (int): The number of the attempt, starting at 0.
+        """
+        elapsed = getattr(response, 'elapsed', None)
+        if hasattr(elapsed, 'total_seconds'):
+            elapsed = elapsed.total_seconds()
+        if not isinstance(elapsed, (int, float)) or not 0 <= elapsed <= seconds:
+            elapsed = seconds
+        self.timings['network'] = self.timings.get('network', 0.0) + elapsed
+        self.timings['download'] = self.timings.get('download', 0.0) + seconds - elapsed
+        status = getattr(response, 'status_code', None)
+        self.status = status if isinstance(status, int) else None
+        content = getattr(response, 'content', None)
+        self.response_bytes = len(content) if isinstance(content, (bytes, bytearray)) else None
+        self.retries = attempt
+
+class QueryObserver:
+    """
+    Base class for objects that want to be told about every request a Query makes, e.g. to export
+    metrics. Subclasses override on_query.
+    """
+
+    def on_query(self, event):
+        """
+        Called after every request.
+
+        Args:
+            event (QueryEvent): The metrics of the request.
+        """
+
+class MetricsAggregator(QueryObserver):
+    """
+    A QueryObserver that collects phase timings and sizes of recent requests and reports counters,
+    percentiles and histograms, e.g. for export to a metrics system.
+    """
+
+    METRICS = ('generate', 'network', 'download', 'decode', 'total', 'query_length', 'response_bytes')
+
+    def __init__(self, max_samples=10000):
+        """
+        Initializes an empty MetricsAggregator.
+
+        Args:
+            max_samples (int): The number of most recent samples kept per metric.
+        """
+        self.samples = {metric: deque(maxlen=max_samples) for metric in self.METRICS}
+        self.counters = {'requests': 0, 'errors': 0, 'retries': 0, 'cache_hits': 0, 'cache_misses': 0}
+        self.statuses = {}  # HTTP status code -> number of requests
+        self._lock = threading.Lock()
+
+    def on_query(self, event):
+        with self._lock:
+            self.counters['requests'] += 1
+            self.counters['retries'] += event.retries
+            if event.error is not None:
+                self.counters['errors'] += 1
+            if event.cache == 'hit':
+                self.counters['cache_hits'] += 1
+            elif event.cache == 'miss':
+                self.counters['cache_misses'] += 1
+            if event.status is not None:
+                self.statuses[event.status] = self.statuses.get(event.status, 0) + 1
+            for phase, seconds in event.timings.items():
+                if phase in self.samples:
+                    self.samples[phase].append(seconds)
+            self.samples['query_length'].append(event.query_length)
+            if event.response_bytes is not None:
+                self.samples['response_bytes'].append(event.response_bytes)
+
+    def percentile(self, metric, percent):
+        """
+        Computes a percentile of the recent samples of a metric, interpolating between samples.
+
+        Args:
+            metric (str): One of METRICS.
+            percent (float): The percentile, between 0 and 100.
+
+        Returns:
+            float: The percentile, or None if there are no samples.
+        """
+        with self._lock:
+            values = sorted(self.samples[metric])
+        if not values:
+            return None
+        position = (len(values) - 1) * percent / 100
+        lower = int(position)
+        upper = min(lower + 1, len(values) - 1)
+        return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+    def histogram(self, metric, bins=10):
+        """
+        Counts the recent samples of a metric in equally wide bins between their minimum and maximum.
+
+        Args:
+            metric (str): One of METRICS.
+            bins (int): The number of bins.
+
+        Returns:
+            tuple: The list of counts and the list of bins + 1 edges. Both are empty if there are no samples.
+        """
+        with self._lock:
+            values = list(self.samples[metric])
+        if not values:
+            return [], []
+        low, high = min(values), max(values)
+        width = (high - low) / bins or 1
+        counts = [0] * bins
+        for value in values:
+            counts[min(int((value - low) / width), bins - 1)] += 1
+        return counts, [low + width * index for index in range(bins + 1)]
+
+    def snapshot(self):
+        """
+        Summarizes everything collected so far.
+
+        Returns:
+            dict: The counters, the requests per status code and, per metric with samples,
+                  its count, mean, p50, p90, p99 and max.
+        """
+        summary = {'counters': dict(self.counters), 'statuses': dict(self.statuses), 'metrics': {}}
+        for metric in self.METRICS:
+            with self._lock:
+                values = list(self.samples[metric])
+            if values:
+                summary['metrics'][metric] = {
+                    'count': len(values),
+                    'mean': sum(values) / len(values),
+                    'p50': self.percentile(metric, 50),
+                    'p90': self.percentile(metric, 90),
+                    'p99': self.percentile(metric, 99),
+                    'max': max(values),
+                }
+        return summary
+
+    def reset(self):
+        """
+        Discards all samples and counters.
+        """
+        with self._lock:
+            for values in self.samples.values():
+                values.clear()
+            for counter in self.counters:
+                self.counters[counter] = 0
+            self.statuses.clear()
+
+class ResultCache:
+    """
+    A thread-safe, size-bounded cache of query results keyed by the generated query text.
+    The least recently used entry is evicted once the cache is full.
+    """
+
+    def __init__(self, max_entries=128):
+        """
+        Initializes an empty ResultCache.
+
+        Args:
+            max_entries (int): The maximum number of results kept in the cache.
+
+        Raises:
+            ValueError: If max_entries is smaller than 1.
+        """
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1")
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, query):
+        """
+        Looks up the result of a query.
+
+        Args:
+            query (str): The query string.
+
+        Returns:
+            bytes: The cached content, or None if the query is not cached.
+        """
+        with self._lock:
+            content = self._entries.get(query)
+            if content is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(query)  # Mark as most recently used
+            self.hits += 1
+            return content
+
+    def put(self, query, content):
+        """
+        Stores the result of a query, evicting the least recently used entry if needed.
+
+        Args:
+            query (str): The query string.
+            content (bytes): The raw content returned by the server.
+        """
+        with self._lock:
+            self._entries[query] = content
+            self._entries.move_to_end(query)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __contains__(self, query):
+        with self._lock:
+            return query in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def clear(self):
+        """
+        Removes every entry from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+def _axis_coordinate(value):
+    """
+    Converts a subset bound or an extent to a number: numbers are kept, and dates such as '"2014-07"'
+    become days since 1970-01-01. Returns None for anything else, which is then not validated.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not isinstance(value, str):
+        return None
+    text = value.strip().strip('"\'')
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    from datetime import datetime, timezone
+    text = text.replace('Z', '+00:00')
+    if len(text) == 4 and text.isdigit():
+        text += '-01-01'  # Year only
+    elif len(text) == 7 and text[4] == '-':
+        text += '-01'  # Year and month
+    try:
+        moment = datetime.fromisoformat(text)
+    except ValueError:
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp() / 86400
+
+def _axis_bound(coordinate, temporal):
+    """
+    Formats a coordinate computed by _axis_coordinate as a subset bound.
+    """
+    if temporal:
+        from datetime import datetime, timezone
+        moment = datetime.fromtimestamp(round(coordinate * 86400), tz=timezone.utc)
+        return f'"{moment.strftime("%Y-%m-%dT%H:%M:%S")}.000Z"'
+    value = float(f'{coordinate:.12g}')
+    return int(value) if value.is_integer() else value
+
+class AxisExtent:
+    """
+    The extent of one axis of a coverage: its bounds, number of cells and direction, as described by the server.
+    """
+
+    def __init__(self, name, lower, upper, size, descending=False):
+        """
+        Initializes an AxisExtent.
+
+        Args:
+            name (str): The axis label, e.g. 'Lat' or 'ansi'.
+            lower (float, int or str): The lower bound of the axis, a number or a date string.
+            upper (float, int or str): The upper bound of the axis.
+            size (int): The number of cells along the axis.
+            descending (bool): True if the cells are stored from the upper bound to the lower one, as the
+                               latitudes of most images are.
+
+        Raises:
+            ValueError: If size is smaller than 1.
+        """
+        if size < 1:
+            raise ValueError(f"Axis '{name}' must have at least one cell")
+        self.name = name
+        self.lower = lower
+        self.upper = upper
+        self.size = size
+        self.descending = descending
+        self._lower = _axis_coordinate(lower)
+        self._upper = _axis_coordinate(upper)
+        self.temporal = isinstance(lower, str) and self._lower is not None  # Numeric extents are given as numbers
+
+    @property
+    def resolution(self):
+        """
+        The average width of a cell in axis units (days for dates), or None if the bounds are not numeric.
+        """
+        if self._lower is None or self._upper is None:
+            return None
+        return (self._upper - self._lower) / self.size
+
+    def contains(self, value):
+        """
+        Checks whether a subset bound lies within the extent. Bounds that cannot be compared are accepted.
+        """
+        coordinate = _axis_coordinate(value)
+        if coordinate is None or self._lower is None or self._upper is None:
+            return True
+        tolerance = 1e-9 * max(1.0, abs(self._upper - self._lower))
+        return self._lower - tolerance <= coordinate <= self._upper + tolerance
+
+    def index_range(self, lower=None, upper=None):
+        """
+        Determines the cells covered by a subset, counted from the lower bound of the axis.
+
+        Args:
+            lower: The lower bound of the subset, or None for the start of the axis.
+            upper: The upper bound of the subset, or None for the end of the axis.
+
+        Returns:
+            tuple: The first and last covered cell, both inclusive.
+        """
+        resolution = self.resolution
+        if not resolution:
+            return 0, self.size - 1
+        positions = []
+        for value, default in ((lower, 0), (upper, self.size - 1)):
+            coordinate = _axis_coordinate(value) if value is not None else None
+            if coordinate is None:
+                positions.append(default)
+            else:
+                positions.append(min(self.size - 1, max(0, int((coordinate - self._lower) // resolution))))
+        return min(positions), max(positions)
+
+    def bounds(self, first, last):
+        """
+        The subset bounds selecting exactly the cells first to last. They lie just inside the outer edges of
+        both cells, so they select the same cells whether the server treats cells as areas or as points.
+        """
+        resolution = self.resolution
+        return (_axis_bound(self._lower + (first + 0.05) * resolution, self.temporal),
+                _axis_bound(self._lower + (last + 0.95) * resolution, self.temporal))
+
+class CoverageMetadata:
+    """
+    Describes a coverage: its axes with their extents and the type and size of its cells. Used to validate
+    subsets and to estimate the size of results before sending a query.
+    """
+
+    CELL_TYPE_BYTES = {
+        'boolean': 1, 'char': 1, 'octet': 1, 'int8': 1, 'uint8': 1, 'unsignedByte': 1, 'byte': 1,
+        'short': 2, 'unsigned short': 2, 'int16': 2, 'uint16': 2,
+        'int': 4, 'unsigned int': 4, 'int32': 4, 'uint32': 4, 'long': 4, 'unsigned long': 4,
+        'int64': 8, 'uint64': 8, 'float': 4, 'float32': 4, 'double': 8, 'float64': 8,
+        'complex': 8, 'cint16': 4, 'cint32': 8, 'cfloat32': 8, 'complexd': 16, 'cfloat64': 16,
+    }
+
+    def __init__(self, name, axes, cell_types=('float32',)):
+        """
+        Initializes a CoverageMetadata.
+
+        Args:
+            name (str): The name of the coverage.
+            axes (list): AxisExtent objects in the order in which the server stores the axes.
+            cell_types (tuple): The type of each band, e.g. ('float32',) or ('uint8', 'uint8', 'uint8').
+                                Unknown types are counted as 8 bytes.
+        """
+        self.name = name
+        self.axes = list(axes)
+        self.cell_types = tuple(cell_types)
+
+    @property
+    def cell_bytes(self):
+        """
+        The size of one cell with all of its bands, in bytes.
+        """
+        return sum(self.CELL_TYPE_BYTES.get(cell_type, 8) for cell_type in self.cell_types)
+
+    def axis(self, name):
+        """
+        Looks up an axis by name.
+
+        Raises:
+            ValueError: If the coverage has no such axis; close matches of the name are suggested.
+        """
+        for extent in self.axes:
+            if extent.name == name:
+                return extent
+        import difflib
+        names = [extent.name for extent in self.axes]
+        suggestion = difflib.get_close_matches(name, names, n=1)
+        hint = f"; did you mean '{suggestion[0]}'?" if suggestion else ""
+        raise ValueError(f"Coverage '{self.name}' has no axis '{name}' (axes: {', '.join(names)}){hint}")
+
+    def validate(self, axes):
+        """
+        Checks a subset against the described axes without contacting the server.
+
+        Args:
+            axes (list): The Axis objects of the subset.
+
+        Raises:
+            ValueError: If an axis is unknown, given twice, has its bounds reversed or lies outside the extent.
+        """
+        seen = set()
+        for axis in axes:
+            extent = self.axis(axis.name)
+            if axis.name in seen:
+                raise ValueError(f"Axis '{axis.name}' is subset more than once")
+            seen.add(axis.name)
+            for bound in (axis.lower_bound, axis.upper_bound):
+                if bound is not None and not extent.contains(bound):
+                    raise ValueError(f"{axis} is outside the extent of coverage '{self.name}', "
+                                     f"{axis.name}({extent.lower}:{extent.upper})")
+            if axis.upper_bound is not None:
+                lower, upper = _axis_coordinate(axis.lower_bound), _axis_coordinate(axis.upper_bound)
+                if lower is not None and upper is not None and lower > upper:
+                    raise ValueError(f"{axis} has its lower bound above its upper bound")
+
+    def shape(self, axes=()):
+        """
+        Estimates the shape of a subset of the coverage.
+
+        Args:
+            axes (list): The Axis objects of the subset. Axes that are sliced to a single value are dropped.
+
+        Returns:
+            list: (axis name, number of cells) pairs of the remaining axes, in storage order.
+        """
+        subsets = {axis.name: axis for axis in axes}
+        shape = []
+        for extent in self.axes:
+            axis = subsets.get(extent.name)
+            if axis is None:
+                shape.append((extent.name, extent.size))
+            elif axis.upper_bound is not None:
+                first, last = extent.index_range(axis.lower_bound, axis.upper_bound)
+                shape.append((extent.name, last - first + 1))
+        return shape
+
+    def estimate_cells(self, axes=()):
+        """
+        Estimates the number of cells in a subset of the coverage.
+        """
+        cells = 1
+        for _, size in self.shape(axes):
+            cells *= size
+        return cells
+
+    def estimate_bytes(self, axes=()):
+        """
+        Estimates the size of a subset of the coverage in bytes, uncompressed and in binary form.
+        """
+        return self.estimate_cells(axes) * self.cell_bytes
+
+    @classmethod
+    def from_xml(cls, content):
+        """
+        Parses a WCS 2.0 DescribeCoverage response as returned by rasdaman.
+
+        Args:
+            content (bytes or str): The XML document.
+
+        Returns:
+            CoverageMetadata: The description of the first coverage in the document.
+
+        Raises:
+            ValueError: If the document does not describe a coverage.
+        """
+        import xml.etree.ElementTree as ElementTree
+        try:
+            root = ElementTree.fromstring(content)
+        except ElementTree.ParseError as err:
+            raise ValueError(f"Invalid DescribeCoverage response: {err}") from None
+
+        def local(element):
+            return element.tag.rsplit('}', 1)[-1]
+
+        def find(parent, name):
+            return next((element for element in parent.iter() if local(element) == name), None)
+
+        envelope = find(root, 'Envelope')
+        if envelope is None:
+            raise ValueError("DescribeCoverage response has no envelope")
+        coverage_id = find(root, 'CoverageId')
+        name = coverage_id.text.strip() if coverage_id is not None and coverage_id.text else None
+        labels = envelope.get('axisLabels', '').split()
+        # Dates are quoted and contain no spaces, so splitting on whitespace is safe.
+        lowers = find(envelope, 'lowerCorner').text.split()
+        uppers = find(envelope, 'upperCorner').text.split()
+
+        def coordinate(text):
+            try:
+                return float(text)
+            except ValueError:
+                return text
+
+        sizes, descending = {}, set()
+        grid_envelope = find(root, 'GridEnvelope')
+        if grid_envelope is not None:
+            grid_labels = find(root, 'axisLabels')
+            grid_labels = grid_labels.text.split() if grid_labels is not None and grid_labels.text else labels
+            lows = find(grid_envelope, 'low').text.split()
+            highs = find(grid_envelope, 'high').text.split()
+            for label, low, high in zip(grid_labels, lows, highs):
+                sizes[label] = int(high) - int(low) + 1
+            # Each offset vector has one non-zero component, on the envelope axis it belongs to.
+            for element in root.iter():
+                if local(element) == 'offsetVector' and element.text:
+                    components = [float(value) for value in element.text.split()]
+                    for label, component in zip(labels, components):
+                        if component < 0:
+                            descending.add(label)
+        axes = [AxisExtent(label, coordinate(lower), coordinate(upper), sizes.get(label, 1), label in descending)
+                for label, lower, upper in zip(labels, lowers, uppers)]
+        cell_types = []
+        for element in root.iter():
+            if local(element) == 'Quantity' and element.get('definition'):
+                cell_types.append(element.get('definition').rstrip('/').rsplit('/', 1)[-1])
+        return cls(name, axes, tuple(cell_types) or ('float32',))
+
+class MetadataCache:
+    """
+    A thread-safe cache of CoverageMetadata that fetches the description of each coverage from the
+    connection once and keeps it until it expires. Failed fetches are remembered for a shorter time, so
+    a coverage without a description does not cost a request for every query.
+    """
+
+    def __init__(self, dbc, ttl=3600.0, negative_ttl=60.0):
+        """
+        Initializes an empty MetadataCache.
+
+        Args:
+            dbc: The connection whose describe_coverage method fetches missing descriptions, e.g. a
+                 DatabaseConnection or a LocalConnection.
+            ttl (float): Seconds a description is kept before it is fetched again.
+            negative_ttl (float): Seconds a failed fetch is remembered before the description is fetched again.
+
+        Raises:
+            ValueError: If ttl or negative_ttl is not positive.
+        """
+        if ttl <= 0 or negative_ttl <= 0:
+            raise ValueError("ttl and negative_ttl must be positive")
+        self.dbc = dbc
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = {}  # Coverage name -> (metadata or None after a failure, expiry time)
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """
+        Returns the description of a coverage, fetching it if it is not cached or has expired.
+
+        Args:
+            name (str): The name of the coverage.
+
+        Returns:
+            CoverageMetadata: The description, or None if it could not be fetched now or within the last
+                              negative_ttl seconds.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry[1] > now:
+                return entry[0]
+        metadata = self.dbc.describe_coverage(name)
+        with self._lock:
+            self._entries[name] = (metadata, time.monotonic() + (self.ttl if metadata is not None else self.negative_ttl))
+        return metadata
+
+    def put(self, metadata):
+        """
+        Stores a description, e.g. one built by hand for a server without DescribeCoverage.
+        """
+        with self._lock:
+            self._entries[metadata.name] = (metadata, time.monotonic() + self.ttl)
+
+    def invalidate(self, name=None):
+        """
+        Forgets the description of one coverage, or of all coverages if name is None.
+        """
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
+
+    def __contains__(self, name):
+        with self._lock:
+            entry = self._entries.get(name)
+            return entry is not None and entry[0] is not None and entry[1] > time.monotonic()
+
+    def __len__(self):
+        with self._lock:
+            return sum(1 for metadata, _ in self._entries.values() if metadata is not None)
+
+class PartialAggregate:
+    """
+    The sum, count, minimum and maximum of the values of one period, from which the aggregates of any
+    window of periods can be assembled without scanning the values again.
+    """
+
+    OPERATIONS = ('sum', 'count', 'min', 'max', 'avg')
+
+    def __init__(self, total=0.0, count=0, minimum=float('inf'), maximum=float('-inf')):
+        """
+        Initializes a PartialAggregate. The defaults describe an empty period.
+
+        Args:
+            total (float): The sum of the values.
+            count (int): The number of values.
+            minimum (float): The smallest value.
+            maximum (float): The largest value.
+        """
+        self.total = total
+        self.count = count
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def merge(self, other):
+        """
+        Combines two partial aggregates.
+
+        Returns:
+            PartialAggregate: The aggregate of the values of both.
+        """
+        return PartialAggregate(self.total + other.total, self.count + other.count,
+                                min(self.minimum, other.minimum), max(self.maximum, other.maximum))
+
+    def value(self, operation):
+        """
+        Returns one aggregate: 'sum', 'count', 'min', 'max' or 'avg' (NaN if there are no values).
+
+        Raises:
+            ValueError: If the operation is unknown.
+        """
+        if operation not in self.OPERATIONS:
+            raise ValueError(f"Invalid operation. Valid operations are: {list(self.OPERATIONS)}")
+        if operation == 'avg':
+            return self.total / self.count if self.count else float('nan')
+        return {'sum': self.total, 'count': self.count, 'min': self.minimum, 'max': self.maximum}[operation]
+
+    def __eq__(self, other):
+        return isinstance(other, PartialAggregate) and \
+            (self.total, self.count, self.minimum, self.maximum) == (other.total, other.count, other.minimum, other.maximum)
+
+    def __repr__(self):
+        return f"PartialAggregate(total={self.total}, count={self.count}, minimum={self.minimum}, maximum={self.maximum})"
+
+class AggregateStore:
+    """
+    A thread-safe store of PartialAggregate objects, one per period of an axis, keyed by the text of the
+    query that computes it. The text identifies the coverage, the expression, the rest of the subset and
+    the period. Rolling aggregates are assembled from stored partials, and only periods that are not in
+    the store yet are fetched. The store can be persisted as JSON between runs.
+    """
+
+    def __init__(self, path=None):
+        """
+        Initializes an AggregateStore, loading the partials saved at path if the file exists.
+
+        Args:
+            path (str, optional): A JSON file the store is saved to after new partials are fetched.
+        """
+        import json
+        import os
+        self.path = path
+        self._partials = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path) as file:
+                for key, values in json.load(file).items():
+                    self._partials[key] = PartialAggregate(*values)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._partials)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._partials
+
+    def get(self, key):
+        """
+        Returns the partial aggregate stored for a query text, or None.
+        """
+        with self._lock:
+            return self._partials.get(key)
+
+    def put(self, key, partial):
+        """
+        Stores the partial aggregate of a query text, replacing any earlier one.
+        """
+        with self._lock:
+            self._partials[key] = partial
+
+    def invalidate(self, key=None):
+        """
+        Forgets one partial aggregate, e.g. of a period whose data was corrected, or all of them if key is None.
+        """
+        with self._lock:
+            if key is None:
+                self._partials.clear()
+            else:
+                self._partials.pop(key, None)
+
+    def save(self):
+        """
+        Writes the store to its path. The file is replaced at once, so readers never see a partial write.
+
+        Raises:
+            ValueError: If the store has no path.
+        """
+        import json
+        import os
+        if self.path is None:
+            raise ValueError("The store has no path to save to")
+        with self._lock:
+            data = {key: [partial.total, partial.count, partial.minimum, partial.maximum]
+                    for key, partial in self._partials.items()}
+        temporary = f"{self.path}.tmp"
+        with open(temporary, 'w') as file:
+            json.dump(data, file)  # Infinite minimums of empty periods are written as Infinity
+        os.replace(temporary, self.path)
+
+    def _period_queries(self, query, coverage, expression, axis_name, periods):
+        """
+        Returns a (key, query text) pair for each period. The key is the query text with every coverage
+        variable replaced by the coverage name, as computed by _normalize_variables.
+        """
+        original = list(coverage.axes) if coverage.subset else None
+        pairs = []
+        try:
+            for period in periods:
+                axes = [axis for axis in original or [] if axis.name != axis_name]
+                coverage.set_subset(*axes, Axis(axis_name, period))
+                text = f'{query._for_clause()}return {expression}'
+                pairs.append((_normalize_variables(text), text))
+        finally:
+            if original is None:
+                coverage.subset, coverage.axes = None, []
+            else:
+                coverage.set_subset(*original)
+        return pairs
+
+    def period_keys(self, query, coverage, expression, axis_name, periods):
+        """
+        Determines the key of each period: the text of the query that selects the values of the period,
+        with the coverage variables replaced by the coverage names. The key therefore stays the same for
+        new Coverage objects and in later processes.
+
+        Args:
+            query (Query): The query that declares the coverages.
+            coverage (Coverage): The coverage whose axis_name is sliced to each period in turn. Its other
+                                 subsets are kept.
+            expression: The expression to aggregate, e.g. the coverage itself.
+            axis_name (str): The axis of the periods, e.g. 'ansi'.
+            periods (list): The slice bounds of the periods, e.g. ['"2014-01"', '"2014-02"'].
+
+        Returns:
+            list: The key of each period, in the order of periods.
+        """
+        return [key for key, _ in self._period_queries(query, coverage, expression, axis_name, periods)]
+
+    def _fetch(self, query, text):
+        """
+        Computes the partial aggregate of one period with two small requests: the maximum and the negated
+        minimum in one coverage constructor, and the sum and the number of values in another.
+        """
+        head, expression = text.split('return ', 1)
+        extremes = query.send_query(f'{head}return encode(coverage partials over $i x(0:1) values '
+                                    f'max({expression} * (1 - 2 * $i)), "text/csv")')
+        sums = query.send_query(f'{head}return encode(coverage partials over $i x(0:1) values '
+                                f'add({expression} * (1 - $i) + $i), "text/csv")')
+        for content in (extremes, sums):
+            if isinstance(content, str):
+                raise RuntimeError(content)
+        maximum, negated_minimum = decode_csv(extremes)
+        total, count = decode_csv(sums)
+        return PartialAggregate(float(total), int(count), float(-negated_minimum), float(maximum))
+
+    def partials(self, query, coverage, expression, axis_name, periods, max_workers=4):
+        """
+        Returns the partial aggregate of every period, fetching the missing ones concurrently.
+
+        Args:
+            query, coverage, expression, axis_name, periods: As for period_keys.
+            max_workers (int): The number of periods fetched at once.
+
+        Returns:
+            list: The PartialAggregate of each period, in the order of periods.
+
+        Raises:
+            RuntimeError: If a query failed. Partials fetched before the failure are kept.
+        """
+        pairs = self._period_queries(query, coverage, expression, axis_name, periods)
+        keys = [key for key, _ in pairs]
+        missing = {key: text for key, text in pairs if key not in self}
+        if missing:
+            from concurrent.futures import ThreadPoolExecutor
+            try:
+                with ThreadPoolExecutor(max_workers=min(max_workers, len(missing))) as executor:
+                    futures = [(key, executor.submit(self._fetch, query, text)) for key, text in missing.items()]
+                    for key, future in futures:
+                        self.put(key, future.result())
+            finally:
+                if self.path is not None:
+                    self.save()
+        return [self.get(key) for key in keys]
+
+    def aggregate(self, query, coverage, expression, axis_name, periods, operation='avg', max_workers=4):
+        """
+        Computes an aggregate over several periods from their partial aggregates.
+
+        Args:
+            query, coverage, expression, axis_name, periods, max_workers: As for partials.
+            operation (str): 'sum', 'count', 'min', 'max' or 'avg'.
+
+        Returns:
+            float: The aggregate of all values of the periods.
+        """
+        if operation not in PartialAggregate.OPERATIONS:
+            raise ValueError(f"Invalid operation. Valid operations are: {list(PartialAggregate.OPERATIONS)}")
+        combined = PartialAggregate()
+        for partial in self.partials(query, coverage, expression, axis_name, periods, max_workers):
+            combined = combined.merge(partial)
+        return combined.value(operation)
+
+    def rolling(self, query, coverage, expression, axis_name, periods, window, operation='avg', max_workers=4):
+        """
+        Computes a rolling aggregate, e.g. the 12-month average at the end of every month.
+
+        Args:
+            query, coverage, expression, axis_name, periods, max_workers: As for partials.
+            window (int): The number of periods in each window.
+            operation (str): 'sum', 'count', 'min', 'max' or 'avg'.
+
+        Returns:
+            list: (last period, aggregate) pairs, one for each complete window.
+
+        Raises:
+            ValueError: If window is not positive or the operation is unknown.
+        """
+        if window < 1:
+            raise ValueError("window must be at least 1")
+        if operation not in PartialAggregate.OPERATIONS:
+            raise ValueError(f"Invalid operation. Valid operations are: {list(PartialAggregate.OPERATIONS)}")
+        partials = self.partials(query, coverage, expression, axis_name, periods, max_workers)
+        results = []
+        for end in range(window - 1, len(periods)):
+            combined = PartialAggregate()
+            for partial in partials[end - window + 1:end + 1]:
+                combined = combined.merge(partial)
+            results.append((periods[end], combined.value(operation)))
+        return results
+
+class Prefetcher:
+    """
+    Watches how a Query steps through the slices of one axis (e.g. an animation walking 'ansi' one
+    month at a time) and, once a steady stride is detected, fetches the next slices in the background
+    into the query's result cache. Pending prefetches that fall out of the predicted window are cancelled.
+    """
+
+    def __init__(self, query, coverage, axis_name, values, depth=3, max_workers=None):
+        """
+        Initializes a Prefetcher for one coverage and axis of a query.
+
+        Args:
+            query (Query): The query being executed frame by frame. A ResultCache is attached if it has none.
+            coverage (Coverage): The coverage whose subset is stepped along the axis.
+            axis_name (str): The name of the stepped axis, e.g. 'ansi'.
+            values (list): The ordered slice values of the axis, written as in Axis, e.g. '"2014-07"'.
+            depth (int): The maximum number of slices fetched ahead of the current one.
+            max_workers (int, optional): The number of background fetches that may run at once.
+                                         Defaults to depth.
+
+        Raises:
+            ValueError: If depth is smaller than 1.
+        """
+        if depth < 1:
+            raise ValueError("depth must be at least 1")
+        if query.cache is None:
+            query.cache = ResultCache(max(128, 2 * depth))
+        self.query = query
+        self.coverage = coverage
+        self.axis_name = axis_name
+        self.values = list(values)
+        self.depth = depth
+        self._positions = {value: index for index, value in enumerate(self.values)}
+        self._history = []  # Indices of the slices requested so far (only the last three are kept)
+        self._pending = {}  # Index -> Future of the background fetch
+        self._lock = threading.Lock()
+        from concurrent.futures import ThreadPoolExecutor
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or depth)
+
+    def _current_index(self):
+        """
+        Finds the position of the coverage's current slice along the stepped axis.
+
+        Raises:
+            ValueError: If the coverage has no single-slice subset on the axis, or the slice is not in values.
+        """
+        for axis in self.coverage.axes:
+            if axis.name == self.axis_name:
+                if axis.upper_bound is not None:
+                    raise ValueError(f"Axis '{self.axis_name}' must select a single slice to be prefetched")
+                if axis.lower_bound not in self._positions:
+                    raise ValueError(f"{axis.lower_bound} is not one of the known values of axis '{self.axis_name}'")
+                return self._positions[axis.lower_bound]
+        raise ValueError(f"Coverage has no subset on axis '{self.axis_name}'")
+
+    def _stride(self):
+        """
+        Returns the step between consecutive requests if the last two steps agree, otherwise None.
+        """
+        if len(self._history) < 3:
+            return None
+        first = self._history[-2] - self._history[-3]
+        second = self._history[-1] - self._history[-2]
+        if first == second and second != 0:
+            return second
+        return None
+
+    def _query_for(self, expression, index):
+        """
+        Generates the query text for the same expression at another slice of the axis.
+        The coverage's subset is swapped temporarily and restored afterwards.
+        """
+        original_axes = self.coverage.axes
+        value = self.values[index]
+        axes = [Axis(axis.name, value) if axis.name == self.axis_name else axis for axis in original_axes]
+        self.coverage.set_subset(*axes)
+        try:
+            return self.query.generate_query(expression)
+        finally:
+            self.coverage.set_subset(*original_axes)
+
+    def execute_query(self, expression):
+        """
+        Executes the query for the current slice and schedules prefetches for the slices that follow.
+
+        Args:
+            expression: The expression passed on to Query.execute_query.
+
+        Returns:
+            bytes or str: The result of Query.execute_query for the current slice.
+        """
+        index = self._current_index()
+        with self._lock:
+            self._history = (self._history + [index])[-3:]
+            stride = self._stride()
+            wanted = []
+            if stride is not None:
+                for step in range(1, self.depth + 1):
+                    ahead = index + stride * step
+                    if 0 <= ahead < len(self.values):
+                        wanted.append(ahead)
+            current = self._pending.pop(index, None)
+            # Cancel what the access pattern no longer needs; running fetches just finish into the cache.
+            for pending_index, future in list(self._pending.items()):
+                if future.done() or (pending_index not in wanted and future.cancel()):
+                    del self._pending[pending_index]
+            for ahead in wanted:
+                if ahead in self._pending:
+                    continue
+                query = self._query_for(expression, ahead)
+                if query in self.query.cache:
+                    continue
+                self._pending[ahead] = self._executor.submit(self.query.send_query, query)
+        if current is not None and not current.cancelled():
+            current.result()  # Wait for the in-flight prefetch instead of sending the query twice
+        return self.query.execute_query(expression)
+
+    def pending(self):
+        """
+        Returns the sorted indices of the slices currently being prefetched.
+
+        Returns:
+            list: The indices into values of prefetches that are queued or running.
+        """
+        with self._lock:
+            return sorted(index for index, future in self._pending.items() if not future.done())
+
+    def close(self):
+        """
+        Cancels queued prefetches and shuts down the background workers.
+        """
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+            self._pending.clear()
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def decode_csv(content):
+    """
+    Decodes a CSV result as encoded by rasdaman, where nested braces delimit the rows of
+    multidimensional results (e.g. '{1,2,3},{4,5,6}' for a 2x3 array).
+
+    Args:
+        content (bytes or str): The raw content of the response.
+
+    Returns:
+        numpy.ndarray: The decoded values as a float array with the shape of the result.
+
+    Raises:
+        ValueError: If the content is not numeric CSV.
+    """
+    import numpy as np
+    text = content.decode() if isinstance(content, (bytes, bytearray)) else content
+    text = text.strip()
+    if not text:
+        return np.empty(0)
+    flat = text.replace('{', '').replace('}', '')
+    try:
+        values = np.array(flat.split(','), dtype=float)
+    except ValueError:
+        raise ValueError("Content is not numeric CSV") from None
+    # Only the first group of each nesting level is scanned; the outermost size follows from the value count.
+    inner_shape = []
+    group = text
+    while group.startswith('{'):
+        depth = 0
+        for position, char in enumerate(group):
+            if char == '{':
+                depth += 1
+            elif char == '}':
+                depth -= 1
+                if depth == 0:
+                    break
+        group = group[1:position].strip()  # Content of the first group
+        depth, count = 0, 1
+        for char in group:
+            if char == '{':
+                depth += 1
+            elif char == '}':
+                depth -= 1
+            elif char == ',' and depth == 0:
+                count += 1
+        inner_shape.append(count)
+    if not inner_shape:
+        return values
+    size = int(np.prod(inner_shape))
+    if values.size % size:
+        raise ValueError("Content is not a regular CSV array")
+    return values.reshape([values.size // size] + inner_shape)
+
+def decode_result(content, return_type):
+    """
+    Decodes the raw content of a query result into a NumPy array.
+
+    Args:
+        content (bytes): The raw content of the response.
+        return_type (str): The return type of the query ('CSV', 'PNG' or 'JPEG'). Anything else,
+                           e.g. the scalar result of an aggregate, is decoded as CSV.
+
+    Returns:
+        numpy.ndarray: The decoded values or image pixels.
+    """
+    if return_type in ('PNG', 'JPEG'):
+        import io
+        import numpy as np
+        from PIL import Image
+        with Image.open(io.BytesIO(content)) as image:
+            return np.asarray(image)
+    return decode_csv(content)
+
+def evaluate_expression(expression, resolve):
+    """
+    Evaluates an expression tree of BinaryOperation objects or OperationNodes locally with NumPy.
+
+    Args:
+        expression: A BinaryOperation, an OperationNode, a Coverage, a CoverageNode or a number.
+        resolve (callable): Returns the NumPy array of values for a Coverage or CoverageNode leaf.
+
+    Returns:
+        numpy.ndarray or number: The result of the expression.
+
+    Raises:
+        ValueError: If the expression contains parts that cannot be evaluated locally, e.g. raw strings.
+    """
+    import numpy as np
+    operators = {
+        '+': np.add, '-': np.subtract, '*': np.multiply, '/': np.true_divide,
+        '<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal,
+        '==': np.equal, '!=': np.not_equal, 'and': np.logical_and, 'or': np.logical_or,
+    }
+    if isinstance(expression, (BinaryOperation, OperationNode)):
+        if expression.operator not in operators:
+            raise ValueError(f"Operator '{expression.operator}' cannot be evaluated locally")
+        lhs = evaluate_expression(expression.lhs, resolve)
+        rhs = evaluate_expression(expression.rhs, resolve)
+        return operators[expression.operator](lhs, rhs)
+    if isinstance(expression, (int, float)) and not isinstance(expression, bool):
+        return expression
+    if isinstance(expression, str):
+        raise ValueError(f"Expression '{expression}' cannot be evaluated locally")
+    return resolve(expression)
+
+def _accepts_event(send_request):
+    """
+    Whether a connection's send_request takes the event keyword, which connections written against the
+    original interface, send_request(query), do not.
+    """
+    import inspect
+    try:
+        parameters = inspect.signature(send_request).parameters.values()
+    except (TypeError, ValueError):
+        return False
+    return any(parameter.name == 'event' or parameter.kind is parameter.VAR_KEYWORD for parameter in parameters)
+
+def _decode_into_shared_memory(content, return_type):
+    """
+    Runs in a worker process of DecodePipeline: decodes a payload and copies the array into a new
+    shared memory block, so only its name, shape and type travel back to the parent.
+    """
+    from multiprocessing import resource_tracker, shared_memory
+    import numpy as np
+    array = np.ascontiguousarray(decode_result(content, return_type))
+    block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    try:
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+    block.close()
+    # The parent attaches to the block and unlinks it. Without this, the worker's resource tracker
+    # would remove the block when the worker exits.
+    resource_tracker.unregister(block._name, 'shared_memory')
+    return block.name, array.shape, array.dtype.str
+
+def _attach_shared_array(name, shape, dtype):
+    """
+    Maps an array written by _decode_into_shared_memory without copying it. The block is unlinked at once,
+    so its memory is released as soon as the array is garbage collected, even if the process is killed.
+    """
+    import weakref
+    from multiprocessing import shared_memory
+    import numpy as np
+    block = shared_memory.SharedMemory(name=name)
+    block.unlink()
+    array = np.ndarray(shape, dtype, buffer=block.buf)
+    weakref.finalize(array, block.close)
+    return array
+
+def _copy_future(source, target):
+    """
+    Resolves target with the result or exception of the finished future source.
+    """
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+class DecodePipeline:
+    """
+    Decodes query results in a pool of processes, so decoding large PNG, JPEG and CSV payloads uses every
+    core instead of holding the GIL of the downloading process. Decoded arrays come back through shared
+    memory rather than being pickled. execute downloads results on threads and hands each payload to the
+    process pool as soon as it arrives, so decoding overlaps with the remaining downloads.
+    """
+
+    def __init__(self, max_workers=None, download_threads=8, inline_bytes=64 * 1024):
+        """
+        Initializes a DecodePipeline. The worker processes are started on first use.
+
+        Args:
+            max_workers (int, optional): The number of decoding processes. Defaults to the number of cores.
+            download_threads (int): The number of results execute downloads at once.
+            inline_bytes (int): Payloads smaller than this are decoded in the calling process, where
+                                they are cheaper to decode than to send to a worker.
+
+        Raises:
+            ValueError: If max_workers or download_threads is not positive.
+        """
+        if (max_workers is not None and max_workers < 1) or download_threads < 1:
+            raise ValueError("max_workers and download_threads must be positive")
+        self.max_workers = max_workers
+        self.download_threads = download_threads
+        self.inline_bytes = inline_bytes
+        self._processes = None
+        self._threads = None
+        self._lock = threading.Lock()
+
+    def _pools(self):
+        with self._lock:
+            if self._processes is None:
+                from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+                self._processes = ProcessPoolExecutor(max_workers=self.max_workers)
+                self._threads = ThreadPoolExecutor(max_workers=self.download_threads)
+            return self._processes, self._threads
+
+    def decode(self, content, return_type):
+        """
+        Decodes a payload, as decode_result does, in a worker process.
+
+        Args:
+            content (bytes): The raw content of a response.
+            return_type (str): The return type of the query ('CSV', 'PNG' or 'JPEG').
+
+        Returns:
+            concurrent.futures.Future: Resolves to the decoded numpy.ndarray.
+        """
+        from concurrent.futures import Future
+        result = Future()
+        if len(content) < self.inline_bytes:
+            try:
+                result.set_result(decode_result(content, return_type))
+            except Exception as err:
+                result.set_exception(err)
+            return result
+        processes, _ = self._pools()
+
+        def decoded(future):
+            try:
+                result.set_result(_attach_shared_array(*future.result()))
+            except BaseException as err:
+                result.set_exception(err)
+        processes.submit(_decode_into_shared_memory, content, return_type).add_done_callback(decoded)
+        return result
+
+    def submit(self, query, expression):
+        """
+        Generates a query, downloads its result on a thread and decodes it in a worker process.
+
+        Args:
+            query (Query): The query whose settings are used. The query text is generated before this returns,
+                           so the query may be changed afterwards.
+            expression: The expression to be executed, as for execute_query.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the decoded numpy.ndarray, or raises RuntimeError if the
+                                       query failed.
+        """
+        from concurrent.futures import Future
+        text = query.generate_query(expression)
+        return_type = query.return_type
+        result = Future()
+        _, threads = self._pools()
+
+        def downloaded(future):
+            try:
+                content = future.result()
+                if isinstance(content, str):
+                    raise RuntimeError(content)
+                decoding = self.decode(content, return_type)
+            except BaseException as err:
+                result.set_exception(err)
+                return
+            decoding.add_done_callback(lambda done: _copy_future(done, result))
+        threads.submit(query.send_query, text).add_done_callback(downloaded)
+        return result
+
+    def execute(self, query, expressions):
+        """
+        Executes one query per expression and yields the decoded results in the order of the expressions.
+        All queries are generated first, then downloaded and decoded concurrently.
+
+        Args:
+            query (Query): The query whose settings are used.
+            expressions (list): The expressions to be executed. To vary a subset between results, call submit
+                                after each change of the subset instead.
+
+        Yields:
+            numpy.ndarray: The decoded result of each expression.
+
+        Raises:
+            RuntimeError: If a query failed.
+        """
+        futures = [self.submit(query, expression) for expression in expressions]
+        for future in futures:
+            yield future.result()
+
+    def close(self):
+        """
+        Waits for pending work and stops the worker processes and download threads.
+        """
+        with self._lock:
+            processes, threads = self._processes, self._threads
+            self._processes = self._threads = None
+        if threads is not None:
+            threads.shutdown()
+            processes.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class LocalColorCoding:
+    """
+    Applies the Switch of a colorcoding Query on the client. The raw values of the coverages used in the
+    switch are fetched once as CSV; every palette change afterwards is an in-memory NumPy operation
+    instead of a new query and PNG download.
+    """
+
+    def __init__(self, query):
+        """
+        Initializes a LocalColorCoding for a colorcoding query.
+
+        Args:
+            query (Query): The query whose dbc, cache, preview, return type and Switch are used.
+        """
+        self.query = query
+        self.arrays = {}  # Coverage text, its variable and subset -> fetched NumPy values
+
+    def _coverages(self, expression, found):
+        """
+        Collects the Coverage objects an expression refers to, keyed by their text, e.g. '$c1[Lat(0:10)]',
+        so a coverage whose subset changed is fetched again.
+        """
+        if isinstance(expression, BinaryOperation):
+            self._coverages(expression.lhs, found)
+            self._coverages(expression.rhs, found)
+        elif isinstance(expression, Coverage):
+            found.setdefault(str(expression), expression)
+        return found
+
+    def fetch(self, switch=None):
+        """
+        Fetches the values of every coverage referenced by the switch cases, once.
+
+        Args:
+            switch (Switch, optional): The switch whose coverages are fetched. Defaults to the query's Switch.
+
+        Raises:
+            ValueError: If no switch is available.
+            RuntimeError: If the values of a coverage could not be fetched.
+        """
+        switch = switch or self.query.Switch
+        if switch is None:
+            raise ValueError("A Switch must be set before fetching values for local colorcoding.")
+        coverages = {}
+        for case in switch.cases:
+            self._coverages(case.expression, coverages)
+        if switch.expression is not None:
+            self._coverages(switch.expression, coverages)
+        for key, coverage in coverages.items():
+            if key in self.arrays:
+                continue
+            values_query = Query(self.query.dbc, cache=self.query.cache)
+            values_query.add_coverage(coverage)
+            values_query.set_operation('encode')
+            values_query.set_return('CSV')
+            values_query.preview = self.query.preview  # Fetch at the same resolution the server would render
+            content = values_query.execute_query(coverage)
+            if isinstance(content, str):
+                raise RuntimeError(f"Could not fetch the values of coverage {coverage.name}: {content}")
+            self.arrays[key] = decode_csv(content)
+
+    def render(self, switch=None):
+        """
+        Colors the fetched values with a switch statement.
+
+        Args:
+            switch (Switch, optional): The switch to apply. Defaults to the query's Switch.
+
+        Returns:
+            numpy.ndarray: The uint8 RGB image.
+        """
+        switch = switch or self.query.Switch
+        self.fetch(switch)  # No-op for coverages that were already fetched with their current subset
+        return switch.evaluate(lambda coverage: self.arrays[str(coverage)])
+
+    def encode(self, switch=None):
+        """
+        Colors the fetched values and encodes them in the query's return type, like the server does.
+
+        Args:
+            switch (Switch, optional): The switch to apply. Defaults to the query's Switch.
+
+        Returns:
+            bytes: The encoded PNG or JPEG image.
+        """
+        import io
+        from PIL import Image
+        rgb = self.render(switch)
+        buffer = io.BytesIO()
+        Image.fromarray(rgb, 'RGB').save(buffer, format=self.query.return_type or 'PNG')
+        return buffer.getvalue()
+
+class LocalCube:
+    """
+    A datacube held in a NumPy array or a memory-mapped .npy file, together with the coordinates
+    of each of its axes, for use with LocalConnection.
+    """
+
+    def __init__(self, data, axes):
+        """
+        Initializes a LocalCube.
+
+        Args:
+            data (numpy.ndarray): The cell values, with one dimension per axis.
+            axes (list): (name, coordinates) pairs in the order of the data's dimensions. Coordinates are
+                         numbers (e.g. latitudes) or strings (e.g. '2014-07' for an ansi time axis).
+
+        Raises:
+            ValueError: If the axes do not match the shape of the data.
+        """
+        import numpy as np
+        if len(axes) != data.ndim:
+            raise ValueError(f"Expected {data.ndim} axes, got {len(axes)}")
+        self.data = data
+        self.axes = []
+        for (name, coordinates), size in zip(axes, data.shape):
+            coordinates = np.asarray(coordinates)
+            if len(coordinates) != size:
+                raise ValueError(f"Axis '{name}' has {len(coordinates)} coordinates for {size} cells")
+            self.axes.append((name, coordinates))
+
+    @classmethod
+    def load(cls, path, axes):
+        """
+        Opens a .npy file as a memory-mapped cube, so only the subsets a query touches are read.
+
+        Args:
+            path (str): The path of the .npy file.
+            axes (list): (name, coordinates) pairs as for LocalCube.
+
+        Returns:
+            LocalCube: The memory-mapped cube.
+        """
+        import numpy as np
+        return cls(np.load(path, mmap_mode='r'), axes)
+
+    def _index(self, name, coordinates, lower, upper, is_range):
+        """
+        Translates the bounds of one subset into an integer index (slicing) or a slice (trimming).
+        """
+        import numpy as np
+        textual = coordinates.dtype.kind in 'USO'
+        if not is_range:
+            if textual:
+                matches = np.nonzero(coordinates == str(lower))[0]
+                if not len(matches):
+                    raise ValueError(f"{lower} is outside the extent of axis '{name}'")
+                return int(matches[0])
+            return int(np.argmin(np.abs(coordinates - float(lower))))  # Nearest cell, like the server
+        if textual:
+            # Dates are compared as points in time, so '2014-07' lies between '2014-06-30T12:00:00Z' and '2014-07-31'.
+            days = [_axis_coordinate(str(value)) for value in coordinates]
+            bounds = [_axis_coordinate(str(bound)) for bound in (lower, upper) if bound is not None]
+            if None not in days and None not in bounds:
+                coordinates = np.array(days)
+                textual = False
+                lower = None if lower is None else _axis_coordinate(str(lower))
+                upper = None if upper is None else _axis_coordinate(str(upper))
+        inside = np.ones(len(coordinates), dtype=bool)
+        if lower is not None:
+            inside &= coordinates >= (str(lower) if textual else float(lower))
+        if upper is not None:
+            inside &= coordinates <= (str(upper) if textual else float(upper))
+        positions = np.nonzero(inside)[0]
+        if not len(positions):
+            raise ValueError(f"Subset {name}({lower}:{upper}) is outside the extent of the axis")
+        return slice(int(positions[0]), int(positions[-1]) + 1)
+
+    def select(self, subsets):
+        """
+        Applies a WCPS subset without reading any cells.
+
+        Args:
+            subsets (list): (axis name, lower, upper, is_range) tuples. None bounds of a range are open.
+
+        Returns:
+            tuple: The selected view of the data and the names of the axes that remain.
+
+        Raises:
+            ValueError: If an axis is unknown or a bound is outside its extent.
+        """
+        names = [name for name, _ in self.axes]
+        index = [slice(None)] * len(names)
+        for name, lower, upper, is_range in subsets:
+            if name not in names:
+                raise ValueError(f"Unknown axis '{name}'; the cube has axes {names}")
+            position = names.index(name)
+            index[position] = self._index(name, self.axes[position][1], lower, upper, is_range)
+        remaining = [name for name, item in zip(names, index) if isinstance(item, slice)]
+        return self.data[tuple(index)], remaining
+
+class _WCPSParser:
+    """
+    Parses the subset of WCPS produced by Query.generate_query into a tree of tuples.
+    """
+
+    TOKEN_PATTERN = r'''\s*(?:(?P<number>\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+)|"(?P<string>[^"]*)"|(?P<variable>\$\w+)
+                        |(?P<name>[A-Za-z_]\w*)|(?P<symbol><=|>=|!=|[-+*/<>=()\[\]{},:;]))'''
+    TOKEN = None  # Compiled on first use to keep importing wdc cheap
+    CONDENSERS = ('count', 'min', 'max', 'avg', 'add')
+    COMPARISONS = ('<', '<=', '>', '>=', '=', '!=')
+
+    def __init__(self, text):
+        if _WCPSParser.TOKEN is None:
+            _WCPSParser.TOKEN = re.compile(self.TOKEN_PATTERN, re.VERBOSE)
+        self.tokens = []
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            match = self.TOKEN.match(text, position)
+            if not match:
+                raise ValueError(f"Unexpected character in query at position {position}: {text[position:position + 20]!r}")
+            kind = match.lastgroup
+            self.tokens.append((kind, match.group(kind)))
+            position = match.end()
+        self.position = 0
+
+    def peek(self, value=None):
+        if self.position >= len(self.tokens):
+            return None
+        token = self.tokens[self.position]
+        if value is None or token[1] == value:
+            return token
+        return None
+
+    def take(self, value=None, kind=None):
+        token = self.peek()
+        if token is None or (value is not None and token[1] != value) or (kind is not None and token[0] != kind):
+            expected = value or kind
+            raise ValueError(f"Expected {expected} in query, found {token[1] if token else 'end of query'}")
+        self.position += 1
+        return token[1]
+
+    def parse(self):
+        """
+        Returns:
+            tuple: The coverage bindings ({variable: coverage name}) and the tree of the return expression.
+        """
+        self.take('for')
+        bindings = {}
+        while True:
+            variable = self.take(kind='variable')
+            self.take('in')
+            self.take('(')
+            bindings[variable] = self.take(kind='name')
+            self.take(')')
+            if not self.peek(','):
+                break
+            self.take(',')
+        self.take('return')
+        tree = self.expression()
+        if self.peek() is not None:
+            raise ValueError(f"Unexpected {self.peek()[1]} after the end of the query")
+        return bindings, tree
+
+    def expression(self):
+        node = self.comparison()
+        while self.peek('and') or self.peek('or'):
+            operator = self.take()
+            node = ('binary', operator, node, self.comparison())
+        return node
+
+    def comparison(self):
+        lhs = self.additive()
+        token = self.peek()
+        if token and token[0] == 'symbol' and token[1] in self.COMPARISONS:
+            operator = self.take()
+            return ('binary', '==' if operator == '=' else operator, lhs, self.additive())
+        return lhs
+
+    def additive(self):
+        node = self.term()
+        while self.peek('+') or self.peek('-'):
+            operator = self.take()
+            node = ('binary', operator, node, self.term())
+        return node
+
+    def term(self):
+        node = self.unary()
+        while self.peek('*') or self.peek('/'):
+            operator = self.take()
+            node = ('binary', operator, node, self.unary())
+        return node
+
+    def unary(self):
+        if self.peek('-'):
+            self.take()
+            return ('binary', '-', ('number', 0), self.unary())
+        return self.primary()
+
+    def number(self):
+        text = self.take(kind='number')
+        return float(text) if any(char in text for char in '.eE') else int(text)
+
+    def primary(self):
+        kind, value = self.peek() or (None, None)
+        if kind == 'number':
+            return ('number', self.number())
+        if kind == 'string':
+            return ('string', self.take())
+        if value == '(':
+            self.take('(')
+            node = self.expression()
+            self.take(')')
+            return node
+        if value == '{':
+            return self.color()
+        if kind == 'variable':
+            variable = self.take()
+            return ('coverage', variable, self.subset() if self.peek('[') else [])
+        if value == 'switch':
+            return self.switch()
+        if value in self.CONDENSERS:
+            self.take()
+            self.take('(')
+            node = self.expression()
+            self.take(')')
+            return ('condense', value, node)
+        if value == 'encode':
+            self.take()
+            self.take('(')
+            node = self.expression()
+            self.take(',')
+            mime_type = self.take(kind='string')
+            self.take(')')
+            return ('encode', node, mime_type)
+        if value == 'scale':
+            return self.scale()
+        if value == 'coverage':
+            return self.construct()
+        raise ValueError(f"Unsupported WCPS construct: {value if value is not None else 'end of query'}")
+
+    def bound(self):
+        if self.peek('*'):
+            self.take()
+            return None
+        if self.peek('-'):
+            self.take()
+            return -self.number()
+        token = self.peek()
+        if token and token[0] == 'string':
+            return self.take()
+        return self.number()
+
+    def subset(self):
+        self.take('[')
+        subsets = []
+        while True:
+            name = self.take(kind='name')
+            self.take('(')
+            lower = self.bound()
+            if self.peek(':'):
+                self.take(':')
+                subsets.append((name, lower, self.bound(), True))
+            else:
+                subsets.append((name, lower, None, False))
+            self.take(')')
+            if not self.peek(','):
+                break
+            self.take(',')
+        self.take(']')
+        return subsets
+
+    def color(self):
+        self.take('{')
+        channels = {}
+        while True:
+            channel = self.take(kind='name')
+            self.take(':')
+            channels[channel] = self.number()
+            if not self.peek(';'):
+                break
+            self.take(';')
+        self.take('}')
+        return ('color', (channels.get('red', 0), channels.get('green', 0), channels.get('blue', 0)))
+
+    def switch(self):
+        self.take('switch')
+        cases = []
+        while self.peek('case'):
+            self.take()
+            condition = self.expression()
+            self.take('return')
+            cases.append((condition, self.expression()))
+        self.take('default')
+        self.take('return')
+        return ('switch', cases, self.expression())
+
+    def construct(self):
+        self.take('coverage')
+        self.take(kind='name')  # The name of the new coverage
+        self.take('over')
+        variable = self.take(kind='variable')
+        axis = self.take(kind='name')
+        self.take('(')
+        lower = self.number()
+        self.take(':')
+        upper = self.number()
+        self.take(')')
+        self.take('values')
+        return ('construct', variable, axis, lower, upper, self.expression())
+
+    def scale(self):
+        self.take('scale')
+        self.take('(')
+        node = self.expression()
+        self.take(',')
+        self.take('{')
+        sizes = {}
+        while True:
+            name = self.take(kind='name')
+            self.take(':')
+            self.take(kind='string')  # The grid CRS, "CRS:1"
+            self.take('(')
+            lower = self.number()
+            self.take(':')
+            sizes[name] = self.number() - lower + 1
+            self.take(')')
+            if not self.peek(','):
+                break
+            self.take(',')
+        self.take('}')
+        self.take(')')
+        return ('scale', node, sizes)
+
+class LocalConnection:
+    """
+    Executes queries without a server, as a drop-in replacement for DatabaseConnection. It evaluates the
+    WCPS that Query.generate_query produces (subsets, arithmetic, comparisons and logical operators, aggregates,
+    coverage constructors over one axis, switch, scale and encode) with vectorized NumPy over LocalCube objects, which may be memory-mapped.
+    Aggregates and CSV encodings of large cubes are computed in chunks along the first axis.
+    """
+
+    def __init__(self, cubes, chunk_size=1 << 22):
+        """
+        Initializes a LocalConnection.
+
+        Args:
+            cubes (dict): Maps coverage names to LocalCube objects.
+            chunk_size (int): The approximate number of cells evaluated at once for aggregates and CSV output.
+        """
+        self.cubes = cubes
+        self.chunk_size = chunk_size
+
+    def send_request(self, query, event=None):
+        """
+        Evaluates a query locally.
+
+        Args:
+            query (str): The WCPS query string.
+            event (QueryEvent, optional): Receives the evaluation time as the network phase.
+
+        Returns:
+            QueryResponse: The encoded result, or None if the query could not be evaluated.
+        """
+        start = time.perf_counter()
+        try:
+            response = QueryResponse(self.evaluate(query), headers={'Content-Type': self._content_type(query)})
+        except Exception as err:
+            print(f"An error occurred: {err}")  # Reported like network errors of DatabaseConnection
+            if event is not None:
+                event.error = str(err)
+            return None
+        if event is not None:
+            event.record_response(response, time.perf_counter() - start, 0)
+        return response
+
+    def describe_coverage(self, name):
+        """
+        Describes a cube like the server's DescribeCoverage: each axis extends half a cell beyond its
+        first and last coordinates.
+
+        Args:
+            name (str): The name of the coverage.
+
+        Returns:
+            CoverageMetadata: The description of the cube, or None if there is no such cube.
+        """
+        cube = self.cubes.get(name)
+        if cube is None:
+            print(f"An error occurred: Unknown coverage '{name}'")
+            return None
+        axes = []
+        for axis_name, coordinates in cube.axes:
+            temporal = coordinates.dtype.kind in 'USO'
+            values = [_axis_coordinate(str(value) if temporal else float(value)) for value in coordinates]
+            step = abs(values[-1] - values[0]) / (len(values) - 1) if len(values) > 1 else 0.0
+            lower, upper = min(values[0], values[-1]) - step / 2, max(values[0], values[-1]) + step / 2
+            axes.append(AxisExtent(axis_name, _axis_bound(lower, temporal), _axis_bound(upper, temporal),
+                                   len(values), values[-1] < values[0]))
+        return CoverageMetadata(name, axes, (cube.data.dtype.name,))
+
+    def _content_type(self, query):
+        for mime_type in Query.VALID_RETURN_TYPES.values():
+            if f'"{mime_type}"' in query:
+                return mime_type
+        return 'text/plain'
+
+    def evaluate(self, query):
+        """
+        Evaluates a query locally.
+
+        Args:
+            query (str): The WCPS query string.
+
+        Returns:
+            bytes: The encoded result, as the server would return it.
+
+        Raises:
+            ValueError: If the query is not supported or refers to unknown coverages or axes.
+        """
+        bindings, tree = _WCPSParser(query).parse()
+        for variable, name in bindings.items():
+            if name not in self.cubes:
+                raise ValueError(f"Unknown coverage '{name}'")
+        evaluator = _WCPSEvaluator({variable: self.cubes[name] for variable, name in bindings.items()}, self.chunk_size)
+        return evaluator.run(tree)
+
+class _WCPSEvaluator:
+    """
+    Evaluates a tree produced by _WCPSParser for one query, with its coverage variables bound to LocalCube objects.
+    """
+
+    def __init__(self, bindings, chunk_size):
+        self._bindings = bindings
+        self._iterators = {}  # Iterator variables of coverage constructors -> their current value
+        self.chunk_size = chunk_size
+
+    def run(self, tree):
+        """
+        Returns:
+            bytes: The encoded result of the query.
+        """
+        if tree[0] == 'encode':
+            return self._encode(tree[1], tree[2])
+        return self._format_scalar(self._value(tree, None))
+
+    def _select(self, node):
+        _, variable, subsets = node
+        if variable not in self._bindings:
+            raise ValueError(f"Unbound coverage variable {variable}")
+        return self._bindings[variable].select(subsets)
+
+    def _layout(self, node):
+        """
+        Returns the shape and axis names of the result of a node without evaluating any cells.
+        """
+        kind = node[0]
+        if kind == 'coverage' and node[1] in self._iterators:
+            return (), []
+        if kind == 'coverage':
+            view, names = self._select(node)
+            return view.shape, names
+        if kind == 'construct':
+            return (node[4] - node[3] + 1,), [node[2]]
+        if kind == 'binary':
+            return self._broadcast([self._layout(node[2]), self._layout(node[3])])
+        if kind == 'switch':
+            parts = [self._layout(part) for case in node[1] for part in case] + [self._layout(node[2])]
+            return self._broadcast(parts)
+        if kind == 'scale':
+            shape, names = self._layout(node[1])
+            return tuple(node[2].get(name, size) for name, size in zip(names, shape)) + shape[len(names):], names
+        return (), []
+
+    def _broadcast(self, layouts):
+        import numpy as np
+        shape = np.broadcast_shapes(*[shape for shape, _ in layouts])
+        names = max((names for _, names in layouts), key=len)
+        return shape, names
+
+    def _value(self, node, rows, shape=()):
+        """
+        Evaluates a node. If rows is a slice, only those rows along the first axis of the result are evaluated;
+        shape is the shape of the whole result, so operands that are broadcast along that axis stay whole.
+        """
+        import numpy as np
+        kind = node[0]
+        if kind in ('number', 'string'):
+            return node[1]
+        if kind == 'color':
+            return np.array(node[1], dtype=np.uint8)
+        if kind == 'coverage' and node[1] in self._iterators:
+            return self._iterators[node[1]]
+        if kind == 'coverage':
+            view, _ = self._select(node)
+            return np.asarray(self._rows(view, rows, shape))
+        if kind == 'binary':
+            lhs = self._value(node[2], rows, shape)
+            rhs = self._value(node[3], rows, shape)
+            return evaluate_expression(BinaryOperation(lhs, node[1], rhs), lambda value: value)
+        if kind == 'switch':
+            return self._switch(node, rows, shape)
+        if kind == 'condense':
+            return self._condense(node[1], node[2])
+        if kind == 'scale':
+            return self._rows(self._scale(node), rows, shape)
+        if kind == 'construct':
+            return self._rows(self._construct(node), rows, shape)
+        raise ValueError(f"{kind} cannot be used inside an expression")
+
+    @staticmethod
+    def _rows(value, rows, shape):
+        """
+        Returns the rows of an operand, or the whole operand if it has a lower rank than the result or is
+        broadcast along its first axis.
+        """
+        if rows is None or value.ndim != len(shape) or value.shape[0] != shape[0]:
+            return value
+        return value[rows]
+
+    def _switch(self, node, rows, shape=()):
+        import numpy as np
+        conditions = [np.asarray(self._value(condition, rows, shape), dtype=bool) for condition, _ in node[1]]
+        results = [np.asarray(self._value(result, rows, shape)) for _, result in node[1]]
+        default = np.asarray(self._value(node[2], rows, shape))
+        conditions = np.broadcast_arrays(*conditions)
+        index = np.select(conditions, np.arange(len(results)), default=len(results))
+        if default.shape == (3,) and default.dtype == np.uint8:  # Colors: look the index up in a palette
+            palette = np.stack([np.broadcast_to(result, (3,)) for result in results] + [default])
+            return palette[index]
+        return np.select(conditions, results, default)
+
+    def _construct(self, node):
+        """
+        Evaluates a coverage constructor over one axis, one value of the iterator at a time.
+        """
+        import numpy as np
+        _, variable, _, lower, upper, values = node
+        result = []
+        try:
+            for index in range(lower, upper + 1):
+                self._iterators[variable] = index
+                result.append(self._value(values, None))
+        finally:
+            self._iterators.pop(variable, None)
+        return np.array(result)
+
+    def _row_chunks(self, shape):
+        """
+        Yields slices over the first axis covering roughly chunk_size cells each.
+        """
+        import numpy as np
+        row_cells = int(np.prod(shape[1:])) if len(shape) > 1 else 1
+        step = max(1, self.chunk_size // max(1, row_cells))
+        for start in range(0, shape[0], step):
+            yield slice(start, min(start + step, shape[0]))
+
+    def _condense(self, operation, node):
+        import numpy as np
+        shape, _ = self._layout(node)
+        if not shape:
+            value = np.asarray(self._value(node, None))
+            chunks = [value]
+        else:
+            chunks = (np.asarray(self._value(node, rows, shape)) for rows in self._row_chunks(shape))
+        total, count, partial = 0, 0, []
+        for chunk in chunks:
+            if operation == 'count':
+                total += int(np.count_nonzero(chunk))
+            elif operation in ('avg', 'add'):
+                total += chunk.sum(dtype=np.float64)
+                count += chunk.size
+            elif operation == 'min':
+                partial.append(chunk.min())
+            else:
+                partial.append(chunk.max())
+        if operation in ('count', 'add'):
+            return total
+        if operation == 'avg':
+            return total / count if count else float('nan')
+        return min(partial) if operation == 'min' else max(partial)
+
+    def _scale(self, node):
+        import numpy as np
+        _, inner, sizes = node
+        _, names = self._layout(inner)
+        value = np.asarray(self._value(inner, None))
+        for axis, name in enumerate(names):
+            if name in sizes:
+                size = value.shape[axis]
+                # Nearest-neighbour resampling onto the requested grid
+                positions = (np.arange(sizes[name]) * size) // sizes[name]
+                value = np.take(value, positions, axis=axis)
+        return value
+
+    def _format_scalar(self, value):
+        import numpy as np
+        value = np.asarray(value)
+        if value.ndim:
+            return self._csv(value).encode()
+        return str(value.item()).encode()
+
+    def _csv(self, value):
+        if value.dtype == bool:
+            value = value.astype(int)
+        if value.ndim == 1:
+            return ','.join(map(str, value.tolist()))
+        return ','.join('{' + self._csv(part) + '}' for part in value)
+
+    def _encode(self, node, mime_type):
+        import io
+        import numpy as np
+        if mime_type == 'text/csv':
+            shape, _ = self._layout(node)
+            if len(shape) < 2 or node[0] == 'scale':
+                return self._format_scalar(self._value(node, None))
+            # Large results are formatted chunk by chunk along the first axis.
+            return ','.join(self._csv(np.asarray(self._value(node, rows, shape))) for rows in self._row_chunks(shape)).encode()
+        from PIL import Image
+        value = np.asarray(self._value(node, None))
+        if value.ndim == 3 and value.shape[-1] == 3:
+            image = Image.fromarray(value.astype(np.uint8), 'RGB')
+        elif value.ndim == 2:
+            image = Image.fromarray(np.clip(value, 0, 255).astype(np.uint8), 'L')
+        else:
+            raise ValueError(f"Only 2D results can be encoded as {mime_type}")
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG' if mime_type == 'image/png' else 'JPEG')
+        return buffer.getvalue()
+
+class ColumnarSink:
+    """
+    Collects scalar and 1-D results of many queries into columns and writes them to Parquet or Arrow in
+    row groups as they arrive, so memory stays bounded however many results a backfill produces. Each
+    row holds one value of a result, its index in the result, the name of the coverage and the bounds of
+    every subset axis:
+
+        coverage | ansi_lower | ansi_upper | Lat_lower | Lat_upper | index | value
+
+    Bounds are stored as text without the quotes of date strings; the upper bound of a slice is null.
+    Values are decoded straight into preallocated NumPy buffers, and the tags of a result are stored once
+    and only repeated for its rows when a row group is written.
+    """
+
+    FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+    def __init__(self, path, axes=None, row_group_size=65536, file_row_groups=None, format=None):
+        """
+        Initializes a ColumnarSink. Files are written under a hidden '.<name>.part' name, which dataset readers
+        skip, and renamed once complete.
+
+        Args:
+            path (str): The file to write, or with file_row_groups the directory that receives the files.
+            axes (list of str, optional): The names of the axes to tag rows with. Defaults to the axes of
+                                          the first result.
+            row_group_size (int): The number of rows buffered and written as one row group.
+            file_row_groups (int, optional): Write a directory of files, part-00000.parquet, ..., and start a
+                                             new file after this many row groups. Every finished file is
+                                             readable on its own, so a crash only loses the current one.
+                                             The partial files of a crashed run are removed when the sink
+                                             opens its first file, so only one sink may write a directory.
+            format (str, optional): 'parquet' or 'arrow' (the Arrow IPC file format). Defaults to 'arrow'
+                                    for paths ending in '.arrow' or '.feather', and 'parquet' otherwise.
+
+        Raises:
+            ValueError: If the row group size is not positive or the format is unknown.
+            ImportError: If pyarrow is not installed.
+        """
+        import numpy as np
+        import pyarrow  # Fail when the sink is created rather than at the first row group
+        if row_group_size < 1:
+            raise ValueError("row_group_size must be at least 1")
+        if format is None:
+            format = 'arrow' if str(path).endswith(('.arrow', '.feather')) else 'parquet'
+        if format not in self.FORMATS:
+            raise ValueError(f"Unknown format '{format}'. Valid formats are: {', '.join(self.FORMATS)}")
+        self.path = path
+        self.axes = list(axes) if axes is not None else None
+        self.row_group_size = row_group_size
+        self.file_row_groups = file_row_groups
+        self.format = format
+        self.files = []  # The finished files, in the order they were written
+        self.rows_written = 0
+        self._values = np.empty(row_group_size)
+        self._index = np.empty(row_group_size, dtype=np.int64)
+        self._rows = 0
+        self._runs = []  # (row count, tags) for the buffered rows, in order
+        self._keys = []  # Keys of the results whose last rows are in the current file
+        self._schema = None
+        self._writer = None
+        self._file_groups = 0
+        self._part = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _build_schema(self, axes):
+        import pyarrow as pa
+        if self.axes is None:
+            self.axes = axes
+        fields = [('coverage', pa.string())]
+        for name in self.axes:
+            fields += [(f'{name}_lower', pa.string()), (f'{name}_upper', pa.string())]
+        self._schema = pa.schema(fields + [('index', pa.int64()), ('value', pa.float64())])
+
+    def _tags(self, coverage, axes):
+        """
+        Returns the tag values of a result in column order, fixing the axes of the sink if needed.
+        """
+        bounds = {axis.name: axis for axis in axes}
+        if self._schema is None:
+            self._build_schema(list(bounds))
+        unknown = [name for name in bounds if name not in self.axes]
+        if unknown:
+            raise ValueError(f"Axis '{unknown[0]}' is not one of the axes of the sink: {', '.join(self.axes)}")
+        tags = [getattr(coverage, 'name', coverage)]
+        for name in self.axes:
+            axis = bounds.get(name)
+            for bound in (None, None) if axis is None else (axis.lower_bound, axis.upper_bound):
+                tags.append(None if bound is None else str(bound).strip('"\''))
+        return tuple(tags)
+
+    def add(self, result, coverage, axes=None, key=None):
+        """
+        Adds the values of one result.
+
+        Args:
+            result: The raw CSV content of the response, or an already decoded number or array.
+            coverage (Coverage or str): The coverage the result belongs to, or its name.
+            axes (list of Axis, optional): The subset of the result. Defaults to the axes of the coverage.
+            key (optional): Identifies the result in the commits returned once its file is finished.
+
+        Returns:
+            list: A (path, keys) pair for every file finished by this call; usually empty.
+
+        Raises:
+            ValueError: If the result has more than one dimension, an axis is not one of the sink's axes,
+                        or the sink is closed.
+        """
+        import numpy as np
+        if isinstance(result, (bytes, bytearray, str)):
+            values = decode_csv(result)
+        else:
+            values = np.asarray(result, dtype=float)
+        if sum(size > 1 for size in values.shape) > 1:
+            raise ValueError(f"Only scalar and 1-D results can be added to a ColumnarSink, not shape {values.shape}")
+        values = values.reshape(-1)
+        if axes is None:
+            axes = getattr(coverage, 'axes', ())
+        with self._lock:
+            if self._closed:
+                raise ValueError("The sink is closed")
+            tags = self._tags(coverage, axes)
+            position = 0
+            while position < len(values):
+                count = min(len(values) - position, self.row_group_size - self._rows)
+                self._values[self._rows:self._rows + count] = values[position:position + count]
+                self._index[self._rows:self._rows + count] = np.arange(position, position + count)
+                self._runs.append((count, tags))
+                self._rows += count
+                position += count
+                if self._rows == self.row_group_size:
+                    self._flush()
+            if key is not None:
+                self._keys.append(key)
+            # Files only end between results, so a result is never split across a crash.
+            if self.file_row_groups and self._file_groups >= self.file_row_groups:
+                return [self._finish()]
+            return []
+
+    def _open(self):
+        import os
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if self.file_row_groups:
+            os.makedirs(self.path, exist_ok=True)
+            if not self.files:  # Remove the partial files a crashed run left behind
+                stale = re.compile(r'\.?part-\d+\..*\.part$')
+                for name in os.listdir(self.path):
+                    if stale.match(name):
+                        os.remove(os.path.join(self.path, name))
+            pattern = re.compile(r'part-(\d+)\.')
+            numbers = [int(match.group(1)) for match in map(pattern.match, os.listdir(self.path)) if match]
+            # Numbering continues after the files of earlier runs, which a resumed batch still relies on.
+            name = f"part-{max(numbers, default=-1) + 1:05d}{self.FORMATS[self.format]}"
+            target = os.path.join(self.path, name)
+        else:
+            target = self.path
+        if self._schema is None:
+            self._build_schema([])
+        directory, name = os.path.split(target)
+        self._part = (target, os.path.join(directory, f".{name}.part"))
+        if self.format == 'parquet':
+            self._writer = pq.ParquetWriter(self._part[1], self._schema)
+        else:
+            self._writer = pa.ipc.new_file(self._part[1], self._schema)
+
+    def _flush(self):
+        """
+        Writes the buffered rows as one row group. Called with the lock held.
+        """
+        import numpy as np
+        import pyarrow as pa
+        if not self._rows:
+            return
+        if self._writer is None:
+            self._open()
+        repeat = pa.array(np.repeat(np.arange(len(self._runs)), [count for count, _ in self._runs]))
+        columns = [pa.array([tags[column] for _, tags in self._runs], type=pa.string()).take(repeat)
+                   for column in range(len(self._schema) - 2)]
+        columns += [pa.array(self._index[:self._rows]), pa.array(self._values[:self._rows])]
+        table = pa.Table.from_arrays(columns, schema=self._schema)
+        if self.format == 'parquet':
+            self._writer.write_table(table, row_group_size=self._rows)
+        else:
+            self._writer.write_table(table)
+        self.rows_written += self._rows
+        self._file_groups += 1
+        self._rows = 0
+        self._runs = []
+
+    def _finish(self):
+        """
+        Writes the remaining rows and completes the current file. Called with the lock held.
+        """
+        import os
+        self._flush()
+        if self._writer is None:
+            self._open()
+        self._writer.close()
+        target, temporary = self._part
+        os.replace(temporary, target)
+        commit = (target, self._keys)
+        self.files.append(target)
+        self._writer = None
+        self._part = None
+        self._keys = []
+        self._file_groups = 0
+        return commit
+
+    def close(self):
+        """
+        Writes the remaining rows and completes the current file. A single-file sink always writes its file,
+        even when no results were added. Further calls do nothing.
+
+        Returns:
+            list: The (path, keys) pair of the file finished by this call, if any.
+        """
+        with self._lock:
+            if self._closed:
+                return []
+            self._closed = True
+            if self.file_row_groups and self._writer is None and not self._rows and not self._keys:
+                return []
+            return [self._finish()]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class BatchRunner:
+    """
+    Runs a batch job: one query per combination of subset values, with the results written to files.
+    Completed items are recorded in a checkpoint journal, so a rerun after a crash skips them.
+
+    A job file is JSON with an optional "server", "parallelism" and "retries", and a list of "jobs":
+
+        {"server": "https://ows.rasdaman.org/rasdaman/ows", "parallelism": 8,
+         "jobs": [{"coverages": ["AvgLandTemp"],
+                   "axes": {"Lat": [35, 75], "Long": [-20, 40], "ansi": {"each": ["\\"2014-01\\"", "\\"2014-02\\""]}},
+                   "operation": "encode", "return_type": "PNG",
+                   "output": "out/{coverage}_{ansi}.png"}]}
+
+    An axis is sliced by a single value, trimmed by a [lower, upper] pair, or given {"each": [...]} values
+    to make one item per value. Each job may also set "expression", a WCPS template in which {c1}, {c2}, ...
+    stand for the subset coverages in order (default "{c1}"), and "count_condition". The output pattern is
+    formatted with {coverage}, {index} and the current value of every axis.
+
+    With a ColumnarSink, scalar and 1-D CSV results are collected into the sink's Parquet or Arrow files
+    instead, tagged with the first coverage and the subset, and jobs need no "output". Items are journaled
+    once the file holding their rows is finished.
+    """
+
+    def __init__(self, jobs, journal_path, dbc, parallelism=4, progress=None, sink=None):
+        """
+        Initializes a BatchRunner.
+
+        Args:
+            jobs (list): The job dictionaries, as in the "jobs" list of a job file.
+            journal_path (str): The checkpoint journal; it is created if it does not exist.
+            dbc: The connection that queries are sent through.
+            parallelism (int): The number of queries in flight at once.
+            progress (file, optional): Receives a live line with throughput and ETA, e.g. sys.stderr.
+            sink (ColumnarSink, optional): Receives the results instead of output files. It must write a
+                                           directory of files (file_row_groups), and run closes it.
+
+        Raises:
+            ValueError: If parallelism is not positive, a job is invalid or the sink writes a single file.
+        """
+        if parallelism < 1:
+            raise ValueError("parallelism must be at least 1")
+        if sink is not None and not sink.file_row_groups:
+            raise ValueError("A sink used by BatchRunner must write a directory of files (file_row_groups), "
+                             "so a rerun does not replace the results of earlier runs")
+        for job in jobs:
+            for key in ('coverages',) if sink is not None else ('coverages', 'output'):
+                if key not in job:
+                    raise ValueError(f"Every job needs '{key}'")
+        self.jobs = jobs
+        self.journal_path = journal_path
+        self.dbc = dbc
+        self.parallelism = parallelism
+        self.progress = progress
+        self.sink = sink
+
+    @classmethod
+    def from_file(cls, path, journal_path=None, dbc=None, parallelism=None, progress=None, sink=None):
+        """
+        Reads a job file. Arguments that are not None override the settings of the file.
+
+        Args:
+            path (str): The JSON job file.
+            journal_path (str, optional): Defaults to the job file's path with '.journal' appended.
+            dbc (optional): Defaults to a DatabaseConnection to the file's "server" with its "retries".
+            parallelism (int, optional): Defaults to the file's "parallelism", or 4.
+            progress (file, optional): As for BatchRunner.
+            sink (ColumnarSink, optional): As for BatchRunner.
+
+        Returns:
+            BatchRunner: The runner for the file.
+        """
+        import json
+        with open(path) as file:
+            settings = json.load(file)
+        if dbc is None:
+            if 'server' not in settings:
+                raise ValueError("The job file has no 'server'")
+            dbc = DatabaseConnection(settings['server'], retries=settings.get('retries', 0))
+        return cls(settings.get('jobs', []), journal_path or f"{path}.journal", dbc,
+                   parallelism or settings.get('parallelism', 4), progress, sink)
+
+    def items(self):
+        """
+        Generates the query of every item. Queries are generated one at a time, in this thread.
+
+        Yields:
+            tuple: The journal key, the query string, the output path ('' without an "output"), the Query
+                   that sends it and the Axis objects of the subset.
+        """
+        import hashlib
+        import itertools
+        for job in self.jobs:
+            query = Query(self.dbc)
+            coverages = []
+            for position, name in enumerate(job['coverages'], start=1):
+                coverage = Coverage(name)
+                coverage.variable = f'c{position}'  # Stable names, so the expression template can refer to them
+                coverages.append(coverage)
+                query.add_coverage(coverage)
+            if job.get('operation'):
+                query.set_operation(job['operation'])
+            if job.get('return_type'):
+                query.set_return(job['return_type'])
+            if job.get('count_condition'):
+                query.set_count_condition(job['count_condition'])
+            axes = job.get('axes', {})
+            varying = [name for name, value in axes.items() if isinstance(value, dict)]
+            combinations = itertools.product(*[axes[name]['each'] for name in varying])
+            for index, values in enumerate(combinations):
+                current = dict(zip(varying, values))
+                subset = []
+                for name, value in axes.items():
+                    value = current.get(name, value)
+                    if isinstance(value, list):
+                        subset.append(Axis(name, value[0], value[1]))
+                    else:
+                        subset.append(Axis(name, value))
+                for coverage in coverages:
+                    if subset:
+                        coverage.set_subset(*subset)
+                expression = job.get('expression', '{c1}').format(
+                    **{coverage.variable: str(coverage) for coverage in coverages})
+                text = query.generate_query(expression)
+                fields = {name: re.sub(r'[^\w.-]+', '_', str(value).strip('"\'')) for name, value in axes.items()
+                          if not isinstance(value, (list, dict))}
+                fields.update({name: re.sub(r'[^\w.-]+', '_', str(value).strip('"\'')) for name, value in current.items()})
+                output = job['output'].format(coverage=coverages[0].name, index=index, **fields) if 'output' in job else ''
+                key = hashlib.sha1(f"{text}\n{output}".encode()).hexdigest()
+                yield key, text, output, query, subset
+
+    def completed(self):
+        """
+        Returns the journal keys of the items that completed in earlier runs and whose output still exists.
+        """
+        import json
+        import os
+        done = set()
+        if not os.path.exists(self.journal_path):
+            return done
+        with open(self.journal_path) as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # A line cut short by a crash
+                if os.path.exists(entry['output']):
+                    done.add(entry['key'])
+        return done
+
+    def _run_item(self, text, output, query):
+        import os
+        content = query.send_query(text)
+        if isinstance(content, str):
+            raise RuntimeError(content)
+        if self.sink is not None:
+            return len(content), decode_csv(content)  # Decoded here, on the worker thread
+        directory = os.path.dirname(output)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = f"{output}.part"
+        with open(temporary, 'wb') as file:
+            file.write(content)
+        os.replace(temporary, output)  # A crash never leaves a truncated output behind
+        return len(content), None
+
+    def run(self):
+        """
+        Runs every item that is not in the journal yet, with up to parallelism queries in flight.
+
+        Returns:
+            dict: The number of 'completed', 'skipped' and 'failed' items, the 'bytes' written and the 'seconds' taken.
+        """
+        import json
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        done = self.completed()
+        items = list(self.items())
+        pending_items = [item for item in items if item[0] not in done]
+        summary = {'completed': 0, 'skipped': len(items) - len(pending_items), 'failed': 0, 'bytes': 0}
+        start = time.perf_counter()
+        last_report = 0.0
+        if self.sink is not None and self.sink.axes is None:
+            # Every job shares the sink's columns, so they cover the axes of all jobs.
+            self.sink.axes = list(dict.fromkeys(name for job in self.jobs for name in job.get('axes', {})))
+        uncommitted = {}  # Key -> bytes of the items whose rows are not in a finished file yet
+
+        def journal_commits(commits):
+            for path, keys in commits:
+                for key in keys:
+                    journal.write(json.dumps({'key': key, 'output': path, 'bytes': uncommitted.pop(key)}) + '\n')
+            journal.flush()
+
+        with open(self.journal_path, 'a') as journal, ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            in_flight = {}
+            queue = iter(pending_items)
+            while True:
+                for key, text, output, query, subset in queue:
+                    in_flight[executor.submit(self._run_item, text, output, query)] = (key, output, query, subset)
+                    if len(in_flight) >= 2 * self.parallelism:
+                        break  # Keep memory bounded for large backfills
+                if not in_flight:
+                    break
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    key, output, query, subset = in_flight.pop(future)
+                    try:
+                        size, values = future.result()
+                        if self.sink is not None:
+                            uncommitted[key] = size
+                            try:
+                                journal_commits(self.sink.add(values, query.coverages[0].name, subset, key=key))
+                            except ValueError:
+                                del uncommitted[key]
+                                raise
+                    except Exception as err:
+                        summary['failed'] += 1
+                        print(f"An error occurred for {output or text}: {err}")
+                        continue
+                    if self.sink is None:
+                        journal.write(json.dumps({'key': key, 'output': output, 'bytes': size}) + '\n')
+                        journal.flush()
+                    summary['completed'] += 1
+                    summary['bytes'] += size
+                now = time.perf_counter()
+                if self.progress is not None and now - last_report >= 0.5:
+                    last_report = now
+                    self._report(summary, len(pending_items), now - start)
+            if self.sink is not None:
+                journal_commits(self.sink.close())
+        summary['seconds'] = time.perf_counter() - start
+        if self.progress is not None:
+            self._report(summary, len(pending_items), summary['seconds'])
+            print(file=self.progress)
+        return summary
+
+    def _report(self, summary, total, elapsed):
+        finished = summary['completed'] + summary['failed']
+        rate = finished / elapsed if elapsed > 0 else 0.0
+        eta = (total - finished) / rate if rate > 0 else float('inf')
+        eta_text = time.strftime('%H:%M:%S', time.gmtime(eta)) if eta != float('inf') else '--:--:--'
+        print(f"\r{finished}/{total} items ({summary['skipped']} skipped, {summary['failed']} failed), "
+              f"{rate:.1f} items/s, {summary['bytes'] / max(elapsed, 1e-9) / 1e6:.2f} MB/s, ETA {eta_text}",
+              end='', file=self.progress, flush=True)
+
+def main(argv=None):
+    """
+    The wdc command line: runs a batch job file with BatchRunner. Returns 0 if every item succeeded.
+    """
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(prog='wdc', description="Run a resumable batch of WCPS queries from a job file.")
+    parser.add_argument('jobfile', help="The JSON job file.")
+    parser.add_argument('--parallelism', type=int, help="Queries in flight at once (overrides the job file).")
+    parser.add_argument('--journal', help="The checkpoint journal (default: the job file with '.journal' appended).")
+    parser.add_argument('--server', help="The server URL (overrides the job file).")
+    parser.add_argument('--retries', type=int, help="Retries of failed requests (overrides the job file).")
+    parser.add_argument('--sink', help="Collect scalar and 1-D results into Parquet files in this directory "
+                                       "instead of writing outputs.")
+    parser.add_argument('--row-group-size', type=int, default=65536, help="Rows per row group of the sink.")
+    parser.add_argument('--file-row-groups', type=int, default=16, help="Row groups per file of the sink.")
+    parser.add_argument('--dry-run', action='store_true', help="Print the queries and outputs without sending anything.")
+    parser.add_argument('--quiet', action='store_true', help="Do not print progress.")
+    args = parser.parse_args(argv)
+    dbc = None
+    if args.server or args.retries is not None:
+        import json
+        with open(args.jobfile) as file:
+            settings = json.load(file)
+        dbc = DatabaseConnection(args.server or settings.get('server'),
+                                 retries=args.retries if args.retries is not None else settings.get('retries', 0))
+    sink = None
+    if args.sink:
+        sink = ColumnarSink(args.sink, row_group_size=args.row_group_size, file_row_groups=args.file_row_groups)
+    runner = BatchRunner.from_file(args.jobfile, args.journal, dbc, args.parallelism,
+                                   None if args.quiet else sys.stderr, sink)
+    if args.dry_run:
+        done = runner.completed()
+        for key, text, output, _, _ in runner.items():
+            print(f"{'skip' if key in done else 'run '} {output or args.sink}\n{text}\n")
+        return 0
+    summary = runner.run()
+    print(f"{summary['completed']} completed, {summary['skipped']} skipped, {summary['failed']} failed, "
+          f"{summary['bytes']} bytes in {summary['seconds']:.1f} s")
+    return 1 if summary['failed'] else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
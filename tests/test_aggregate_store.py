@@ -0,0 +1,117 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+import sys
+sys.path.append('../src/wdc')
+import numpy as np
+from wdc import AggregateStore, PartialAggregate, LocalConnection, LocalCube, Query, Coverage, Axis
+
+MONTHS = [f"2014-{month:02d}" for month in range(1, 13)] + [f"2015-{month:02d}" for month in range(1, 13)]
+PERIODS = [f'"{month}"' for month in MONTHS]
+
+class TestPartialAggregate(unittest.TestCase):
+    def test_merge_and_values(self):
+        # Test combining partial aggregates and reading aggregates from them
+        combined = PartialAggregate(10.0, 4, 1.0, 4.0).merge(PartialAggregate(5.0, 1, 5.0, 5.0))
+        self.assertEqual(combined, PartialAggregate(15.0, 5, 1.0, 5.0))
+        self.assertEqual(combined.value('avg'), 3.0)
+        self.assertEqual(combined.value('max'), 5.0)
+        self.assertTrue(np.isnan(PartialAggregate().value('avg')))
+        with self.assertRaises(ValueError):
+            combined.value('median')
+
+class TestAggregateStore(unittest.TestCase):
+    def setUp(self):
+        # Reset coverage counter for each test and build a two-year cube
+        Coverage.coverage_counter = 1
+        self.data = np.random.default_rng(1).uniform(-5, 30, (24, 10, 8))
+        cube = LocalCube(self.data, [("ansi", MONTHS), ("Lat", np.arange(10.0)), ("Long", np.arange(8.0))])
+        self.coverage = Coverage("AvgLandTemp")
+        self.coverage.set_subset(Axis("Lat", 2, 5))
+        self.query = Query(LocalConnection({"AvgLandTemp": cube}))
+        self.query.add_coverage(self.coverage)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "partials.json")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_period_keys(self):
+        # Test that each period is keyed by the query selecting it, and the subset is restored
+        keys = AggregateStore().period_keys(self.query, self.coverage, self.coverage, "ansi", PERIODS[:2])
+        self.assertEqual(keys[0], 'for $AvgLandTemp in (AvgLandTemp)\nreturn $AvgLandTemp[Lat(2:5), ansi("2014-01")]')
+        self.assertEqual(self.coverage.subset, "[Lat(2:5)]")
+
+    def test_rolling(self):
+        # Test a rolling 12-month average against NumPy
+        store = AggregateStore()
+        results = store.rolling(self.query, self.coverage, self.coverage + 1, "ansi", PERIODS, 12)
+        self.assertEqual(len(results), 13)
+        for end, (period, value) in enumerate(results, start=11):
+            self.assertEqual(period, PERIODS[end])
+            self.assertAlmostEqual(value, (self.data[end - 11:end + 1, 2:6] + 1).mean())
+        self.assertEqual(len(store), 24)
+
+    def test_only_missing_periods_fetched(self):
+        # Test that the next month's window costs the queries of one period
+        store = AggregateStore()
+        store.aggregate(self.query, self.coverage, self.coverage, "ansi", PERIODS[:12])
+        with patch.object(self.query, "send_query", wraps=self.query.send_query) as mock_send:
+            maximum = store.aggregate(self.query, self.coverage, self.coverage, "ansi", PERIODS[1:13], 'max')
+        self.assertEqual(mock_send.call_count, 2)
+        self.assertAlmostEqual(maximum, self.data[1:13, 2:6].max())
+
+    def test_keys_independent_of_variables(self):
+        # Test that a new Coverage object for the same data finds the stored partials
+        store = AggregateStore()
+        store.aggregate(self.query, self.coverage, self.coverage + 1, "ansi", PERIODS[:12])
+        Coverage("Other")
+        coverage = Coverage("AvgLandTemp")
+        coverage.set_subset(Axis("Lat", 2, 5))
+        query = Query(self.query.dbc)
+        query.add_coverage(coverage)
+        self.assertNotEqual(coverage.variable, self.coverage.variable)
+        with patch.object(query, "send_query", wraps=query.send_query) as mock_send:
+            average = store.aggregate(query, coverage, coverage + 1, "ansi", PERIODS[:12])
+        mock_send.assert_not_called()
+        self.assertAlmostEqual(average, (self.data[:12, 2:6] + 1).mean())
+
+    def test_duplicate_names_keyed_apart(self):
+        # Test that two coverages of the same name in one query keep distinct variables in the key
+        other = Coverage("AvgLandTemp")
+        other.set_subset(Axis("Lat", 0, 1), Axis("ansi", '"2014-01"'))
+        self.query.add_coverage(other)
+        key = AggregateStore().period_keys(self.query, self.coverage, self.coverage - other, "ansi", PERIODS[:1])[0]
+        self.assertIn('$AvgLandTemp#1[Lat(2:5), ansi("2014-01")] - $AvgLandTemp#2[Lat(0:1), ansi("2014-01")]', key)
+
+    def test_persistence(self):
+        # Test that partials saved to JSON are reused by a new store
+        AggregateStore(self.path).aggregate(self.query, self.coverage, self.coverage, "ansi", PERIODS[:3])
+        store = AggregateStore(self.path)
+        self.assertEqual(len(store), 3)
+        with patch.object(self.query, "send_query") as mock_send:
+            total = store.aggregate(self.query, self.coverage, self.coverage, "ansi", PERIODS[:3], 'sum')
+        mock_send.assert_not_called()
+        self.assertAlmostEqual(total, self.data[:3, 2:6].sum())
+
+    def test_failed_fetch(self):
+        # Test that failures raise and leave nothing stored for the failed period
+        store = AggregateStore()
+        with patch.object(self.query, "send_query", return_value="Query execution failed or no response."):
+            with self.assertRaises(RuntimeError):
+                store.aggregate(self.query, self.coverage, self.coverage, "ansi", PERIODS[:1])
+        self.assertEqual(len(store), 0)
+
+    def test_invalid_arguments(self):
+        # Test the validation of windows and operations
+        store = AggregateStore()
+        with self.assertRaises(ValueError):
+            store.rolling(self.query, self.coverage, self.coverage, "ansi", PERIODS, 0)
+        with self.assertRaises(ValueError):
+            store.aggregate(self.query, self.coverage, self.coverage, "ansi", PERIODS, 'median')
+        with self.assertRaises(ValueError):
+            store.save()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+import sys
+sys.path.append('../src/wdc')
+import numpy as np
+from wdc import BatchRunner, LocalConnection, LocalCube, Coverage, decode_csv, main
+
+MONTHS = [f"2014-{month:02d}" for month in range(1, 13)]
+
+class TestBatchRunner(unittest.TestCase):
+    def setUp(self):
+        # Reset coverage counter for each test and prepare a local cube and a job
+        Coverage.coverage_counter = 1
+        self.data = np.random.default_rng(3).uniform(-10, 40, (12, 6, 5))
+        cube = LocalCube(self.data, [("ansi", MONTHS), ("Lat", np.arange(6.0)), ("Long", np.arange(5.0))])
+        self.dbc = LocalConnection({"AvgLandTemp": cube})
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = self.directory.name
+        self.jobs = [{
+            "coverages": ["AvgLandTemp"],
+            "axes": {"Lat": [1, 4], "ansi": {"each": [f'"{month}"' for month in MONTHS[:6]]}},
+            "expression": "{c1} + 273.15",
+            "operation": "encode",
+            "return_type": "CSV",
+            "output": os.path.join(self.root, "out", "{coverage}_{ansi}.csv"),
+        }]
+        self.journal = os.path.join(self.root, "job.journal")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_items(self):
+        # Test expanding the axes into one query and output per value
+        runner = BatchRunner(self.jobs, self.journal, self.dbc)
+        items = list(runner.items())
+        self.assertEqual(len(items), 6)
+        key, text, output, _, subset = items[1]
+        self.assertEqual(text, 'for $c1 in (AvgLandTemp)\nreturn encode($c1[Lat(1:4), ansi("2014-02")] + 273.15, "text/csv")')
+        self.assertEqual(output, os.path.join(self.root, "out", "AvgLandTemp_2014-02.csv"))
+        self.assertEqual([str(axis) for axis in subset], ['Lat(1:4)', 'ansi("2014-02")'])
+
+    def test_run_writes_outputs_and_journal(self):
+        # Test that every item is written and journaled
+        progress = io.StringIO()
+        summary = BatchRunner(self.jobs, self.journal, self.dbc, parallelism=3, progress=progress).run()
+        self.assertEqual((summary['completed'], summary['skipped'], summary['failed']), (6, 0, 0))
+        with open(os.path.join(self.root, "out", "AvgLandTemp_2014-03.csv"), 'rb') as file:
+            np.testing.assert_allclose(decode_csv(file.read()), self.data[2, 1:5] + 273.15)
+        with open(self.journal) as file:
+            self.assertEqual(len(file.readlines()), 6)
+        self.assertIn("6/6 items", progress.getvalue())
+        self.assertIn("ETA", progress.getvalue())
+
+    def test_rerun_skips_completed(self):
+        # Test that a rerun only runs items that are missing from the journal or whose output was deleted
+        BatchRunner(self.jobs, self.journal, self.dbc).run()
+        os.remove(os.path.join(self.root, "out", "AvgLandTemp_2014-05.csv"))
+        with open(self.journal, 'a') as file:
+            file.write('{"key": "cut sh')  # A line interrupted by a crash
+        with patch.object(self.dbc, "send_request", wraps=self.dbc.send_request) as mock_send:
+            summary = BatchRunner(self.jobs, self.journal, self.dbc).run()
+        self.assertEqual((summary['completed'], summary['skipped']), (1, 5))
+        self.assertEqual(mock_send.call_count, 1)
+
+    def test_failures_are_not_journaled(self):
+        # Test that failed items are counted and retried by the next run
+        self.jobs[0]["axes"]["Height"] = 1
+        summary = BatchRunner(self.jobs, self.journal, self.dbc).run()
+        self.assertEqual((summary['completed'], summary['failed']), (0, 6))
+        self.assertEqual(BatchRunner(self.jobs, self.journal, self.dbc).completed(), set())
+
+    def test_invalid_job(self):
+        # Test the validation of jobs and parallelism
+        with self.assertRaises(ValueError):
+            BatchRunner([{"coverages": ["AvgLandTemp"]}], self.journal, self.dbc)
+        with self.assertRaises(ValueError):
+            BatchRunner(self.jobs, self.journal, self.dbc, parallelism=0)
+
+    def test_command_line(self):
+        # Test the command line with a job file, against a mocked server
+        path = os.path.join(self.root, "job.json")
+        with open(path, 'w') as file:
+            json.dump({"server": "https://ows.rasdaman.org/rasdaman/ows", "parallelism": 2, "jobs": self.jobs}, file)
+        with patch('wdc.DatabaseConnection.send_request', return_value=MagicMock(content=b"1,2,3,4")) as mock_send, \
+                patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            self.assertEqual(main([path, '--quiet']), 0)
+            self.assertEqual(main([path, '--quiet']), 0)
+        self.assertEqual(mock_send.call_count, 6)
+        self.assertIn("0 completed, 6 skipped", stdout.getvalue())
+        self.assertTrue(os.path.exists(path + ".journal"))
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            self.assertEqual(main([path, '--dry-run']), 0)
+        self.assertIn("skip ", stdout.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
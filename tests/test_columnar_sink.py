@@ -0,0 +1,177 @@
+import importlib.util
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+import sys
+sys.path.append('../src/wdc')
+import numpy as np
+from wdc import ColumnarSink, BatchRunner, LocalConnection, LocalCube, Coverage, Axis, main
+
+MONTHS = [f"2014-{month:02d}" for month in range(1, 13)]
+
+@unittest.skipUnless(importlib.util.find_spec('pyarrow'), "pyarrow is not installed")
+class TestColumnarSink(unittest.TestCase):
+    def setUp(self):
+        # Reset coverage counter for each test and prepare a coverage and a directory
+        Coverage.coverage_counter = 1
+        self.coverage = Coverage("AvgLandTemp")
+        self.coverage.set_subset(Axis("Lat", 1, 4), Axis("ansi", '"2014-01"'))
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if path.endswith('.arrow'):
+            with pa.ipc.open_file(path) as reader:
+                return reader.read_all()
+        return pq.read_table(path)
+
+    def test_rows_are_tagged(self):
+        # Test that scalar and 1-D results become tagged rows in one Parquet file
+        import pyarrow.parquet as pq
+        path = os.path.join(self.root, "results.parquet")
+        with ColumnarSink(path, row_group_size=4) as sink:
+            sink.add(b"1.5,2.5,3.5", self.coverage)
+            sink.add(b"7", "Precipitation", [Axis("ansi", '"2014-02"')])
+            sink.add(np.arange(3.0), self.coverage, [Axis("Lat", 2, 3), Axis("ansi", '"2014-03"')])
+        table = self.read(path).to_pydict()
+        self.assertEqual(table['coverage'], ["AvgLandTemp"] * 3 + ["Precipitation"] + ["AvgLandTemp"] * 3)
+        self.assertEqual(table['Lat_lower'], ['1', '1', '1', None, '2', '2', '2'])
+        self.assertEqual(table['ansi_lower'], ['2014-01'] * 3 + ['2014-02'] + ['2014-03'] * 3)
+        self.assertEqual(table['ansi_upper'], [None] * 7)
+        self.assertEqual(table['index'], [0, 1, 2, 0, 0, 1, 2])
+        self.assertEqual(table['value'], [1.5, 2.5, 3.5, 7.0, 0.0, 1.0, 2.0])
+        self.assertEqual(pq.ParquetFile(path).metadata.num_row_groups, 2)
+        self.assertEqual(sink.rows_written, 7)
+        self.assertEqual(sink.files, [path])
+
+    def test_arrow_format(self):
+        # Test that paths ending in .arrow are written in the Arrow IPC file format
+        path = os.path.join(self.root, "results.arrow")
+        with ColumnarSink(path) as sink:
+            sink.add(b"{1,2,3}", self.coverage)  # A 1x3 result is one-dimensional
+        self.assertEqual(self.read(path).column('value').to_pylist(), [1.0, 2.0, 3.0])
+
+    def test_files_are_rotated(self):
+        # Test that a directory sink finishes a file after file_row_groups and reports its keys
+        sink = ColumnarSink(self.root, row_group_size=3, file_row_groups=2)
+        commits = [sink.add([index, index], self.coverage, key=index) for index in range(5)]
+        self.assertEqual(commits[:2], [[], []])
+        self.assertEqual(commits[2], [(os.path.join(self.root, "part-00000.parquet"), [0, 1, 2])])
+        self.assertEqual(sink.close(), [(os.path.join(self.root, "part-00001.parquet"), [3, 4])])
+        self.assertEqual(self.read(os.path.join(self.root, "part-00001.parquet")).column('value').to_pylist(),
+                         [3.0, 3.0, 4.0, 4.0])
+        self.assertFalse([name for name in os.listdir(self.root) if name.endswith('.part')])
+        with ColumnarSink(self.root, file_row_groups=2) as sink:
+            sink.add(b"1", self.coverage)
+        self.assertTrue(os.path.exists(os.path.join(self.root, "part-00002.parquet")))
+
+    def test_crashed_writer_leaves_readable_directory(self):
+        # Test that a writer killed mid-file leaves a directory that reads and that the next sink cleans up
+        import subprocess
+        import pyarrow.parquet as pq
+        script = (f"import os, sys\nsys.path[:0] = {sys.path!r}\nfrom wdc import ColumnarSink\n"
+                  f"sink = ColumnarSink({self.root!r}, row_group_size=2, file_row_groups=1)\n"
+                  "sink.add([1.0, 2.0], 'AvgLandTemp', [])\nsink.add([3.0], 'AvgLandTemp', [])\n"
+                  "sink._lock.acquire()\nsink._flush()\nos.kill(os.getpid(), 9)\n")
+        subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(sorted(os.listdir(self.root)), [".part-00001.parquet.part", "part-00000.parquet"])
+        self.assertEqual(pq.read_table(self.root).column('value').to_pylist(), [1.0, 2.0])
+        with ColumnarSink(self.root, file_row_groups=1) as sink:
+            sink.add(b"4", self.coverage)
+        self.assertEqual(sorted(os.listdir(self.root)), ["part-00000.parquet", "part-00001.parquet"])
+        self.assertEqual(pq.read_table(self.root).column('value').to_pylist(), [1.0, 2.0, 4.0])
+
+    def test_invalid_results(self):
+        # Test that multidimensional results, unknown axes and closed sinks are rejected
+        sink = ColumnarSink(os.path.join(self.root, "results.parquet"), axes=["Lat", "ansi"])
+        with self.assertRaises(ValueError):
+            sink.add(b"{1,2},{3,4}", self.coverage)
+        with self.assertRaises(ValueError):
+            sink.add(b"1", self.coverage, [Axis("Long", 5)])
+        sink.close()
+        with self.assertRaises(ValueError):
+            sink.add(b"1", self.coverage)
+        self.assertEqual(self.read(sink.path).num_rows, 0)
+        with self.assertRaises(ValueError):
+            ColumnarSink(self.root, row_group_size=0)
+        with self.assertRaises(ValueError):
+            ColumnarSink(self.root, format='csv')
+
+@unittest.skipUnless(importlib.util.find_spec('pyarrow'), "pyarrow is not installed")
+class TestBatchRunnerSink(unittest.TestCase):
+    def setUp(self):
+        # Reset coverage counter for each test and prepare a local cube and a job without outputs
+        Coverage.coverage_counter = 1
+        self.data = np.random.default_rng(3).uniform(-10, 40, (12, 6, 5))
+        cube = LocalCube(self.data, [("ansi", MONTHS), ("Lat", np.arange(6.0)), ("Long", np.arange(5.0))])
+        self.dbc = LocalConnection({"AvgLandTemp": cube})
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = self.directory.name
+        self.jobs = [{
+            "coverages": ["AvgLandTemp"],
+            "axes": {"Lat": [1, 4], "Long": 2, "ansi": {"each": [f'"{month}"' for month in MONTHS[:6]]}},
+            "operation": "encode",
+            "return_type": "CSV",
+        }]
+        self.journal = os.path.join(self.root, "job.journal")
+        self.sink_path = os.path.join(self.root, "sink")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def table(self):
+        import pyarrow.parquet as pq
+        return pq.read_table(self.sink_path).sort_by([('ansi_lower', 'ascending'), ('index', 'ascending')])
+
+    def test_run_collects_results(self):
+        # Test that every result ends up in the sink and is journaled with its file
+        sink = ColumnarSink(self.sink_path, row_group_size=8, file_row_groups=1)
+        summary = BatchRunner(self.jobs, self.journal, self.dbc, parallelism=3, sink=sink).run()
+        self.assertEqual((summary['completed'], summary['failed']), (6, 0))
+        table = self.table()
+        self.assertEqual(table.num_rows, 24)
+        np.testing.assert_allclose(table.column('value').to_numpy(), self.data[:6, 1:5, 2].ravel())
+        self.assertEqual(set(table.column('Long_lower').to_pylist()), {'2'})
+        with open(self.journal) as file:
+            entries = [json.loads(line) for line in file]
+        self.assertEqual(len(entries), 6)
+        self.assertTrue(all(entry['output'] in sink.files for entry in entries))
+
+    def test_rerun_skips_committed(self):
+        # Test that a rerun only repeats the items whose file is missing
+        sink = ColumnarSink(self.sink_path, row_group_size=8, file_row_groups=1)
+        BatchRunner(self.jobs, self.journal, self.dbc, parallelism=1, sink=sink).run()
+        os.remove(sink.files[0])
+        sink = ColumnarSink(self.sink_path, row_group_size=8, file_row_groups=1)
+        summary = BatchRunner(self.jobs, self.journal, self.dbc, parallelism=1, sink=sink).run()
+        self.assertEqual((summary['completed'], summary['skipped']), (2, 4))
+        self.assertEqual(self.table().num_rows, 24)
+
+    def test_single_file_sink_rejected(self):
+        # Test that a sink writing a single file cannot be resumed and is rejected
+        with self.assertRaises(ValueError):
+            BatchRunner(self.jobs, self.journal, self.dbc, sink=ColumnarSink(os.path.join(self.root, "one.parquet")))
+        with self.assertRaises(ValueError):
+            BatchRunner(self.jobs, self.journal, self.dbc)
+
+    def test_command_line(self):
+        # Test the --sink option of the command line, against a mocked server
+        path = os.path.join(self.root, "job.json")
+        with open(path, 'w') as file:
+            json.dump({"server": "https://ows.rasdaman.org/rasdaman/ows", "jobs": self.jobs}, file)
+        with patch('wdc.DatabaseConnection.send_request', return_value=MagicMock(content=b"1,2,3,4")), \
+                patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            self.assertEqual(main([path, '--quiet', '--sink', self.sink_path]), 0)
+        self.assertIn("6 completed", stdout.getvalue())
+        self.assertEqual(self.table().num_rows, 24)
+
+if __name__ == '__main__':
+    unittest.main()
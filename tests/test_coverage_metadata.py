@@ -0,0 +1,245 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import sys
+sys.path.append('../src/wdc')
+import numpy as np
+from wdc import (CoverageMetadata, AxisExtent, MetadataCache, DatabaseConnection, LocalConnection, LocalCube,
+                 QueryResponse, Query, Coverage, Axis)
+
+DESCRIBE_COVERAGE = b'''<?xml version="1.0" encoding="UTF-8"?>
+<wcs:CoverageDescriptions xmlns:wcs="http://www.opengis.net/wcs/2.0" xmlns:gml="http://www.opengis.net/gml/3.2" xmlns:gmlcov="http://www.opengis.net/gmlcov/1.0" xmlns:swe="http://www.opengis.net/swe/2.0" xmlns:gmlrgrid="http://www.opengis.net/gml/3.3/rgrid">
+<wcs:CoverageDescription gml:id="AvgLandTemp">
+<gml:boundedBy><gml:Envelope srsName="x" axisLabels="Lat Long ansi" uomLabels="degree degree d" srsDimension="3">
+<gml:lowerCorner>-90 -180 "2000-02-01T00:00:00.000Z"</gml:lowerCorner>
+<gml:upperCorner>90 180 "2015-06-01T00:00:00.000Z"</gml:upperCorner></gml:Envelope></gml:boundedBy>
+<wcs:CoverageId>AvgLandTemp</wcs:CoverageId>
+<gml:domainSet><gmlrgrid:ReferenceableGridByVectors dimension="3">
+<gml:limits><gml:GridEnvelope><gml:low>0 0 0</gml:low><gml:high>1799 3599 184</gml:high></gml:GridEnvelope></gml:limits>
+<gml:axisLabels>Lat Long ansi</gml:axisLabels>
+<gmlrgrid:generalGridAxis><gmlrgrid:GeneralGridAxis><gmlrgrid:offsetVector srsName="x">-0.1 0 0</gmlrgrid:offsetVector></gmlrgrid:GeneralGridAxis></gmlrgrid:generalGridAxis>
+<gmlrgrid:generalGridAxis><gmlrgrid:GeneralGridAxis><gmlrgrid:offsetVector srsName="x">0 0.1 0</gmlrgrid:offsetVector></gmlrgrid:GeneralGridAxis></gmlrgrid:generalGridAxis>
+<gmlrgrid:generalGridAxis><gmlrgrid:GeneralGridAxis><gmlrgrid:offsetVector srsName="x">0 0 1</gmlrgrid:offsetVector></gmlrgrid:GeneralGridAxis></gmlrgrid:generalGridAxis>
+</gmlrgrid:ReferenceableGridByVectors></gml:domainSet>
+<gmlcov:rangeType><swe:DataRecord><swe:field name="Gray"><swe:Quantity definition="http://www.opengis.net/def/dataType/OGC/0/float32"/></swe:field></swe:DataRecord></gmlcov:rangeType>
+</wcs:CoverageDescription></wcs:CoverageDescriptions>'''
+
+class TestCoverageMetadata(unittest.TestCase):
+    def setUp(self):
+        # Reset coverage counter for each test and parse the description of AvgLandTemp
+        Coverage.coverage_counter = 1
+        self.metadata = CoverageMetadata.from_xml(DESCRIBE_COVERAGE)
+
+    def test_from_xml(self):
+        # Test parsing axes, extents, sizes, directions and cell types
+        self.assertEqual(self.metadata.name, "AvgLandTemp")
+        self.assertEqual([axis.name for axis in self.metadata.axes], ["Lat", "Long", "ansi"])
+        lat, long, ansi = self.metadata.axes
+        self.assertEqual((lat.lower, lat.upper, lat.size), (-90.0, 90.0, 1800))
+        self.assertTrue(lat.descending)
+        self.assertFalse(long.descending)
+        self.assertAlmostEqual(long.resolution, 0.1)
+        self.assertTrue(ansi.temporal)
+        self.assertEqual(ansi.size, 185)
+        self.assertEqual(self.metadata.cell_types, ("float32",))
+        self.assertEqual(self.metadata.cell_bytes, 4)
+
+    def test_from_xml_invalid(self):
+        # Test that documents without a coverage are rejected
+        with self.assertRaises(ValueError):
+            CoverageMetadata.from_xml(b"<ExceptionReport/>")
+        with self.assertRaises(ValueError):
+            CoverageMetadata.from_xml(b"not xml")
+
+    def test_validate(self):
+        # Test that valid subsets pass, including date ranges
+        self.metadata.validate([Axis("Lat", 53.08), Axis("Long", -10, 10), Axis("ansi", '"2014-01"', '"2014-12"')])
+
+    def test_validate_unknown_axis(self):
+        # Test that a misspelt axis name is reported with a suggestion
+        with self.assertRaisesRegex(ValueError, "did you mean 'Lat'"):
+            self.metadata.validate([Axis("lat", 53.08)])
+
+    def test_validate_out_of_range(self):
+        # Test bounds outside the extent, reversed bounds and repeated axes
+        with self.assertRaisesRegex(ValueError, "outside the extent"):
+            self.metadata.validate([Axis("Lat", 100)])
+        with self.assertRaisesRegex(ValueError, "outside the extent"):
+            self.metadata.validate([Axis("ansi", '"1990-01"')])
+        with self.assertRaisesRegex(ValueError, "lower bound above"):
+            self.metadata.validate([Axis("Long", 10, -10)])
+        with self.assertRaisesRegex(ValueError, "more than once"):
+            self.metadata.validate([Axis("Lat", 10), Axis("Lat", 20)])
+
+    def test_set_subset_validates(self):
+        # Test that a coverage with metadata validates its subset immediately
+        coverage = Coverage("AvgLandTemp", metadata=self.metadata)
+        coverage.set_subset(Axis("Lat", 53.08))
+        with self.assertRaises(ValueError):
+            coverage.set_subset(Axis("Lat", 153.08))
+
+    def test_estimate(self):
+        # Test the estimated shape, cells and bytes of subsets
+        subset = [Axis("Lat", 30, 60), Axis("Long", -10, 10), Axis("ansi", '"2014-07"')]
+        self.assertEqual(self.metadata.shape(subset), [("Lat", 301), ("Long", 201)])
+        self.assertEqual(self.metadata.estimate_cells(subset), 301 * 201)
+        self.assertEqual(self.metadata.estimate_bytes(subset), 301 * 201 * 4)
+        self.assertEqual(self.metadata.estimate_bytes(), 1800 * 3600 * 185 * 4)
+
+    def test_axis_extent_bounds(self):
+        # Test that tile bounds lie inside the outer edges of the selected cells
+        extent = AxisExtent("Lat", 0, 10, 10)
+        self.assertEqual(extent.index_range(2, 4), (2, 4))
+        self.assertEqual(extent.index_range(), (0, 9))
+        self.assertEqual(extent.bounds(2, 4), (2.05, 4.95))
+
+class TestMetadataCache(unittest.TestCase):
+    def setUp(self):
+        # Reset coverage counter for each test
+        Coverage.coverage_counter = 1
+        self.transport = MagicMock()
+        self.transport.get.return_value = QueryResponse(DESCRIBE_COVERAGE)
+        self.dbc = DatabaseConnection("https://ows.rasdaman.org/rasdaman/ows", transport=self.transport)
+
+    def test_describe_coverage(self):
+        # Test the DescribeCoverage request of DatabaseConnection
+        metadata = self.dbc.describe_coverage("AvgLandTemp")
+        self.assertEqual(metadata.name, "AvgLandTemp")
+        self.transport.get.assert_called_once_with("https://ows.rasdaman.org/rasdaman/ows", {
+            'SERVICE': 'WCS', 'VERSION': '2.0.1', 'REQUEST': 'DescribeCoverage', 'COVERAGEID': 'AvgLandTemp'})
+
+    def test_describe_coverage_failure(self):
+        # Test that failed requests return None
+        self.transport.get.return_value = QueryResponse(b"Not found", 404)
+        self.assertIsNone(self.dbc.describe_coverage("Missing"))
+
+    def test_cached(self):
+        # Test that a description is fetched once until it expires
+        cache = MetadataCache(self.dbc, ttl=60)
+        self.assertIs(cache.get("AvgLandTemp"), cache.get("AvgLandTemp"))
+        self.assertEqual(self.transport.get.call_count, 1)
+        self.assertIn("AvgLandTemp", cache)
+        cache.invalidate("AvgLandTemp")
+        cache.get("AvgLandTemp")
+        self.assertEqual(self.transport.get.call_count, 2)
+
+    @patch('wdc.time.monotonic')
+    def test_expiry(self, mock_monotonic):
+        # Test that expired descriptions are fetched again
+        mock_monotonic.return_value = 100.0
+        cache = MetadataCache(self.dbc, ttl=10)
+        cache.get("AvgLandTemp")
+        mock_monotonic.return_value = 111.0
+        self.assertNotIn("AvgLandTemp", cache)
+        cache.get("AvgLandTemp")
+        self.assertEqual(self.transport.get.call_count, 2)
+
+    @patch('wdc.time.monotonic')
+    def test_failures_cached_briefly(self, mock_monotonic):
+        # Test that a failed fetch is remembered for negative_ttl seconds and then retried
+        mock_monotonic.return_value = 100.0
+        self.transport.get.return_value = QueryResponse(b"Unavailable", 503)
+        cache = MetadataCache(self.dbc, negative_ttl=5)
+        self.assertIsNone(cache.get("AvgLandTemp"))
+        self.assertIsNone(cache.get("AvgLandTemp"))
+        self.assertEqual(self.transport.get.call_count, 1)
+        self.assertEqual(len(cache), 0)
+        self.assertNotIn("AvgLandTemp", cache)
+        mock_monotonic.return_value = 106.0
+        self.transport.get.return_value = QueryResponse(DESCRIBE_COVERAGE)
+        self.assertEqual(cache.get("AvgLandTemp").name, "AvgLandTemp")
+        self.assertEqual(self.transport.get.call_count, 2)
+        with self.assertRaises(ValueError):
+            MetadataCache(self.dbc, negative_ttl=0)
+
+    def test_undescribed_coverage_fetched_once(self):
+        # Test that executes against a coverage without a description ask for it only once
+        self.transport.post.return_value = QueryResponse(b"1")
+        self.dbc.describe_coverage = MagicMock(return_value=None)
+        coverage = Coverage("AvgLandTemp")
+        cache = MetadataCache(self.dbc)
+        query = Query(self.dbc)
+        query.set_metadata(cache, max_bytes=1000)
+        query.add_coverage(coverage)
+        for operation in ('max', 'encode'):
+            query.set_operation(operation)
+            query.set_return('CSV')
+            for _ in range(3):
+                self.assertEqual(query.execute_query(coverage), b"1")
+        self.dbc.describe_coverage.assert_called_once_with("AvgLandTemp")
+        with patch.object(cache, 'get', wraps=cache.get) as get:
+            query.execute_query(coverage)  # Estimated and validated with one lookup
+        get.assert_called_once_with("AvgLandTemp")
+
+    def test_query_validation(self):
+        # Test that Query validates subsets before generating the query
+        query = Query(self.dbc)
+        query.set_metadata(MetadataCache(self.dbc))
+        coverage = Coverage("AvgLandTemp")
+        coverage.set_subset(Axis("Lon", 8.80))
+        query.add_coverage(coverage)
+        with self.assertRaisesRegex(ValueError, "did you mean 'Long'"):
+            query.generate_query(coverage)
+
+class TestTiledExecution(unittest.TestCase):
+    def setUp(self):
+        # Reset coverage counter for each test and build a cube whose latitudes are stored descending
+        Coverage.coverage_counter = 1
+        self.data = np.arange(12 * 10 * 6, dtype=float).reshape(12, 10, 6)
+        months = [f"2014-{month:02d}" for month in range(1, 13)]
+        cube = LocalCube(self.data, [("ansi", months), ("Lat", np.arange(10, 0, -1.0)), ("Long", np.arange(6) * 0.5)])
+        self.dbc = LocalConnection({"T": cube})
+        self.coverage = Coverage("T")
+        self.coverage.set_subset(Axis("Lat", 2, 8))
+        self.query = Query(self.dbc)
+        self.query.add_coverage(self.coverage)
+        self.query.set_operation("encode")
+        self.query.set_return("CSV")
+
+    def test_describe_local_cube(self):
+        # Test that LocalConnection describes its cubes
+        metadata = self.dbc.describe_coverage("T")
+        lat = metadata.axis("Lat")
+        self.assertEqual((lat.lower, lat.upper, lat.size, lat.descending), (0.5, 10.5, 10, True))
+        self.assertEqual(metadata.cell_types, ("float64",))
+
+    def test_estimate_result(self):
+        # Test the estimated result size for encodings, previews and aggregations
+        self.query.set_metadata(MetadataCache(self.dbc))
+        self.assertEqual(self.query.estimate_result(), (12 * 7 * 6, 12 * 7 * 6 * 8))
+        self.query.set_operation("max")
+        self.assertEqual(self.query.estimate_result(), (1, 8))
+
+    def test_oversized_query_refused(self):
+        # Test that queries estimated above the limit are not sent
+        self.query.set_metadata(MetadataCache(self.dbc), max_bytes=1000)
+        with self.assertRaisesRegex(ValueError, "more than the limit"):
+            self.query.execute_query(self.coverage)
+        with self.assertRaisesRegex(ValueError, "set a tile axis"):
+            self.query.execute_array(self.coverage)
+
+    def test_routed_to_tiles(self):
+        # Test that execute_array splits oversized results and joins them in storage order
+        expected = self.data[:, 2:9, :]
+        self.query.set_metadata(MetadataCache(self.dbc), max_bytes=1000, tile_axis="Lat")
+        with patch.object(self.query, "send_query", wraps=self.query.send_query) as mock_send:
+            result = self.query.execute_array(self.coverage)
+        self.assertEqual(mock_send.call_count, 5)
+        np.testing.assert_array_equal(result, expected)
+        self.assertEqual(self.coverage.subset, "[Lat(2:8)]")  # The subset is restored
+
+    def test_execute_tiled_other_axes(self):
+        # Test tiling along a date axis and an axis without a subset
+        expected = self.data[:, 2:9, :]
+        self.query.set_metadata(MetadataCache(self.dbc))
+        np.testing.assert_array_equal(self.query.execute_tiled(self.coverage, "ansi", 300), expected)
+        np.testing.assert_array_equal(self.query.execute_tiled(self.coverage, "Long", 300), expected)
+
+    def test_execute_tiled_requires_csv(self):
+        # Test that only CSV encodings can be tiled
+        self.query.set_metadata(MetadataCache(self.dbc))
+        self.query.set_return("PNG")
+        with self.assertRaises(ValueError):
+            self.query.execute_tiled(self.coverage, "Lat", 300)
+
+if __name__ == '__main__':
+    unittest.main()
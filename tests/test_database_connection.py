@@ -3,13 +3,13 @@ from unittest.mock import patch, Mock
 from requests.exceptions import HTTPError
 import sys
 sys.path.append('../src/wdc')
-from wdc import DatabaseConnection  # Ensure you import your class correctly
+from wdc import DatabaseConnection, QueryEvent, RequestsTransport  # Ensure you import your class correctly
 
 class TestDatabaseConnection(unittest.TestCase):
     def setUp(self):
         """Setup for all tests; create a DatabaseConnection instance."""
         self.endpoint_url = "https://ows.rasdaman.org/rasdaman/ows"
-        self.db_connection = DatabaseConnection(self.endpoint_url)
+        self.db_connection = DatabaseConnection(self.endpoint_url, transport=RequestsTransport())
 
     @patch('requests.post')  # Make sure to patch 'requests.post' in the correct location
     def test_send_request_success(self, mock_post):
@@ -56,5 +56,38 @@ class TestDatabaseConnection(unittest.TestCase):
         self.assertIsNone(response)
         mock_post.assert_called_once_with(self.endpoint_url, data={'query': wcps_query}, verify=False)
 
+    @patch('time.sleep')
+    @patch('requests.post')
+    def test_send_request_retries(self, mock_post, mock_sleep):
+        """Test that network errors and 5XX responses are retried with backoff."""
+        failure = Mock(status_code=503)
+        failure.raise_for_status.side_effect = HTTPError("503 Server Error", response=failure)
+        success = Mock(status_code=200, content=b'Successful response')
+        success.raise_for_status.return_value = None
+        mock_post.side_effect = [ConnectionError("reset"), failure, success]
+        db_connection = DatabaseConnection(self.endpoint_url, retries=2, backoff=0.1, transport=RequestsTransport())
+        event = QueryEvent()
+
+        response = db_connection.send_request("for $c in (AvgLandTemp) return 1", event=event)
+
+        self.assertIs(response, success)
+        self.assertEqual(mock_post.call_count, 3)
+        self.assertEqual([call.args[0] for call in mock_sleep.call_args_list], [0.1, 0.2])
+        self.assertEqual((event.status, event.retries, event.response_bytes), (200, 2, 19))
+
+    @patch('requests.post')
+    def test_client_errors_are_not_retried(self, mock_post):
+        """Test that 4XX responses are reported without retrying."""
+        failure = Mock(status_code=400, content=b'bad query')
+        failure.raise_for_status.side_effect = HTTPError("400 Client Error", response=failure)
+        mock_post.return_value = failure
+        db_connection = DatabaseConnection(self.endpoint_url, retries=3, transport=RequestsTransport())
+        event = QueryEvent()
+
+        self.assertIsNone(db_connection.send_request("for $c in (AvgLandTemp) return x", event=event))
+        mock_post.assert_called_once()
+        self.assertEqual(event.status, 400)
+        self.assertIn("400", event.error)
+
 if __name__ == '__main__':
     unittest.main()
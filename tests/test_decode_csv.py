@@ -0,0 +1,38 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import sys
+sys.path.append('../src/wdc')
+import numpy as np
+from wdc import decode_csv
+
+class TestDecodeCSV(unittest.TestCase):
+    def test_one_dimensional(self):
+        # Test decoding a 1D result such as a time series
+        values = decode_csv(b"1.5,2,3.25")
+        np.testing.assert_array_equal(values, [1.5, 2, 3.25])
+
+    def test_two_dimensional(self):
+        # Test decoding a 2D result with one group per row
+        values = decode_csv(b"{1,2,3},{4,5,6}")
+        np.testing.assert_array_equal(values, [[1, 2, 3], [4, 5, 6]])
+
+    def test_three_dimensional(self):
+        # Test decoding a 3D result with nested groups
+        values = decode_csv("{{1,2},{3,4},{5,6}},{{7,8},{9,10},{11,12}}")
+        self.assertEqual(values.shape, (2, 3, 2))
+        self.assertEqual(values[1, 2, 0], 11)
+
+    def test_whitespace_and_empty(self):
+        # Test that surrounding whitespace is ignored and empty content decodes to an empty array
+        np.testing.assert_array_equal(decode_csv(" {1, 2}, {3, 4}\n"), [[1, 2], [3, 4]])
+        self.assertEqual(decode_csv(b"").size, 0)
+
+    def test_invalid_content(self):
+        # Test that non-numeric or ragged content is rejected
+        with self.assertRaises(ValueError):
+            decode_csv(b"Query execution failed")
+        with self.assertRaises(ValueError):
+            decode_csv(b"{1,2},{3,4,5}")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import io
+import os
+import unittest
+from unittest.mock import patch, MagicMock
+import sys
+sys.path.append('../src/wdc')
+import numpy as np
+from PIL import Image
+from wdc import DecodePipeline, Query, Coverage, decode_result
+
+def png_bytes(pixels):
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def shared_blocks():
+    return sorted(name for name in os.listdir('/dev/shm') if name.startswith('psm_')) if os.path.isdir('/dev/shm') else []
+
+class TestDecodePipeline(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pipeline = DecodePipeline(max_workers=2, download_threads=4, inline_bytes=1024)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pipeline.close()
+
+    def setUp(self):
+        # Reset coverage counter for each test and prepare a noisy image that compresses badly
+        Coverage.coverage_counter = 1
+        self.pixels = np.random.default_rng(0).integers(0, 255, (200, 300, 3), dtype=np.uint8)
+        self.png = png_bytes(self.pixels)
+
+    def test_decode_in_worker(self):
+        # Test that a large payload is decoded in a worker and returned through shared memory
+        blocks = shared_blocks()
+        array = self.pipeline.decode(self.png, 'PNG').result(timeout=30)
+        np.testing.assert_array_equal(array, self.pixels)
+        self.assertFalse(array.flags.owndata)  # A view of the shared block, not a copy
+        self.assertEqual(shared_blocks(), blocks)  # The block is unlinked once attached
+
+    def test_decode_inline(self):
+        # Test that small payloads are decoded without a worker
+        array = self.pipeline.decode(b"{1,2},{3,4}", 'CSV').result(timeout=30)
+        np.testing.assert_array_equal(array, [[1, 2], [3, 4]])
+
+    def test_decode_error(self):
+        # Test that decoding errors of workers are raised by the future
+        with self.assertRaises(Exception):
+            self.pipeline.decode(b"not an image" * 1000, 'PNG').result(timeout=30)
+
+    def test_execute(self):
+        # Test downloading and decoding several results, in the order of the expressions
+        images = [png_bytes(np.full((50, 60), value, dtype=np.uint8)) for value in (10, 20, 30)]
+        dbc = MagicMock()
+        dbc.send_request.side_effect = [MagicMock(content=content) for content in images]
+        query = Query(dbc)
+        coverage = Coverage("AvgLandTemp")
+        query.add_coverage(coverage)
+        query.set_operation('encode')
+        query.set_return('PNG')
+        pipeline = DecodePipeline(max_workers=1, download_threads=1, inline_bytes=0)
+        with pipeline:
+            arrays = list(pipeline.execute(query, [coverage, coverage + 1, coverage + 2]))
+        self.assertEqual([int(array[0, 0]) for array in arrays], [10, 20, 30])
+        self.assertIn("($c1 + 2)", dbc.send_request.call_args_list[2].args[0])
+
+    def test_failed_query(self):
+        # Test that failed downloads raise RuntimeError
+        dbc = MagicMock()
+        dbc.send_request.return_value = None
+        query = Query(dbc)
+        coverage = Coverage("AvgLandTemp")
+        query.add_coverage(coverage)
+        with self.assertRaises(RuntimeError):
+            self.pipeline.submit(query, coverage).result(timeout=30)
+
+    def test_invalid_arguments(self):
+        # Test the validation of pool sizes
+        with self.assertRaises(ValueError):
+            DecodePipeline(max_workers=0)
+        with self.assertRaises(ValueError):
+            DecodePipeline(download_threads=0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import threading
+import time
+import unittest
+from unittest.mock import patch, MagicMock
+import sys
+sys.path.append('../src/wdc')
+import numpy as np
+from wdc import Deferred, delayed, compute, Query, Coverage, Axis, LocalConnection, LocalCube, ResultCache
+
+MONTHS = [f"2014-{month:02d}" for month in range(1, 13)]
+
+class TestDeferred(unittest.TestCase):
+    def setUp(self):
+        # Reset coverage counter for each test and build a local cube
+        Coverage.coverage_counter = 1
+        self.data = np.random.default_rng(2).uniform(-10, 40, (12, 5, 4))
+        cube = LocalCube(self.data, [("ansi", MONTHS), ("Lat", np.arange(5.0)), ("Long", np.arange(4.0))])
+        self.dbc = LocalConnection({"AvgLandTemp": cube})
+        self.coverage = Coverage("AvgLandTemp")
+        self.query = Query(self.dbc)
+        self.query.add_coverage(self.coverage)
+        self.query.set_operation('encode')
+        self.query.set_return('CSV')
+
+    def defer_month(self, month, decode=True):
+        self.coverage.set_subset(Axis("ansi", f'"{month}"'))
+        return self.query.defer(self.coverage, decode=decode)
+
+    def test_nothing_sent_until_compute(self):
+        # Test that deferring only generates the query
+        with patch.object(self.dbc, "send_request", wraps=self.dbc.send_request) as mock_send:
+            july = self.defer_month("2014-07")
+            mock_send.assert_not_called()
+            np.testing.assert_array_equal(july.compute(), self.data[6])
+            self.assertEqual(mock_send.call_count, 1)
+        self.assertIn('ansi("2014-07")', july.text)
+
+    def test_anomaly_graph(self):
+        # Test derived results with arithmetic and delayed functions
+        baseline = delayed(np.mean, [self.defer_month(month) for month in MONTHS], axis=0)
+        anomaly = self.defer_month("2014-07") - baseline
+        expected = self.data[6] - self.data.mean(axis=0)
+        np.testing.assert_allclose(anomaly.compute(), expected)
+
+    def test_identical_queries_sent_once(self):
+        # Test deduplication of identical queries, also between raw and decoded results
+        first = self.defer_month("2014-03")
+        second = self.defer_month("2014-03")
+        raw = self.defer_month("2014-03", decode=False)
+        with patch.object(self.dbc, "send_request", wraps=self.dbc.send_request) as mock_send:
+            a, b, content = compute(first, second, raw)
+        self.assertEqual(mock_send.call_count, 1)
+        np.testing.assert_array_equal(a, b)
+        self.assertIsInstance(content, bytes)
+
+    def test_unneeded_queries_skipped(self):
+        # Test that only the dependencies of the requested handles are sent
+        needed = self.defer_month("2014-01")
+        self.defer_month("2014-02")
+        unused = delayed(np.negative, self.defer_month("2014-03"))
+        with patch.object(self.dbc, "send_request", wraps=self.dbc.send_request) as mock_send:
+            compute(needed)
+        self.assertEqual(mock_send.call_count, 1)
+        self.assertEqual(len(unused.dependencies), 1)
+
+    def test_queries_sent_concurrently(self):
+        # Test that independent queries are in flight at the same time
+        active, peak, lock = [0], [0], threading.Lock()
+
+        def slow(query, event=None):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+            return MagicMock(content=b"1")
+        dbc = MagicMock()
+        dbc.send_request.side_effect = slow
+        query = Query(dbc)
+        coverage = Coverage("AvgLandTemp")
+        query.add_coverage(coverage)
+        query.set_operation('max')
+        handles = []
+        for month in MONTHS[:4]:
+            coverage.set_subset(Axis("ansi", f'"{month}"'))
+            handles.append(query.defer(coverage))
+        self.assertEqual(compute(*handles, max_workers=4), (b"1",) * 4)
+        self.assertEqual(peak[0], 4)
+
+    def test_failures(self):
+        # Test that failed queries give the error message, or raise when decoded
+        self.coverage.set_subset(Axis("Height", 1))
+        raw = self.query.defer(self.coverage)
+        decoded = self.query.defer(self.coverage, decode=True)
+        self.assertEqual(raw.compute(), "Query execution failed or no response.")
+        with self.assertRaises(RuntimeError):
+            decoded.compute()
+        with self.assertRaises(TypeError):
+            compute(self.coverage)
+        with self.assertRaises(TypeError):
+            delayed(42)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import sys
+sys.path.append('../src/wdc')
+import functools
+import pickle
+import numpy as np
+from wdc import (Coverage, Axis, BinaryOperation, RGBColor, Case, Switch, Query, DatabaseConnection, ExpressionNode,
+                 AxisNode, CoverageNode, OperationNode, ColorNode, CaseNode, SwitchNode, to_node, evaluate_expression, NodeScope)
+
+class TestExpressionNodes(unittest.TestCase):
+    def setUp(self):
+        # Reset coverage counter for each test
+        Coverage.coverage_counter = 1
+        self.coverage = Coverage("AvgLandTemp")
+        self.coverage.set_subset(Axis("Lat", 53.08), Axis("Long", 8.80), Axis("ansi", '"2014-01"', '"2014-12"'))
+        self.node = to_node(self.coverage)
+
+    def test_identical_subtrees_are_shared(self):
+        # Test that building the same expression twice returns the same objects
+        first = (self.node * 2 + 1) > 0
+        second = (self.node * 2 + 1) > 0
+        self.assertIs(first, second)
+        self.assertIs(first.lhs.lhs, second.lhs.lhs)
+        self.assertIs(to_node(self.coverage), self.node)
+
+    def test_constants_of_different_types_are_not_shared(self):
+        # Test that 1, 1.0 and True stay distinct because they render differently
+        self.assertIsNot(self.node + 1, self.node + 1.0)
+        self.assertIsNot(self.node + 1, self.node + True)
+        self.assertNotEqual(self.node + 0.0, self.node + -0.0)
+        self.assertEqual(str(self.node + 1.0), str(self.coverage + 1.0))
+
+    def test_numpy_scalars_become_numbers(self):
+        # Test that NumPy scalars are interned like the equal Python numbers
+        self.assertIs(self.node + np.float64(2.5), self.node + 2.5)
+        self.assertIs(self.node * np.int64(3), self.node * 3)
+
+    def test_rendering_matches_classes(self):
+        # Test that nodes render exactly like the classes they mirror
+        other = Coverage("Precipitation")
+        expression = ((self.coverage - 273.15) * 2 / other >= 10) != (self.coverage == other)
+        self.assertEqual(str(to_node(expression)), str(expression))
+        self.assertEqual(str(self.node.eq(5)), str(self.coverage == 5))
+        self.assertEqual(str(self.node.ne(5)), str(self.coverage != 5))
+        self.assertEqual(str(AxisNode("ansi", '"2014-01"', '"2014-12"')), str(Axis("ansi", '"2014-01"', '"2014-12"')))
+        self.assertEqual(str(ColorNode(0, 128, 255)), str(RGBColor(0, 128, 255)))
+
+    def test_switch_rendering_matches(self):
+        # Test that switches, including threshold switches, render like Switch
+        switch = Switch(RGBColor(255, 255, 255))
+        switch.add_case(Case(self.coverage > 30, RGBColor(255, 0, 0)))
+        switch.add_case(Case(self.coverage < 0, RGBColor(0, 0, 255)))
+        node = to_node(switch)
+        self.assertIsInstance(node, SwitchNode)
+        self.assertIsInstance(node.cases[0], CaseNode)
+        self.assertEqual(str(node), str(switch))
+        thresholds = Switch.from_thresholds(self.coverage, [0, 10, 20], [(0, 0, 255), (0, 255, 0), (255, 255, 0), (255, 0, 0)])
+        thresholds.add_case(Case(self.coverage.__eq__(-999), RGBColor(0, 0, 0)))
+        self.assertEqual(str(to_node(thresholds)), str(thresholds))
+
+    def test_nodes_are_hashable(self):
+        # Test that nodes can be used as dict keys and memoized
+        calls = []
+
+        @functools.lru_cache(maxsize=None)
+        def render(node):
+            calls.append(node)
+            return str(node)
+
+        expression = self.node * 2 + 1
+        results = {expression: 'first'}
+        self.assertEqual(results[self.node * 2 + 1], 'first')
+        render(expression)
+        render(self.node * 2 + 1)
+        self.assertEqual(len(calls), 1)
+
+    def test_nodes_are_immutable(self):
+        # Test that the fields of a node cannot be changed or removed
+        expression = self.node + 1
+        with self.assertRaises(AttributeError):
+            expression.rhs = 2
+        with self.assertRaises(AttributeError):
+            del expression.lhs
+        with self.assertRaises(AttributeError):
+            expression.extra = 3
+
+    def test_conversion_captures_subset(self):
+        # Test that a converted coverage keeps the subset it had when it was converted
+        self.coverage.set_subset(Axis("Lat", 0, 10))
+        self.assertEqual(str(self.node), '$c1[Lat(53.08), Long(8.8), ansi("2014-01":"2014-12")]')
+        self.assertEqual(str(to_node(self.coverage)), '$c1[Lat(0:10)]')
+        self.assertEqual(self.node.name, "AvgLandTemp")
+
+    def test_deep_chains(self):
+        # Test that long running sums are converted and rendered without recursion
+        expression = self.coverage
+        for index in range(20000):
+            expression = expression + index
+        node = to_node(expression)
+        text = str(node)
+        self.assertTrue(text.startswith('(' * 20000 + '$c1['))
+        self.assertTrue(text.endswith(' + 19998) + 19999)'))
+        self.assertIs(node.lhs, to_node(expression.lhs))
+
+    def test_shared_objects_convert_once(self):
+        # Test that an object used twice in a tree becomes one shared node
+        term = self.coverage * 2
+        node = to_node(BinaryOperation(term, '+', term))
+        self.assertIs(node.lhs, node.rhs)
+
+    def test_pickle_keeps_interning(self):
+        # Test that unpickled nodes are the interned nodes
+        expression = (self.node - 273.15) > 0
+        self.assertIs(pickle.loads(pickle.dumps(expression)), expression)
+
+    def test_clear_keeps_structural_equality(self):
+        # Test that trees rebuilt after clearing the intern table are equal, hash alike and hit caches
+        calls = []
+
+        @functools.lru_cache(maxsize=None)
+        def render(node):
+            calls.append(node)
+            return str(node)
+
+        expression = CoverageNode('A', 'c1') + 1
+        results = {expression: 'first'}
+        render(expression)
+        ExpressionNode.clear()
+        self.assertEqual(ExpressionNode.interned(), 0)
+        rebuilt = CoverageNode('A', 'c1') + 1
+        self.assertIsNot(rebuilt, expression)
+        self.assertEqual(rebuilt, expression)
+        self.assertEqual(hash(rebuilt), hash(expression))
+        self.assertEqual(results[rebuilt], 'first')
+        render(rebuilt)
+        self.assertEqual(len(calls), 1)
+        self.assertNotEqual(CoverageNode('A', 'c1') + 1.0, expression)
+        self.assertNotEqual(CoverageNode('B', 'c1') + 1, expression)
+
+    def test_unused_nodes_are_released(self):
+        # Test that nodes which are no longer used leave the intern table
+        import gc
+        before = ExpressionNode.interned()
+        base = CoverageNode('A', 'c1')
+        for index in range(1000):
+            base + index
+        gc.collect()
+        self.assertLessEqual(ExpressionNode.interned(), before + 1)
+
+    def test_scope_interns_locally(self):
+        # Test that nodes built in a scope are shared inside it and equal to nodes built elsewhere
+        outside = self.node * 2 + 1
+        with NodeScope() as scope:
+            inside = self.node * 2 + 1
+            self.assertIs(self.node * 2 + 1, inside)
+            self.assertEqual(len(scope), 2)
+            self.assertEqual(ExpressionNode.interned(), 2)
+        self.assertEqual(len(scope), 0)
+        self.assertIsNot(inside, outside)
+        self.assertEqual(inside, outside)
+        self.assertEqual(hash(inside), hash(outside))
+        self.assertIs(self.node * 2 + 1, outside)
+
+    def test_deep_chains_compare(self):
+        # Test that long chains built in different scopes compare without recursion
+        chains = []
+        for _ in range(2):
+            with NodeScope():
+                expression = self.node
+                for index in range(20000):
+                    expression = expression + index
+                chains.append(expression)
+        self.assertIsNot(chains[0], chains[1])
+        self.assertEqual(chains[0], chains[1])
+        self.assertNotEqual(chains[0], chains[1] + 0)
+
+    def test_operations_store_only_operands(self):
+        # Test that the operator lives on a per-operator class, so operations only hold their operands
+        expression = self.node + 1
+        self.assertIsInstance(expression, OperationNode)
+        self.assertEqual(expression.operator, '+')
+        self.assertEqual(type(expression).__name__, 'OperationNode')
+        self.assertFalse(hasattr(expression, '__dict__'))
+        self.assertEqual(OperationNode.__slots__, ('lhs', 'rhs'))
+        self.assertEqual(repr(expression.rhs), '1')
+        with self.assertRaises(TypeError):
+            OperationNode(self.node, None, 1)
+
+    def test_invalid_operand(self):
+        # Test that values which cannot be rendered are rejected
+        with self.assertRaises(TypeError):
+            self.node + [1, 2]
+
+    def test_generate_query_with_nodes(self):
+        # Test that a query renders nodes the same way as the classes
+        query = Query(DatabaseConnection("http://example.com"))
+        query.add_coverage(self.coverage)
+        query.set_operation('avg')
+        self.assertEqual(query.generate_query(to_node(self.coverage + 273.15)), query.generate_query(self.coverage + 273.15))
+
+    def test_evaluate_expression(self):
+        # Test that node trees are evaluated locally like BinaryOperation trees
+        values = np.array([1.0, 2.0, 3.0])
+        result = evaluate_expression((self.node * 2 + 1) > 4, lambda leaf: values)
+        np.testing.assert_array_equal(result, [False, True, True])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import io
+import unittest
+from unittest.mock import patch, MagicMock
+import sys
+sys.path.append('../src/wdc')
+import numpy as np
+from PIL import Image
+from wdc import LocalColorCoding, Query, Coverage, Axis, Switch, Case, RGBColor
+
+WHITE, BLUE, YELLOW, ORANGE, RED = (255, 255, 255), (0, 0, 255), (255, 255, 0), (255, 140, 0), (255, 0, 0)
+
+class TestLocalColorCoding(unittest.TestCase):
+    def setUp(self):
+        # Reset coverage counter for each test
+        Coverage.coverage_counter = 1
+        self.coverage = Coverage("AvgLandTemp")
+        self.coverage.set_subset(Axis("Lat", 35, 75), Axis("Long", -20, 40), Axis("ansi", '"2014-07"'))
+        self.dbc = MagicMock()
+        self.dbc.send_request.return_value = MagicMock(content=b"{99999,10,20},{25,29,35}")
+        self.query = Query(self.dbc)
+        self.query.add_coverage(self.coverage)
+        self.query.set_operation('colorcoding')
+        self.query.set_return('PNG')
+        self.query.set_switch(self.make_switch(self.coverage))
+
+    def make_switch(self, coverage):
+        switch = Switch(RGBColor(*RED))
+        switch.add_case(Case(coverage == 99999, RGBColor(*WHITE)))
+        switch.add_case(Case(coverage < 18, RGBColor(*BLUE)))
+        switch.add_case(Case(coverage < 23, RGBColor(*YELLOW)))
+        switch.add_case(Case(coverage < 30, RGBColor(*ORANGE)))
+        return switch
+
+    def test_render_matches_switch(self):
+        # Test that the first matching case decides the color of each cell
+        rgb = LocalColorCoding(self.query).render()
+        self.assertEqual(rgb.dtype, np.uint8)
+        np.testing.assert_array_equal(rgb, [[WHITE, BLUE, YELLOW], [ORANGE, ORANGE, RED]])
+
+    def test_values_are_fetched_once_as_csv(self):
+        # Test that re-coloring with another switch does not query the server again
+        colorcoding = LocalColorCoding(self.query)
+        colorcoding.render()
+        recolor = Switch(RGBColor(0, 0, 0))
+        recolor.add_case(Case(self.coverage > 20, RGBColor(*WHITE)))
+        rgb = colorcoding.render(recolor)
+        np.testing.assert_array_equal(rgb[0], [WHITE, (0, 0, 0), (0, 0, 0)])
+        self.dbc.send_request.assert_called_once_with(
+            'for $c1 in (AvgLandTemp)\nreturn encode($c1[Lat(35:75), Long(-20:40), ansi("2014-07")], "text/csv")')
+
+    def test_subset_change_fetches_again(self):
+        # Test that changing the subset of a coverage fetches its new values instead of recoloring the old ones
+        colorcoding = LocalColorCoding(self.query)
+        colorcoding.render()
+        self.coverage.set_subset(Axis("Lat", 35, 75), Axis("Long", -20, 40), Axis("ansi", '"2014-08"'))
+        self.dbc.send_request.return_value = MagicMock(content=b"{1,1,1},{1,1,1}")
+        np.testing.assert_array_equal(colorcoding.render(), [[BLUE] * 3] * 2)
+        self.assertEqual(self.dbc.send_request.call_count, 2)
+        self.assertIn('ansi("2014-08")', self.dbc.send_request.call_args[0][0])
+
+    def test_arithmetic_in_cases(self):
+        # Test that cases may contain arithmetic on the coverage
+        switch = Switch(RGBColor(*RED))
+        switch.add_case(Case(self.coverage + 273.15 < 300, RGBColor(*BLUE)))
+        rgb = LocalColorCoding(self.query).render(switch)
+        np.testing.assert_array_equal(rgb[1], [BLUE, RED, RED])
+
+    def test_encode_png(self):
+        # Test that the colored values are encoded like the server's PNG output
+        content = LocalColorCoding(self.query).encode()
+        image = np.asarray(Image.open(io.BytesIO(content)))
+        self.assertEqual(image.shape, (2, 3, 3))
+        np.testing.assert_array_equal(image[0, 0], WHITE)
+
+    def test_string_cases_are_rejected(self):
+        # Test that cases written as raw strings cannot be evaluated locally
+        switch = Switch(RGBColor(*RED))
+        switch.add_case(Case("temperature > 30", RGBColor(*BLUE)))
+        self.query.set_switch(switch)
+        with self.assertRaises(ValueError):
+            LocalColorCoding(self.query).render()
+
+    def test_failed_fetch(self):
+        # Test that a failed fetch is reported
+        self.dbc.send_request.return_value = None
+        with self.assertRaises(RuntimeError):
+            LocalColorCoding(self.query).render()
+
+if __name__ == '__main__':
+    unittest.main()
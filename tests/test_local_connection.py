@@ -0,0 +1,156 @@
+import io
+import os
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+import sys
+sys.path.append('../src/wdc')
+import numpy as np
+from PIL import Image
+from wdc import LocalConnection, LocalCube, LocalColorCoding, Query, Coverage, Axis, Switch, Case, RGBColor, decode_csv
+
+MONTHS = [f"2014-{month:02d}" for month in range(1, 13)]
+LATITUDES = np.arange(30, 80, 1.0)
+LONGITUDES = np.arange(-30, 50, 1.0)
+
+class TestLocalConnection(unittest.TestCase):
+    def setUp(self):
+        # Reset coverage counter for each test and build a small random cube
+        Coverage.coverage_counter = 1
+        self.data = np.random.default_rng(0).uniform(-10, 40, (12, 50, 80))
+        self.cube = LocalCube(self.data, [("ansi", MONTHS), ("Lat", LATITUDES), ("Long", LONGITUDES)])
+        self.dbc = LocalConnection({"AvgLandTemp": self.cube}, chunk_size=100)
+        self.coverage = Coverage("AvgLandTemp")
+        self.query = Query(self.dbc)
+        self.query.add_coverage(self.coverage)
+
+    def set_time_series(self):
+        self.coverage.set_subset(Axis("Lat", 53.08), Axis("Long", 8.80), Axis("ansi", '"2014-01"', '"2014-12"'))
+        return self.data[:, 23, 39]
+
+    def test_aggregates(self):
+        # Test min, max, avg and count over a 1D subset
+        series = self.set_time_series()
+        for operation, expected in (('min', series.min()), ('max', series.max()), ('avg', series.mean())):
+            self.query.set_operation(operation)
+            self.assertAlmostEqual(float(self.query.execute_query(self.coverage)), expected)
+        self.query.set_operation('count')
+        self.query.set_count_condition('> 15')
+        self.assertEqual(int(self.query.execute_query(self.coverage)), (series > 15).sum())
+
+    def test_chunked_aggregate_over_cube(self):
+        # Test that aggregates over the whole cube are combined correctly from chunks
+        self.query.set_operation('avg')
+        self.assertAlmostEqual(float(self.query.execute_query(self.coverage * 2 - 1)), (self.data * 2 - 1).mean())
+        self.query.set_operation('max')
+        self.assertAlmostEqual(float(self.query.execute_query(self.coverage)), self.data.max())
+
+    def test_encode_csv_with_arithmetic(self):
+        # Test encoding a Celsius to Kelvin conversion as CSV
+        series = self.set_time_series()
+        self.query.set_operation('encode')
+        self.query.set_return('CSV')
+        values = decode_csv(self.query.execute_query(self.coverage + 273.15))
+        np.testing.assert_allclose(values, series + 273.15)
+
+    def test_encode_2d_csv_in_chunks(self):
+        # Test that a 2D CSV produced in chunks decodes to the full subset
+        self.coverage.set_subset(Axis("Lat", 35, 75), Axis("Long", -20, 40), Axis("ansi", '"2014-07"'))
+        self.query.set_operation('encode')
+        self.query.set_return('CSV')
+        values = decode_csv(self.query.execute_query(self.coverage))
+        np.testing.assert_allclose(values, self.data[6, 5:46, 10:71])
+
+    def test_chunked_broadcast_of_lower_rank_operand(self):
+        # Test that an operand with fewer axes than the result is broadcast whole against every chunk
+        self.dbc.chunk_size = 10
+        self.coverage.set_subset(Axis("ansi", '"2014-01"', '"2014-12"'))
+        january = Coverage("AvgLandTemp")
+        january.set_subset(Axis("ansi", '"2014-01"'))
+        self.query.add_coverage(january)
+        self.query.set_operation('avg')
+        self.assertAlmostEqual(float(self.query.execute_query(self.coverage - january)), (self.data - self.data[0]).mean())
+        self.coverage.set_subset(Axis("ansi", '"2014-01"', '"2014-12"'), Axis("Lat", 53.08))
+        january.set_subset(Axis("ansi", '"2014-01"'), Axis("Lat", 53.08))
+        self.query.set_operation('encode')
+        self.query.set_return('CSV')
+        values = decode_csv(self.query.execute_query(self.coverage - january))
+        np.testing.assert_allclose(values, self.data[:, 23] - self.data[0, 23])
+
+    def test_single_value_and_basic_query(self):
+        # Test selecting a single value and returning a constant
+        self.coverage.set_subset(Axis("Lat", 53.08), Axis("Long", 8.80), Axis("ansi", '"2014-07"'))
+        self.assertAlmostEqual(float(self.query.execute_query(self.coverage)), self.data[6, 23, 39])
+        self.query.set_return('CSV', 1)
+        self.assertEqual(self.query.execute_query(self.coverage), b'1')
+
+    def test_colorcoding_matches_local_colorcoding(self):
+        # Test that the switch evaluated by the engine matches client-side colorcoding
+        self.coverage.set_subset(Axis("Lat", 35, 75), Axis("Long", -20, 40), Axis("ansi", '"2014-07"'))
+        switch = Switch(RGBColor(255, 0, 0))
+        switch.add_case(Case(self.coverage == 99999, RGBColor(255, 255, 255)))
+        switch.add_case(Case(self.coverage < 18, RGBColor(0, 0, 255)))
+        switch.add_case(Case(self.coverage < 23, RGBColor(255, 255, 0)))
+        self.query.set_operation('colorcoding')
+        self.query.set_return('PNG')
+        self.query.set_switch(switch)
+        server = np.asarray(Image.open(io.BytesIO(self.query.execute_query(self.coverage))))
+        np.testing.assert_array_equal(server, LocalColorCoding(self.query).render())
+
+    def test_preview_scale(self):
+        # Test that a preview is resampled to the requested size
+        self.coverage.set_subset(Axis("ansi", '"2014-07"'))
+        self.query.set_operation('encode')
+        self.query.set_return('PNG')
+        self.query.set_preview(20, 10)
+        image = Image.open(io.BytesIO(self.query.execute_query(self.coverage)))
+        self.assertEqual(image.size, (20, 10))
+
+    def test_memory_mapped_cube(self):
+        # Test evaluating queries over a memory-mapped .npy cube
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cube.npy")
+            np.save(path, self.data)
+            cube = LocalCube.load(path, [("ansi", MONTHS), ("Lat", LATITUDES), ("Long", LONGITUDES)])
+            self.assertIsInstance(cube.data, np.memmap)
+            query = Query(LocalConnection({"AvgLandTemp": cube}, chunk_size=500))
+            query.add_coverage(self.coverage)
+            query.set_operation('min')
+            self.assertAlmostEqual(float(query.execute_query(self.coverage)), self.data.min())
+            del cube, query
+
+    def test_errors_return_none(self):
+        # Test that unknown axes, coverages and constructs fail like a server error
+        self.coverage.set_subset(Axis("Height", 1))
+        self.query.set_operation('max')
+        self.assertEqual(self.query.execute_query(self.coverage), "Query execution failed or no response.")
+        self.assertIsNone(self.dbc.send_request('for $c1 in (Unknown)\nreturn 1'))
+        self.assertIsNone(self.dbc.send_request('for $c1 in (AvgLandTemp)\nreturn sqrt($c1)'))
+        with self.assertRaises(ValueError):
+            self.dbc.evaluate('for $c1 in (AvgLandTemp)\nreturn sqrt($c1)')
+
+    def test_sum(self):
+        # Test the add condenser
+        self.query.set_operation('sum')
+        self.assertAlmostEqual(float(self.query.execute_query(self.coverage)), self.data.sum())
+
+    def test_histogram_and_percentiles(self):
+        # Test that server-side histograms match NumPy
+        self.query.set_histogram(20, -10.0, 40.0)
+        counts, edges = self.query.execute_histogram(self.coverage)
+        expected_counts, expected_edges = np.histogram(self.data, 20, (-10.0, 40.0))
+        np.testing.assert_array_equal(counts, expected_counts)
+        np.testing.assert_allclose(edges, expected_edges)
+        self.query.set_histogram(200)
+        percentiles = self.query.execute_percentiles(self.coverage, [1, 50, 99])
+        np.testing.assert_allclose(percentiles, np.percentile(self.data, [1, 50, 99]), atol=50 / 200)
+
+    def test_cube_axes_must_match(self):
+        # Test that the axes of a cube must match its data
+        with self.assertRaises(ValueError):
+            LocalCube(self.data, [("ansi", MONTHS), ("Lat", LATITUDES)])
+        with self.assertRaises(ValueError):
+            LocalCube(self.data, [("ansi", MONTHS[:3]), ("Lat", LATITUDES), ("Long", LONGITUDES)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import sys
+sys.path.append('../src/wdc')
+from wdc import MetricsAggregator, QueryEvent, Query, Coverage
+
+class TestMetricsAggregator(unittest.TestCase):
+    def setUp(self):
+        # Reset coverage counter for each test
+        Coverage.coverage_counter = 1
+
+    def make_event(self, total, status=200, cache=None, error=None, retries=0):
+        event = QueryEvent()
+        event.query = "for $c1 in (AvgLandTemp)\nreturn 1"
+        event.timings = {'network': total / 2, 'total': total}
+        event.status = status
+        event.cache = cache
+        event.error = error
+        event.retries = retries
+        event.response_bytes = 100
+        return event
+
+    def test_counters(self):
+        # Test that requests, errors, retries, cache outcomes and statuses are counted
+        metrics = MetricsAggregator()
+        metrics.on_query(self.make_event(0.1, cache='hit'))
+        metrics.on_query(self.make_event(0.2, status=500, error="500 Server Error", retries=2, cache='miss'))
+        self.assertEqual(metrics.counters, {'requests': 2, 'errors': 1, 'retries': 2, 'cache_hits': 1, 'cache_misses': 1})
+        self.assertEqual(metrics.statuses, {200: 1, 500: 1})
+
+    def test_percentiles(self):
+        # Test percentiles interpolated between samples
+        metrics = MetricsAggregator()
+        for total in range(1, 101):
+            metrics.on_query(self.make_event(float(total)))
+        self.assertAlmostEqual(metrics.percentile('total', 50), 50.5)
+        self.assertAlmostEqual(metrics.percentile('total', 99), 99.01)
+        self.assertEqual(metrics.percentile('total', 100), 100)
+        self.assertIsNone(metrics.percentile('decode', 50))
+
+    def test_histogram(self):
+        # Test counting samples in equally wide bins
+        metrics = MetricsAggregator()
+        for total in (1.0, 1.5, 2.0, 4.0):
+            metrics.on_query(self.make_event(total))
+        counts, edges = metrics.histogram('total', bins=3)
+        self.assertEqual(counts, [2, 1, 1])
+        self.assertEqual(edges, [1.0, 2.0, 3.0, 4.0])
+
+    def test_samples_are_bounded(self):
+        # Test that only the most recent samples are kept
+        metrics = MetricsAggregator(max_samples=10)
+        for total in range(100):
+            metrics.on_query(self.make_event(float(total)))
+        self.assertEqual(metrics.snapshot()['metrics']['total']['count'], 10)
+        self.assertEqual(metrics.percentile('total', 0), 90)
+
+    def test_snapshot_and_reset(self):
+        # Test the exported summary and resetting it
+        metrics = MetricsAggregator()
+        metrics.on_query(self.make_event(0.5))
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['metrics']['response_bytes']['max'], 100)
+        self.assertEqual(snapshot['metrics']['query_length']['mean'], 33)
+        metrics.reset()
+        self.assertEqual(metrics.snapshot()['metrics'], {})
+        self.assertEqual(metrics.counters['requests'], 0)
+
+    def test_with_query(self):
+        # Test collecting metrics of real query executions, including failures
+        dbc = MagicMock()
+        dbc.send_request.side_effect = [MagicMock(content=b"42", status_code=200, elapsed=None), None]
+        coverage = Coverage("AvgLandTemp")
+        query = Query(dbc)
+        query.add_coverage(coverage)
+        query.set_operation('max')
+        metrics = MetricsAggregator()
+        query.add_observer(metrics)
+        query.execute_query(coverage)
+        query.execute_query(coverage)
+        self.assertEqual(metrics.counters['requests'], 2)
+        self.assertEqual(metrics.statuses, {200: 1})
+        self.assertEqual(len(metrics.samples['generate']), 2)
+
+    def test_with_one_argument_connection(self):
+        # Test that observers work with connections whose send_request only takes the query
+        class FakeConnection:
+            def __init__(self):
+                self.queries = []
+
+            def send_request(self, query):
+                self.queries.append(query)
+                return MagicMock(content=b"42", status_code=200, elapsed=None)
+
+        dbc = FakeConnection()
+        coverage = Coverage("AvgLandTemp")
+        query = Query(dbc)
+        query.add_coverage(coverage)
+        query.set_operation('max')
+        metrics = MetricsAggregator()
+        query.add_observer(metrics)
+        self.assertEqual(query.execute_query(coverage), b"42")
+        self.assertEqual(len(dbc.queries), 1)
+        self.assertEqual(metrics.counters['requests'], 1)
+        self.assertEqual(metrics.statuses, {200: 1})
+
+if __name__ == '__main__':
+    unittest.main()
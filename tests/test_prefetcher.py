@@ -0,0 +1,124 @@
+import threading
+import time
+import unittest
+from unittest.mock import patch, MagicMock
+import sys
+sys.path.append('../src/wdc')
+from wdc import Prefetcher, Query, Coverage, Axis, ResultCache
+
+MONTHS = [f'"2014-{month:02d}"' for month in range(1, 13)]
+
+class RecordingConnection:
+    """A fake DatabaseConnection that records queries and can hold them until released."""
+    def __init__(self, block=False):
+        self.queries = []
+        self.lock = threading.Lock()
+        self.release = threading.Event()
+        if not block:
+            self.release.set()
+
+    def send_request(self, query):
+        self.release.wait(5)
+        with self.lock:
+            self.queries.append(query)
+        return MagicMock(content=query.encode())
+
+class TestPrefetcher(unittest.TestCase):
+    def setUp(self):
+        # Reset coverage counter for each test
+        Coverage.coverage_counter = 1
+        self.coverage = Coverage("AvgTemperatureColorScaled")
+
+    def make_query(self, dbc):
+        query = Query(dbc)
+        query.add_coverage(self.coverage)
+        query.set_operation('encode')
+        query.set_return('PNG')
+        return query
+
+    def wait_for_prefetches(self, prefetcher):
+        deadline = time.monotonic() + 5
+        while prefetcher.pending() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def step_to(self, prefetcher, month):
+        self.coverage.set_subset(Axis("ansi", MONTHS[month]))
+        return prefetcher.execute_query(self.coverage)
+
+    def test_cache_is_attached(self):
+        # Test that a query without a cache gets one
+        query = self.make_query(RecordingConnection())
+        with Prefetcher(query, self.coverage, "ansi", MONTHS):
+            self.assertIsInstance(query.cache, ResultCache)
+
+    def test_sequential_steps_prefetch_ahead(self):
+        # Test that steady stepping fetches the next slices in the background
+        dbc = RecordingConnection()
+        query = self.make_query(dbc)
+        with Prefetcher(query, self.coverage, "ansi", MONTHS, depth=2) as prefetcher:
+            for month in range(3):
+                result = self.step_to(prefetcher, month)
+            self.assertIn(b'"2014-03"', result)
+            self.wait_for_prefetches(prefetcher)
+        self.assertEqual(len(dbc.queries), 5)
+        self.coverage.set_subset(Axis("ansi", MONTHS[4]))
+        self.assertIn(query.generate_query(self.coverage), query.cache)
+
+    def test_prefetched_slice_is_not_sent_again(self):
+        # Test that stepping onto a prefetched slice is served from the cache
+        dbc = RecordingConnection()
+        query = self.make_query(dbc)
+        with Prefetcher(query, self.coverage, "ansi", MONTHS, depth=1) as prefetcher:
+            for month in range(4):
+                self.step_to(prefetcher, month)
+            self.wait_for_prefetches(prefetcher)
+        self.assertEqual(len(dbc.queries), len(set(dbc.queries)))
+
+    def test_no_prefetch_without_a_pattern(self):
+        # Test that random access does not trigger prefetching
+        dbc = RecordingConnection()
+        query = self.make_query(dbc)
+        with Prefetcher(query, self.coverage, "ansi", MONTHS) as prefetcher:
+            for month in (0, 5, 2):
+                self.step_to(prefetcher, month)
+        self.assertEqual(len(dbc.queries), 3)
+
+    def test_prefetch_depth_is_bounded_by_axis(self):
+        # Test that no slices beyond the end of the axis are requested
+        dbc = RecordingConnection()
+        query = self.make_query(dbc)
+        with Prefetcher(query, self.coverage, "ansi", MONTHS, depth=5) as prefetcher:
+            for month in (9, 10, 11):
+                self.step_to(prefetcher, month)
+        self.assertEqual(len(dbc.queries), 3)
+
+    def test_pattern_change_cancels_prefetches(self):
+        # Test that queued prefetches are cancelled when the access pattern changes
+        dbc = RecordingConnection(block=True)
+        query = self.make_query(dbc)
+        prefetcher = Prefetcher(query, self.coverage, "ansi", MONTHS, depth=3, max_workers=1)
+        for month in range(3):
+            self.coverage.set_subset(Axis("ansi", MONTHS[month]))
+            query.cache.put(query.generate_query(self.coverage), b"cached")
+        for month in range(3):
+            self.step_to(prefetcher, month)
+        self.assertEqual(prefetcher.pending(), [3, 4, 5])
+        for month in (0, 1):
+            self.coverage.set_subset(Axis("ansi", MONTHS[month]))
+            query.cache.put(query.generate_query(self.coverage), b"cached")
+        self.step_to(prefetcher, 1)  # Stepping backwards breaks the forward pattern
+        self.assertEqual(prefetcher.pending(), [3])  # Only the running fetch is left
+        dbc.release.set()
+        prefetcher.close()
+        self.assertEqual(len(dbc.queries), 1)
+
+    def test_range_subset_is_rejected(self):
+        # Test that the stepped axis has to select a single slice
+        query = self.make_query(RecordingConnection())
+        with Prefetcher(query, self.coverage, "ansi", MONTHS) as prefetcher:
+            self.coverage.set_subset(Axis("ansi", MONTHS[0], MONTHS[2]))
+            with self.assertRaises(ValueError):
+                prefetcher.execute_query(self.coverage)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,7 +4,7 @@ import sys
 sys.path.append('../src/wdc')
 import numpy as np  # Import NumPy for image comparison
 from PIL import Image  # Import PIL for image handling
-from wdc import Query, DatabaseConnection, Coverage, Axis, BinaryOperation, Case, Switch, RGBColor
+from wdc import Query, DatabaseConnection, Coverage, Axis, BinaryOperation, Case, Switch, RGBColor, QueryObserver, ResultCache
 
 class TestQuery(unittest.TestCase):
     def setUp(self):
@@ -226,6 +226,177 @@ class TestQuery(unittest.TestCase):
         expected_query = '''for $c1 in (AvgLandTemp)\n return encode(\n    switch\n\tcase ($c1[Lat(35:75), Long(-20:40), ansi("2014-07")] = 99999)\n\t\treturn {red: 255; green: 255; blue: 255}\n\tcase ($c1[Lat(35:75), Long(-20:40), ansi("2014-07")] < 18)\n\t\treturn {red: 0; green: 0; blue: 255}\n\tcase ($c1[Lat(35:75), Long(-20:40), ansi("2014-07")] < 23)\n\t\treturn {red: 255; green: 255; blue: 0}\n\tcase ($c1[Lat(35:75), Long(-20:40), ansi("2014-07")] < 30)\n\t\treturn {red: 255; green: 140; blue: 0}\n\tdefault return {red: 255; green: 0; blue: 0}\n\t, "image/png")'''
 
         self.assertIn(expected_query, generated_query)
-        
+
+    def test_preview_query(self):
+        # Test that a preview scales the encoded result on the server
+        coverage1 = Coverage("AvgTemperatureColorScaled")
+        coverage1.set_subset(Axis("ansi", '"2014-07"'))
+        query = Query(self.dbc)
+        query.add_coverage(coverage1)
+        query.set_operation('encode')
+        query.set_return('PNG')
+        query.set_preview(800, 400)
+        generated_query = query.generate_query(coverage1)
+
+        self.assertIn('for $c1 in (AvgTemperatureColorScaled)\nreturn encode(scale($c1[ansi("2014-07")], { Long:"CRS:1"(0:799), Lat:"CRS:1"(0:399) }), "image/png")', generated_query)
+
+        query.clear_preview()
+        self.assertIn('return encode($c1[ansi("2014-07")], "image/png")', query.generate_query(coverage1))
+
+    def test_preview_height_from_subset(self):
+        # Test that the preview height follows the aspect ratio of the subset
+        coverage1 = Coverage("AvgLandTemp")
+        coverage1.set_subset(Axis("Lat", 35, 75), Axis("Long", -20, 40), Axis("ansi", '"2014-07"'))
+        query = Query(self.dbc)
+        query.add_coverage(coverage1)
+        query.set_preview(600)
+        self.assertEqual(query.preview_size(), (600, 400))
+
+    def test_preview_height_required_without_ranges(self):
+        # Test that the height must be given when the subset has no numeric ranges
+        coverage1 = Coverage("AvgLandTemp")
+        query = Query(self.dbc)
+        query.add_coverage(coverage1)
+        query.set_preview(600)
+        with self.assertRaises(ValueError):
+            query.preview_size()
+        with self.assertRaises(ValueError):
+            query.set_preview(0)
+
+    def test_preview_colorcoding_query(self):
+        # Test that the preview scales the whole switch statement
+        coverage = Coverage("AvgLandTemp")
+        coverage.set_subset(Axis("ansi", '"2014-07"'))
+        switch_statement = Switch(RGBColor(255, 0, 0))
+        switch_statement.add_case(Case(coverage < 18, RGBColor(0, 0, 255)))
+        query = Query(self.dbc)
+        query.add_coverage(coverage)
+        query.set_operation('colorcoding')
+        query.set_return('PNG')
+        query.set_switch(switch_statement)
+        query.set_preview(100, 50)
+        generated_query = query.generate_query(coverage)
+
+        self.assertIn('return encode(\n    scale(switch\n\tcase ($c1[ansi("2014-07")] < 18)\n\t\treturn {red: 0; green: 0; blue: 255}\n\tdefault return {red: 255; green: 0; blue: 0}, { Long:"CRS:1"(0:99), Lat:"CRS:1"(0:49) })\n\t, "image/png")', generated_query)
+
+    def test_progressive_execution(self):
+        # Test that progressive execution yields coarse previews before the final one
+        dbc = MagicMock()
+        dbc.send_request.side_effect = lambda query: MagicMock(content=query.encode())
+        coverage1 = Coverage("AvgTemperatureColorScaled")
+        coverage1.set_subset(Axis("ansi", '"2014-07"'))
+        query = Query(dbc)
+        query.add_coverage(coverage1)
+        query.set_operation('encode')
+        query.set_return('PNG')
+        query.set_preview(800, 400)
+        levels = list(query.execute_progressive(coverage1, levels=(8, 1)))
+
+        self.assertEqual([(width, height) for width, height, _ in levels], [(100, 50), (800, 400)])
+        self.assertIn(b'Long:"CRS:1"(0:99)', levels[0][2])
+        self.assertIn(b'Long:"CRS:1"(0:799)', levels[1][2])
+        self.assertEqual(query.preview, (800, 400, 'Long', 'Lat'))
+
+    def test_observer_receives_events(self):
+        # Test that observers are told about the phases and outcome of each request
+        class Collector(QueryObserver):
+            def __init__(self):
+                self.events = []
+
+            def on_query(self, event):
+                self.events.append(event)
+
+        dbc = MagicMock()
+        dbc.send_request.return_value = MagicMock(content=b"{1,2},{3,4}", status_code=200, elapsed=None)
+        coverage1 = Coverage("AvgLandTemp")
+        query = Query(dbc, cache=ResultCache())
+        query.add_coverage(coverage1)
+        query.set_operation('encode')
+        query.set_return('CSV')
+        collector = Collector()
+        query.add_observer(collector)
+        values = query.execute_array(coverage1)
+        query.execute_query(coverage1)
+
+        self.assertEqual(values.shape, (2, 2))
+        first, second = collector.events
+        self.assertEqual((first.cache, first.status, first.response_bytes), ('miss', 200, 11))
+        self.assertEqual(first.query_length, len(query.generate_query(coverage1)))
+        self.assertTrue({'generate', 'network', 'download', 'decode', 'total'} <= set(first.timings))
+        self.assertEqual(second.cache, 'hit')
+        self.assertNotIn('network', second.timings)
+        dbc.send_request.assert_called_once_with(first.query, event=first)
+
+    def test_observer_type_is_checked(self):
+        # Test that only QueryObserver instances can be registered
+        query = Query(self.dbc)
+        with self.assertRaises(TypeError):
+            query.add_observer(print)
+
+    def test_sum_query(self):
+        # Test generating a sum, which WCPS calls add
+        query = Query(self.dbc)
+        coverage = Coverage("AvgLandTemp")
+        query.add_coverage(coverage)
+        query.set_operation('sum')
+        self.assertEqual(query.generate_query(coverage), "for $c1 in (AvgLandTemp)\nreturn add($c1)")
+
+    def test_histogram_query(self):
+        # Test that all bins of a histogram are counted in a single query
+        query = Query(self.dbc)
+        coverage = Coverage("AvgLandTemp")
+        query.add_coverage(coverage)
+        query.set_operation('histogram')
+        query.set_histogram(4, -10.0, 30.0)
+        expected = ('for $c1 in (AvgLandTemp)\nreturn encode(coverage histogram over $i x(0:3) values '
+                    'count(($c1 >= -10.0 + 10.0 * $i) and ($c1 < -10.0 + 10.0 * ($i + 1))), "text/csv")')
+        self.assertEqual(query.generate_query(coverage), expected)
+        query.set_histogram(4, np.float64(-10.0), np.float32(30.0))
+        self.assertEqual(query.generate_query(coverage), expected)
+
+    def test_histogram_bounds(self):
+        # Test the validation of histogram bins and bounds
+        query = Query(self.dbc)
+        coverage = Coverage("AvgLandTemp")
+        query.add_coverage(coverage)
+        query.set_operation('histogram')
+        query.set_histogram(10)
+        with self.assertRaises(ValueError):
+            query.generate_query(coverage)  # The bounds are only found by execute_histogram
+        with self.assertRaises(ValueError):
+            query.set_histogram(0)
+        with self.assertRaises(ValueError):
+            query.set_histogram(10, 5.0)
+        with self.assertRaises(ValueError):
+            query.set_histogram(10, 5.0, 5.0)
+
+    def test_execute_histogram_fetches_range(self):
+        # Test that the minimum and maximum are fetched in one request before the histogram
+        dbc = MagicMock()
+        dbc.send_request.side_effect = [MagicMock(content=b"30,10"), MagicMock(content=b"3,0,1")]
+        query = Query(dbc)
+        coverage = Coverage("AvgLandTemp")
+        query.add_coverage(coverage)
+        query.set_histogram(3)
+        counts, edges = query.execute_histogram(coverage)
+        np.testing.assert_array_equal(counts, [3, 0, 1])
+        self.assertEqual(edges[0], -10.0)
+        self.assertGreater(edges[-1], 30.0)
+        first = dbc.send_request.call_args_list[0].args[0]
+        self.assertIn("max($c1 * (1 - 2 * $i))", first)
+        self.assertIsNone(query.operation)  # The query is left as it was
+
+    def test_execute_percentiles(self):
+        # Test interpolating percentiles within the bins of the histogram
+        dbc = MagicMock()
+        dbc.send_request.return_value = MagicMock(content=b"2,4,2,2")
+        query = Query(dbc)
+        coverage = Coverage("AvgLandTemp")
+        query.add_coverage(coverage)
+        query.set_histogram(4, 0.0, 40.0)
+        np.testing.assert_allclose(query.execute_percentiles(coverage, [0, 10, 50, 100]), [0.0, 5.0, 17.5, 40.0])
+        with self.assertRaises(ValueError):
+            query.execute_percentiles(coverage, [101])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,114 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest.mock import patch, Mock
+from requests.exceptions import HTTPError
+import sys
+sys.path.append('../src/wdc')
+from wdc import RecordingConnection, ReplayConnection, RequestsTransport, Query, Coverage, Axis
+
+class TestRecordReplay(unittest.TestCase):
+    def setUp(self):
+        # Reset coverage counter for each test and create a scratch directory for the archive
+        Coverage.coverage_counter = 1
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "traffic.zip")
+        self.endpoint_url = "https://ows.rasdaman.org/rasdaman/ows"
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def make_response(self, content, status_code=200, seconds=0.25):
+        response = Mock(content=content, status_code=status_code, headers={'Content-Type': 'text/csv'},
+                        elapsed=timedelta(seconds=seconds))
+        if status_code >= 400:
+            response.raise_for_status.side_effect = HTTPError(f"{status_code} Error", response=response)
+        else:
+            response.raise_for_status.return_value = None
+        return response
+
+    def make_query(self, dbc, month):
+        coverage = Coverage("AvgLandTemp")
+        coverage.set_subset(Axis("Lat", 53.08), Axis("Long", 8.80), Axis("ansi", f'"2014-{month:02d}"'))
+        query = Query(dbc)
+        query.add_coverage(coverage)
+        query.set_operation('max')
+        return query, coverage
+
+    @patch('requests.post')
+    def record(self, responses, mock_post):
+        mock_post.side_effect = responses
+        with RecordingConnection(self.endpoint_url, self.path, transport=RequestsTransport()) as dbc:
+            results = []
+            for month in range(1, len(responses) + 1):
+                query, coverage = self.make_query(dbc, month)
+                results.append(query.execute_query(coverage))
+        return results
+
+    def test_record_and_replay(self):
+        # Test that replayed results equal the recorded ones without contacting the server
+        recorded = self.record([self.make_response(b"21.5"), self.make_response(b"23.25")])
+        replay = ReplayConnection(self.path)
+        self.assertEqual(len(replay), 2)
+        with patch('requests.post') as mock_post:
+            replayed = []
+            for month in (1, 2):
+                query, coverage = self.make_query(replay, month)
+                replayed.append(query.execute_query(coverage))
+            mock_post.assert_not_called()
+        self.assertEqual(replayed, recorded)
+
+    def test_replay_independent_of_variables(self):
+        # Test that a query matches its recording when its coverage variable differs
+        recorded = self.record([self.make_response(b"21.5")])
+        Coverage("Precipitation")  # Shift the variables of the coverages created next
+        replay = ReplayConnection(self.path)
+        query, coverage = self.make_query(replay, 1)
+        self.assertNotEqual(coverage.variable, "c1")
+        self.assertIn(query.generate_query(coverage), replay)
+        self.assertEqual(query.execute_query(coverage), recorded[0])
+
+    def test_error_status_is_replayed(self):
+        # Test that a recorded error response fails again on replay
+        self.record([self.make_response(b"Invalid axis", status_code=400)])
+        query, coverage = self.make_query(ReplayConnection(self.path), 1)
+        self.assertEqual(query.execute_query(coverage), "Query execution failed or no response.")
+
+    def test_identical_bodies_are_stored_once(self):
+        # Test that the archive deduplicates response bodies
+        import zipfile
+        self.record([self.make_response(b"x" * 1000) for _ in range(3)])
+        with zipfile.ZipFile(self.path) as archive:
+            bodies = [name for name in archive.namelist() if name.startswith('bodies/')]
+        self.assertEqual(len(bodies), 1)
+
+    def test_unknown_query(self):
+        # Test that queries that were not recorded fail like a network error
+        self.record([self.make_response(b"1")])
+        replay = ReplayConnection(self.path)
+        self.assertIsNone(replay.send_request("for $c1 in (Other)\nreturn 1"))
+
+    @patch('time.sleep')
+    def test_scaled_latency(self, mock_sleep):
+        # Test that the recorded latency is reproduced with a scale factor
+        self.record([self.make_response(b"1", seconds=0.4)])
+        query, coverage = self.make_query(ReplayConnection(self.path, latency_scale=0.5), 1)
+        query.execute_query(coverage)
+        mock_sleep.assert_called_once_with(0.2)
+
+    def test_concurrent_replay(self):
+        # Test serving many concurrent requests from one archive
+        self.record([self.make_response(f"{month}".encode(), seconds=0.01) for month in range(1, 5)])
+        replay = ReplayConnection(self.path, latency_scale=1.0)
+        queries = []
+        for month in range(1, 5):
+            query, coverage = self.make_query(replay, month)
+            queries.append(query.generate_query(coverage))
+        with ThreadPoolExecutor(max_workers=64) as executor:
+            contents = list(executor.map(lambda index: replay.send_request(queries[index % 4]).content, range(256)))
+        self.assertEqual(contents, [f"{index % 4 + 1}".encode() for index in range(256)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import sys
+sys.path.append('../src/wdc')
+from wdc import ResultCache, Query, Coverage
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        # Reset coverage counter for each test
+        Coverage.coverage_counter = 1
+
+    def test_put_and_get(self):
+        # Test storing and retrieving a result
+        cache = ResultCache()
+        cache.put("query", b"content")
+        self.assertEqual(cache.get("query"), b"content")
+        self.assertIsNone(cache.get("other"))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_least_recently_used_is_evicted(self):
+        # Test that the least recently used entry is dropped once the cache is full
+        cache = ResultCache(max_entries=2)
+        cache.put("a", b"1")
+        cache.put("b", b"2")
+        cache.get("a")
+        cache.put("c", b"3")
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_invalid_size(self):
+        # Test that an empty cache cannot be created
+        with self.assertRaises(ValueError):
+            ResultCache(max_entries=0)
+
+    def test_query_uses_cache(self):
+        # Test that a cached query is not sent to the server again
+        dbc = MagicMock()
+        dbc.send_request.return_value = MagicMock(content=b"42")
+        coverage = Coverage("AvgLandTemp")
+        query = Query(dbc, cache=ResultCache())
+        query.add_coverage(coverage)
+        query.set_operation('max')
+        self.assertEqual(query.execute_query(coverage), b"42")
+        self.assertEqual(query.execute_query(coverage), b"42")
+        dbc.send_request.assert_called_once()
+
+    def test_failed_query_is_not_cached(self):
+        # Test that failures are not stored in the cache
+        dbc = MagicMock()
+        dbc.send_request.return_value = None
+        coverage = Coverage("AvgLandTemp")
+        query = Query(dbc, cache=ResultCache())
+        query.add_coverage(coverage)
+        query.set_operation('max')
+        query.execute_query(coverage)
+        self.assertEqual(len(query.cache), 0)
+
+if __name__ == '__main__':
+    unittest.main()
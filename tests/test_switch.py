@@ -2,6 +2,7 @@ import unittest
 from unittest.mock import patch, MagicMock
 import sys
 sys.path.append('../src/wdc')
+import numpy as np
 from wdc import Switch, Case, RGBColor, Coverage, Axis
 
 class TestSwitch(unittest.TestCase):
@@ -91,5 +92,57 @@ class TestSwitch(unittest.TestCase):
                         f"\tdefault return {self.default_color}")
         self.assertEqual(str(switch), expected_str)
 
+    def test_from_thresholds(self):
+        # Test building a colormap switch from breakpoint and color arrays
+        Coverage.coverage_counter = 1
+        coverage = Coverage("AvgLandTemp")
+        switch = Switch.from_thresholds(coverage, [18, 23, 30],
+                                        [RGBColor(0, 0, 255), (255, 255, 0), (255, 140, 0), (255, 0, 0)])
+
+        expected_str = ("switch\n"
+                        "\tcase ($c1 < 18)\n\t\treturn {red: 0; green: 0; blue: 255}\n"
+                        "\tcase ($c1 < 23)\n\t\treturn {red: 255; green: 255; blue: 0}\n"
+                        "\tcase ($c1 < 30)\n\t\treturn {red: 255; green: 140; blue: 0}\n"
+                        "\tdefault return {red: 255; green: 0; blue: 0}")
+        self.assertEqual(str(switch), expected_str)
+        self.assertEqual(len(switch.cases), 0)
+
+    def test_from_thresholds_matches_cases(self):
+        # Test that a threshold switch renders like the equivalent Case objects
+        Coverage.coverage_counter = 1
+        coverage = Coverage("AvgLandTemp")
+        coverage.set_subset(Axis("ansi", '"2014-07"'))
+        breakpoints = np.linspace(-40, 40, 200)
+        colors = np.stack([np.arange(201) % 256, np.zeros(201), np.full(201, 255)], axis=1).astype(int)
+        switch = Switch.from_thresholds(coverage, breakpoints, colors)
+        reference = Switch(RGBColor(*colors[-1]))
+        for breakpoint, color in zip(breakpoints.tolist(), colors.tolist()):
+            reference.add_case(Case(coverage < breakpoint, RGBColor(*color)))
+        self.assertEqual(str(switch), str(reference))
+
+    def test_from_thresholds_merges_equal_colors(self):
+        # Test that breakpoints between ranges of the same color are dropped
+        coverage = Coverage("AvgLandTemp")
+        switch = Switch.from_thresholds(coverage, [0, 10, 20], [(0, 0, 255), (0, 0, 255), (0, 255, 0), (255, 0, 0)])
+        self.assertEqual(switch.breakpoints, (10, 20))
+        self.assertEqual(switch.threshold_colors, ((0, 0, 255), (0, 255, 0)))
+
+    def test_from_thresholds_validation(self):
+        # Test that unsorted breakpoints and mismatched colors are rejected
+        coverage = Coverage("AvgLandTemp")
+        with self.assertRaises(ValueError):
+            Switch.from_thresholds(coverage, [10, 5], [(0, 0, 0)] * 3)
+        with self.assertRaises(ValueError):
+            Switch.from_thresholds(coverage, [5, 10], [(0, 0, 0)] * 2)
+
+    def test_evaluate_thresholds_with_cases(self):
+        # Test local evaluation of threshold cases followed by regular cases
+        coverage = Coverage("AvgLandTemp")
+        switch = Switch.from_thresholds(coverage, [0, 10], [(0, 0, 255), (0, 255, 0), (255, 0, 0)])
+        switch.add_case(Case(coverage == 99999, RGBColor(255, 255, 255)))
+        values = np.array([-5, 0, 9.5, 10, 99999, np.nan])
+        rgb = switch.evaluate(lambda coverage: values)
+        np.testing.assert_array_equal(rgb, [(0, 0, 255), (0, 255, 0), (0, 255, 0), (255, 0, 0), (255, 255, 255), (255, 0, 0)])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,164 @@
+import subprocess
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from unittest.mock import patch, MagicMock
+import sys
+sys.path.append('../src/wdc')
+from wdc import HTTPClientTransport, RequestsTransport, Transport, DatabaseConnection, HTTPError, QueryEvent, QueryResponse
+
+class EchoHandler(BaseHTTPRequestHandler):
+    """Answers POSTs with the posted query and GETs with the path; '/fail' answers 500."""
+    protocol_version = 'HTTP/1.1'
+    connections = set()
+
+    def reply(self, status, body):
+        EchoHandler.connections.add(self.client_address)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        fields = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        self.reply(500 if self.path == '/fail' else 200, fields['query'][0].encode())
+
+    def do_GET(self):
+        self.reply(200, self.path.encode())
+
+    def log_message(self, *args):
+        pass
+
+class TestHTTPClientTransport(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), EchoHandler)
+        cls.server.daemon_threads = True
+        cls.url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_post_and_keep_alive(self):
+        # Test that queries are posted as form fields over one kept-alive connection
+        EchoHandler.connections.clear()
+        transport = HTTPClientTransport(timeout=5)
+        for _ in range(3):
+            response = transport.post(self.url + '/rasdaman/ows', {'query': 'for $c in (A) return 1'})
+            self.assertEqual(response.content, b'for $c in (A) return 1')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Content-Type'], 'text/plain')
+            self.assertGreaterEqual(response.elapsed, 0)
+        self.assertEqual(len(EchoHandler.connections), 1)
+        transport.close()
+
+    def test_connections_of_finished_threads_are_closed(self):
+        # Test that repeated thread pools do not leave kept-alive connections behind
+        from concurrent.futures import ThreadPoolExecutor
+        transport = HTTPClientTransport(timeout=5)
+        dbc = DatabaseConnection(self.url, transport=transport)
+        opened = set()
+
+        def send(query):
+            response = dbc.send_request(query)
+            opened.update(transport._local.connections.values())
+            return response
+
+        for _ in range(20):
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                self.assertTrue(all(executor.map(send, ['return 1'] * 8)))
+        self.assertEqual(transport._all_connections, [])
+        self.assertGreaterEqual(len(opened), 20)
+        self.assertTrue(all(connection.sock is None for connection in opened))
+
+    def test_connection_close_and_context_manager(self):
+        # Test that closing a DatabaseConnection closes its connections, also as a context manager
+        with DatabaseConnection(self.url, transport=HTTPClientTransport(timeout=5)) as dbc:
+            self.assertEqual(dbc.send_request('return 1').content, b'return 1')
+            connection = dbc.transport._all_connections[0]
+            self.assertIsNotNone(connection.sock)
+        self.assertIsNone(connection.sock)
+        self.assertEqual(dbc.send_request('return 2').content, b'return 2')  # Reopens on use
+        dbc.close()
+
+    def test_discarded_connections_are_released(self):
+        # Test that a connection closed after an error is no longer tracked
+        transport = HTTPClientTransport(timeout=5)
+        transport.post(self.url, {'query': 'return 1'})
+        connection = transport._all_connections[0]
+        with patch.object(connection, 'request', side_effect=ValueError("broken")):
+            with self.assertRaises(ValueError):
+                transport.post(self.url, {'query': 'return 1'})
+        self.assertEqual(transport._all_connections, [])
+
+    def test_get_with_parameters(self):
+        # Test that GET parameters are appended to the URL
+        transport = HTTPClientTransport(timeout=5)
+        response = transport.get(self.url + '/ows?SERVICE=WCS', {'REQUEST': 'DescribeCoverage'})
+        self.assertEqual(response.content, b'/ows?SERVICE=WCS&REQUEST=DescribeCoverage')
+        transport.close()
+
+    def test_default_transport_of_connection(self):
+        # Test that DatabaseConnection uses the standard library transport by default
+        db_connection = DatabaseConnection(self.url + '/rasdaman/ows')
+        self.assertIsInstance(db_connection.transport, HTTPClientTransport)
+        event = QueryEvent()
+        response = db_connection.send_request('for $c in (A) return 1', event=event)
+        self.assertEqual(response.content, b'for $c in (A) return 1')
+        self.assertEqual(event.status, 200)
+        self.assertIn('network', event.timings)
+
+    def test_error_status(self):
+        # Test that error statuses raise the library's HTTPError and make send_request return None
+        transport = HTTPClientTransport(timeout=5)
+        response = transport.post(self.url + '/fail', {'query': 'x'})
+        with self.assertRaises(HTTPError):
+            response.raise_for_status()
+        self.assertIsNone(DatabaseConnection(self.url + '/fail', transport=transport).send_request('x'))
+
+    def test_connection_refused(self):
+        # Test that network errors are reported by send_request
+        db_connection = DatabaseConnection('http://127.0.0.1:9/rasdaman/ows')
+        self.assertIsNone(db_connection.send_request('x'))
+
+    def test_transport_must_implement_request(self):
+        # Test that a transport without request cannot be created, while one with it can
+        class Incomplete(Transport):
+            def close(self):
+                pass
+
+        class Complete(Transport):
+            def request(self, method, url, fields=None):
+                return QueryResponse(f"{method} {url}".encode())
+
+        with self.assertRaises(TypeError):
+            Incomplete()
+        self.assertEqual(Complete().get(self.url).content, f"GET {self.url}".encode())
+
+class TestLazyImports(unittest.TestCase):
+    def test_import_does_not_load_http_libraries(self):
+        # Test that importing wdc loads neither requests nor http.client
+        code = "import sys; import wdc; print('requests' in sys.modules, 'http.client' in sys.modules)"
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd='../src/wdc').stdout
+        self.assertEqual(output.split(), ['False', 'False'])
+
+class TestRequestsTransport(unittest.TestCase):
+    @patch('requests.post')
+    def test_post(self, mock_post):
+        # Test that requests is called like the library always did
+        RequestsTransport().post('https://ows.rasdaman.org/rasdaman/ows', {'query': 'q'})
+        mock_post.assert_called_once_with('https://ows.rasdaman.org/rasdaman/ows', data={'query': 'q'}, verify=False)
+
+    @patch('requests.get')
+    def test_get(self, mock_get):
+        # Test GET requests with parameters
+        RequestsTransport(verify=True).get('https://ows.rasdaman.org/rasdaman/ows', {'SERVICE': 'WCS'})
+        mock_get.assert_called_once_with('https://ows.rasdaman.org/rasdaman/ows', params={'SERVICE': 'WCS'}, verify=True)
+
+if __name__ == '__main__':
+    unittest.main()